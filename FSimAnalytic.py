@@ -0,0 +1,253 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FSimAnalytic.py  -- target proxy transforms straight from their F-curves
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V0.3.0 - Goldfish Version - Blender 2.8
+
+# Most target proxies are keyframed empties with no constraints or drivers.
+# Their world matrix at any frame only depends on their location, rotation
+# and scale F-curves (and those of their parents), so the whole frame range
+# can be worked out at once with NumPy, without stepping the scene.
+# The keyframe interpolation follows Blender's own F-curve evaluation.
+# IsAnalytic() says which objects can be handled this way; anything else is
+# sampled from the depsgraph as before.
+# No bpy here, only the objects' properties are read.
+
+import numpy as np
+
+
+#Interpolation types evaluated here (others use FCurve.evaluate())
+_INTERPOLATIONS = {'CONSTANT': 0, 'LINEAR': 1, 'BEZIER': 2}
+#Bisection steps when solving a Bezier segment for its parameter
+_BISECT = 40
+
+
+def _Animation(obj):
+    #The object's action if nothing but the action animates it, else False
+    anim = obj.animation_data
+    if anim is None:
+        return None
+    if len(anim.drivers):
+        return False
+    if any(not track.mute for track in anim.nla_tracks):
+        return False
+    if anim.action_influence != 1.0 or anim.action_blend_type != 'REPLACE':
+        return False
+    return anim.action
+
+
+def IsAnalytic(obj):
+    """ True if the object's transform over time only depends on its own (and its parents') F-curves """
+    while obj is not None:
+        if len(obj.constraints) or obj.rotation_mode == 'AXIS_ANGLE':
+            return False
+        if _Animation(obj) is False:
+            return False
+        if any(obj.delta_location) or any(obj.delta_rotation_euler) or tuple(obj.delta_scale) != (1.0, 1.0, 1.0):
+            return False
+        if tuple(obj.delta_rotation_quaternion) != (1.0, 0.0, 0.0, 0.0):
+            return False
+        if obj.parent is not None and obj.parent_type != 'OBJECT':
+            return False
+        obj = obj.parent
+    return True
+
+
+def _Segments(fc):
+    #Keyframes as arrays: co, handle_left, handle_right (n, 2) and interpolation codes,
+    #or None if the curve needs FCurve.evaluate()
+    keys = fc.keyframe_points
+    n = len(keys)
+    if n == 0 or len(fc.modifiers):
+        return None
+    co = np.empty(n * 2)
+    left = np.empty(n * 2)
+    right = np.empty(n * 2)
+    keys.foreach_get('co', co)
+    keys.foreach_get('handle_left', left)
+    keys.foreach_get('handle_right', right)
+    try:
+        ipo = np.array([_INTERPOLATIONS[key.interpolation] for key in keys])
+    except KeyError:
+        return None
+    return co.reshape(n, 2), left.reshape(n, 2), right.reshape(n, 2), ipo
+
+
+def _Bezier(p0, p1, p2, p3, frames):
+    #Value of Bezier segments (one per frame) at those frames
+    #keep the handles inside the segment so x is monotonic (like correct_bezpart())
+    h1 = p0[:, 0] - p1[:, 0]
+    h2 = p3[:, 0] - p2[:, 0]
+    length = p3[:, 0] - p0[:, 0]
+    both = np.abs(h1) + np.abs(h2)
+    fac = np.where(both > length, length / np.where(both > 0.0, both, 1.0), 1.0)[:, None]
+    p1 = p0 - fac * (p0 - p1)
+    p2 = p3 - fac * (p3 - p2)
+    lo = np.zeros(len(frames))
+    hi = np.ones(len(frames))
+    for i in range(_BISECT):
+        t = 0.5 * (lo + hi)
+        u = 1.0 - t
+        x = u*u*u*p0[:, 0] + 3.0*u*u*t*p1[:, 0] + 3.0*u*t*t*p2[:, 0] + t*t*t*p3[:, 0]
+        below = x < frames
+        lo = np.where(below, t, lo)
+        hi = np.where(below, hi, t)
+    t = 0.5 * (lo + hi)
+    u = 1.0 - t
+    return u*u*u*p0[:, 1] + 3.0*u*u*t*p1[:, 1] + 3.0*u*t*t*p2[:, 1] + t*t*t*p3[:, 1]
+
+
+def EvaluateFCurve(fc, frames):
+    """ An F-curve's values at every frame, same as fc.evaluate() for each """
+    frames = np.asarray(frames, dtype=float)
+    segments = _Segments(fc)
+    if segments is None:
+        return np.array([fc.evaluate(f) for f in frames])
+    co, left, right, ipo = segments
+    n = len(co)
+    values = np.empty(len(frames))
+    before = frames <= co[0, 0]
+    after = frames >= co[-1, 0]
+    #extrapolation
+    values[before] = co[0, 1]
+    values[after] = co[-1, 1]
+    if fc.extrapolation == 'LINEAR' and n > 1:
+        if ipo[0] == 1:
+            slope = (co[1, 1] - co[0, 1]) / (co[1, 0] - co[0, 0])
+        elif ipo[0] == 2 and co[0, 0] != left[0, 0]:
+            slope = (co[0, 1] - left[0, 1]) / (co[0, 0] - left[0, 0])
+        else:
+            slope = 0.0
+        values[before] += slope * (frames[before] - co[0, 0])
+        if ipo[-1] == 1:
+            slope = (co[-1, 1] - co[-2, 1]) / (co[-1, 0] - co[-2, 0])
+        elif ipo[-1] == 2 and co[-1, 0] != right[-1, 0]:
+            slope = (right[-1, 1] - co[-1, 1]) / (right[-1, 0] - co[-1, 0])
+        else:
+            slope = 0.0
+        values[after] += slope * (frames[after] - co[-1, 0])
+    inside = ~(before | after)
+    if not np.any(inside):
+        return values
+    f = frames[inside]
+    k = np.clip(np.searchsorted(co[:, 0], f, side='right') - 1, 0, n - 2)
+    p0 = co[k]
+    p3 = co[k + 1]
+    kind = ipo[k]
+    result = np.where(kind == 0, p0[:, 1], 0.0)
+    linear = kind == 1
+    if np.any(linear):
+        w = (f[linear] - p0[linear, 0]) / (p3[linear, 0] - p0[linear, 0])
+        result[linear] = p0[linear, 1] + w * (p3[linear, 1] - p0[linear, 1])
+    bezier = kind == 2
+    if np.any(bezier):
+        result[bezier] = _Bezier(p0[bezier], right[k[bezier]], left[k[bezier] + 1], p3[bezier], f[bezier])
+    values[inside] = result
+    return values
+
+
+def _Channel(action, obj, prop, count, frames):
+    #(frames, count) values of a property, keyed or constant
+    values = np.tile(np.asarray(tuple(getattr(obj, prop)), dtype=float), (len(frames), 1))
+    if action is not None:
+        for i in range(count):
+            fc = action.fcurves.find(prop, index=i)
+            if fc is not None and not fc.mute:
+                values[:, i] = EvaluateFCurve(fc, frames)
+    return values
+
+
+def _AxisMatrices(axis, angles):
+    #(frames, 3, 3) rotations about one axis
+    c = np.cos(angles)
+    s = np.sin(angles)
+    m = np.zeros((len(angles), 3, 3))
+    i, j = [(1, 2), (2, 0), (0, 1)][axis]
+    m[:, axis, axis] = 1.0
+    m[:, i, i] = c
+    m[:, j, j] = c
+    m[:, i, j] = -s
+    m[:, j, i] = s
+    return m
+
+
+def EulerMatrices(euler, order='XYZ'):
+    """ (frames, 3, 3) rotation matrices (rows) of eulers, first axis of order applied first """
+    m = np.broadcast_to(np.eye(3), (len(euler), 3, 3))
+    for axis in order:
+        a = "XYZ".index(axis)
+        m = _AxisMatrices(a, euler[:, a]) @ m
+    return m
+
+
+def QuatMatrices(q):
+    """ (frames, 3, 3) rotation matrices (rows) of quaternions (w, x, y, z), normalised first """
+    n = np.linalg.norm(q, axis=1)
+    q = np.where(n[:, None] > 0.0, q / np.where(n > 0.0, n, 1.0)[:, None], (1.0, 0.0, 0.0, 0.0))
+    w, x, y, z = q.T
+    return np.stack((
+        np.stack((1.0 - 2.0*(y*y + z*z), 2.0*(x*y - w*z), 2.0*(x*z + w*y)), axis=1),
+        np.stack((2.0*(x*y + w*z), 1.0 - 2.0*(x*x + z*z), 2.0*(y*z - w*x)), axis=1),
+        np.stack((2.0*(x*z - w*y), 2.0*(y*z + w*x), 1.0 - 2.0*(x*x + y*y)), axis=1)), axis=1)
+
+
+def MatrixToQuat(m):
+    """ Quaternions (w, x, y, z) of (frames, 3, 3) matrices, as Matrix.to_quaternion() """
+    m = m / np.linalg.norm(m, axis=1, keepdims=True)
+    q = np.empty((len(m), 4))
+    tr = 0.25 * (1.0 + m[:, 0, 0] + m[:, 1, 1] + m[:, 2, 2])
+    #the same four cases as mat3_normalized_to_quat()
+    case0 = tr > 1.1920929e-07
+    case1 = ~case0 & (m[:, 0, 0] > m[:, 1, 1]) & (m[:, 0, 0] > m[:, 2, 2])
+    case2 = ~case0 & ~case1 & (m[:, 1, 1] > m[:, 2, 2])
+    case3 = ~(case0 | case1 | case2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.sqrt(np.where(case0, tr, 1.0))
+        q0 = np.stack((s, (m[:, 2, 1] - m[:, 1, 2]) / (4.0 * s), (m[:, 0, 2] - m[:, 2, 0]) / (4.0 * s), (m[:, 1, 0] - m[:, 0, 1]) / (4.0 * s)), axis=1)
+        s = 2.0 * np.sqrt(np.where(case1, 1.0 + m[:, 0, 0] - m[:, 1, 1] - m[:, 2, 2], 1.0))
+        q1 = np.stack(((m[:, 2, 1] - m[:, 1, 2]) / s, 0.25 * s, (m[:, 0, 1] + m[:, 1, 0]) / s, (m[:, 0, 2] + m[:, 2, 0]) / s), axis=1)
+        s = 2.0 * np.sqrt(np.where(case2, 1.0 + m[:, 1, 1] - m[:, 0, 0] - m[:, 2, 2], 1.0))
+        q2 = np.stack(((m[:, 0, 2] - m[:, 2, 0]) / s, (m[:, 0, 1] + m[:, 1, 0]) / s, 0.25 * s, (m[:, 1, 2] + m[:, 2, 1]) / s), axis=1)
+        s = 2.0 * np.sqrt(np.where(case3, 1.0 + m[:, 2, 2] - m[:, 0, 0] - m[:, 1, 1], 1.0))
+        q3 = np.stack(((m[:, 1, 0] - m[:, 0, 1]) / s, (m[:, 0, 2] + m[:, 2, 0]) / s, (m[:, 1, 2] + m[:, 2, 1]) / s, 0.25 * s), axis=1)
+    q[case0] = q0[case0]
+    q[case1] = q1[case1]
+    q[case2] = q2[case2]
+    q[case3] = q3[case3]
+    return q / np.linalg.norm(q, axis=1, keepdims=True)
+
+
+def WorldMatrices(obj, frames):
+    """ (frames, 4, 4) world matrices of an IsAnalytic() object at every frame """
+    frames = np.asarray(frames, dtype=float)
+    action = _Animation(obj) or None
+    loc = _Channel(action, obj, "location", 3, frames)
+    scale = _Channel(action, obj, "scale", 3, frames)
+    if obj.rotation_mode == 'QUATERNION':
+        rot = QuatMatrices(_Channel(action, obj, "rotation_quaternion", 4, frames))
+    else:
+        rot = EulerMatrices(_Channel(action, obj, "rotation_euler", 3, frames), obj.rotation_mode)
+    m = np.zeros((len(frames), 4, 4))
+    m[:, :3, :3] = rot * scale[:, None, :]
+    m[:, :3, 3] = loc
+    m[:, 3, 3] = 1.0
+    if obj.parent is not None:
+        m = WorldMatrices(obj.parent, frames) @ np.array(obj.matrix_parent_inverse) @ m
+    return m
@@ -0,0 +1,617 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FSimBatch.py  -- vectorised swimming physics for whole schools of fish
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V0.3.0 - Goldfish Version - Blender 2.8
+
+# The FSimCore physics, one NumPy array per state variable.
+# step_batch() advances N fish by one frame in a fixed number of array
+# operations, so the Python overhead per frame doesn't grow with the school.
+# The maths is a line by line translation of FSimCore.step(); keep them in step.
+# step_batch_fixed() is the batch version of FSimCore.step_fixed().
+
+import math
+import random
+import numpy as np
+
+if __package__:
+    from . import FSimCore
+else:
+    import FSimCore
+
+
+#State variables that are plain per-fish floats
+_SCALARS = (
+    "sEffort", "sTailAngleOffset", "sAngularForceV", "sOldRqdEffort",
+    "sState", "sPecState", "sFreq", "sTailAngle",
+    "sHoverMode", "sHoverTurn",
+    "sRestFrame", "sRestartFrame", "sRestAmount",
+    "sTwitchFrame", "sTwitchAngle", "sTwitchTarget",
+    "sBackFinX", "sOldBackFinX", "sSpineAngle", "sTorsoAngle",
+    "rMaxTailAngle", "rMaxFreq", "sClock",
+)
+#State variables that are per-fish vectors
+_VECTORS = ("location", "rotation", "scale", "sRootQuat", "sVelocity")
+
+
+class BatchState:
+    """ FishState for N fish as a struct of arrays """
+    __slots__ = ("count", "frame", "sGoldfish", "sTailModel", "sTailFK", "sRandom",
+                 "sStepFrame", "sChannels", "sPrevFrame", "sPrevChannels") + _VECTORS + _SCALARS
+
+    def __init__(self, count, frame):
+        self.count = count
+        self.frame = frame
+        self.sGoldfish = np.ones(count, dtype=bool)
+        #TailFinX coefficients, used where sTailModel is set
+        self.sTailModel = np.zeros(count, dtype=bool)
+        self.sTailFK = np.zeros((count, FSimCore.TAIL_FK_SIZE))
+        #Each fish's own random.Random (drawn from in the same order as FSimCore)
+        self.sRandom = [random.Random() for i in range(count)]
+        self.location = np.zeros((count, 3))
+        self.rotation = np.zeros((count, 3))
+        self.scale = np.ones((count, 3))
+        self.sRootQuat = np.tile((1.0, 0.0, 0.0, 0.0), (count, 1))
+        self.sVelocity = np.zeros((count, 3))
+        for name in _SCALARS:
+            setattr(self, name, np.zeros(count))
+        self.sClock[:] = frame
+        #Fixed steps: scene frame and channels of the last two steps (see FSimCore.step_fixed)
+        self.sStepFrame = float(frame)
+        self.sChannels = None
+        self.sPrevFrame = float(frame)
+        self.sPrevChannels = None
+
+    @classmethod
+    def from_states(cls, states):
+        """ Pack a list of FishState (all on the same frame) into one batch """
+        batch = cls(len(states), states[0].frame if states else 0)
+        batch.sRandom = [s.sRandom for s in states]
+        batch.sGoldfish[:] = [s.sGoldfish for s in states]
+        for name in _VECTORS + _SCALARS:
+            getattr(batch, name)[:] = [getattr(s, name) for s in states]
+        for i, s in enumerate(states):
+            if s.sTailFK is not None:
+                batch.sTailModel[i] = True
+                batch.sTailFK[i] = s.sTailFK
+        if states:
+            batch.sStepFrame = states[0].sStepFrame
+            batch.sPrevFrame = states[0].sPrevFrame
+            batch.sChannels = _StackChannels([s.sChannels for s in states])
+            batch.sPrevChannels = _StackChannels([s.sPrevChannels for s in states])
+        return batch
+
+    def to_state(self, i):
+        """ Unpack fish i back into a FishState """
+        state = FSimCore.FishState(self.frame, self.location[i], self.rotation[i], self.scale[i], self.sRootQuat[i], bool(self.sGoldfish[i]))
+        for name in ("sVelocity",):
+            setattr(state, name, tuple(getattr(self, name)[i].tolist()))
+        for name in _SCALARS:
+            setattr(state, name, float(getattr(self, name)[i]))
+        if self.sTailModel[i]:
+            state.sTailFK = tuple(self.sTailFK[i].tolist())
+        state.sRandom = self.sRandom[i]
+        state.sStepFrame = self.sStepFrame
+        state.sPrevFrame = self.sPrevFrame
+        if self.sChannels is not None:
+            state.sChannels = {path: tuple(values[i].tolist()) for path, values in self.sChannels.items()}
+        if self.sPrevChannels is not None:
+            state.sPrevChannels = {path: tuple(values[i].tolist()) for path, values in self.sPrevChannels.items()}
+        return state
+
+
+def _StackChannels(channels):
+    #Per fish channel dicts as one dict of arrays (None if any fish has none)
+    if not channels or any(c is None for c in channels):
+        return None
+    return {path: np.array([c[path] for c in channels]) for path in channels[0]}
+
+
+class BatchTargets:
+    """ TargetPose for N fish. valid is False where a rig has no proxy """
+    __slots__ = ("location", "rotation", "dimensions", "valid")
+
+    def __init__(self, location, rotation, dimensions, valid=None):
+        self.location = np.asarray(location, dtype=float)
+        self.rotation = np.asarray(rotation, dtype=float)
+        self.dimensions = np.asarray(dimensions, dtype=float)
+        self.valid = np.ones(len(self.location), dtype=bool) if valid is None else np.asarray(valid, dtype=bool)
+
+    @classmethod
+    def from_poses(cls, poses):
+        """ Pack a list of TargetPose (or None) into arrays """
+        n = len(poses)
+        location = np.zeros((n, 3))
+        rotation = np.tile((1.0, 0.0, 0.0, 0.0), (n, 1))
+        dimensions = np.zeros((n, 3))
+        valid = np.zeros(n, dtype=bool)
+        for i, pose in enumerate(poses):
+            if pose is not None:
+                location[i] = pose.location
+                rotation[i] = pose.rotation
+                dimensions[i] = pose.dimensions
+                valid[i] = True
+        return cls(location, rotation, dimensions, valid)
+
+
+#Vectorised versions of the FSimCore quaternion and euler helpers
+
+def QuatX(angle):
+    angle = np.asarray(angle, dtype=float) * 0.5
+    z = np.zeros_like(angle)
+    return np.stack((np.cos(angle), np.sin(angle), z, z), axis=-1)
+
+def QuatY(angle):
+    angle = np.asarray(angle, dtype=float) * 0.5
+    z = np.zeros_like(angle)
+    return np.stack((np.cos(angle), z, np.sin(angle), z), axis=-1)
+
+def QuatZ(angle):
+    angle = np.asarray(angle, dtype=float) * 0.5
+    z = np.zeros_like(angle)
+    return np.stack((np.cos(angle), z, z, np.sin(angle)), axis=-1)
+
+def QuatMul(a, b):
+    a0, a1, a2, a3 = np.moveaxis(a, -1, 0)
+    b0, b1, b2, b3 = np.moveaxis(b, -1, 0)
+    return np.stack((a0*b0 - a1*b1 - a2*b2 - a3*b3,
+                     a0*b1 + a1*b0 + a2*b3 - a3*b2,
+                     a0*b2 + a2*b0 + a3*b1 - a1*b3,
+                     a0*b3 + a3*b0 + a1*b2 - a2*b1), axis=-1)
+
+def QuatSlerp(a, b, t):
+    t = np.asarray(t, dtype=float)
+    cosom = np.sum(a * b, axis=-1)
+    #rotate around the shortest angle
+    neg = cosom < 0.0
+    a = np.where(neg[..., None], -a, a)
+    cosom = np.abs(cosom)
+    big = (1.0 - cosom) > 0.0001
+    omega = np.arccos(np.minimum(cosom, 1.0))
+    sinom = np.where(big, np.sin(omega), 1.0)
+    sc1 = np.where(big, np.sin((1.0 - t) * omega) / sinom, 1.0 - t)
+    sc2 = np.where(big, np.sin(t * omega) / sinom, t)
+    return sc1[..., None] * a + sc2[..., None] * b
+
+def EulerToQuat(eul):
+    ti = eul[:, 0] * 0.5
+    tj = eul[:, 1] * 0.5
+    th = eul[:, 2] * 0.5
+    ci = np.cos(ti)
+    cj = np.cos(tj)
+    ch = np.cos(th)
+    si = np.sin(ti)
+    sj = np.sin(tj)
+    sh = np.sin(th)
+    cc = ci * ch
+    cs = ci * sh
+    sc = si * ch
+    ss = si * sh
+    return np.stack((cj*cc + sj*ss, cj*sc - sj*cs, cj*ss + sj*cc, cj*cs - sj*sc), axis=-1)
+
+def EulerToMatrix(eul):
+    """ (N, 3, 3) rotation matrices (rows) of 'XYZ' eulers """
+    ci = np.cos(eul[:, 0])
+    cj = np.cos(eul[:, 1])
+    ch = np.cos(eul[:, 2])
+    si = np.sin(eul[:, 0])
+    sj = np.sin(eul[:, 1])
+    sh = np.sin(eul[:, 2])
+    cc = ci * ch
+    cs = ci * sh
+    sc = si * ch
+    ss = si * sh
+    R = np.empty((len(eul), 3, 3))
+    R[:, 0, 0] = cj*ch
+    R[:, 0, 1] = sj*sc - cs
+    R[:, 0, 2] = sj*cc + ss
+    R[:, 1, 0] = cj*sh
+    R[:, 1, 1] = sj*ss + cc
+    R[:, 1, 2] = sj*cs - sc
+    R[:, 2, 0] = -sj
+    R[:, 2, 1] = cj*si
+    R[:, 2, 2] = cj*ci
+    return R
+
+def _QuatToMatrix(q):
+    n = np.linalg.norm(q, axis=-1)
+    n = np.where(n == 0.0, 1.0, n)
+    q0, q1, q2, q3 = np.moveaxis(math.sqrt(2.0) * q / n[:, None], -1, 0)
+    qda = q0 * q1
+    qdb = q0 * q2
+    qdc = q0 * q3
+    qaa = q1 * q1
+    qab = q1 * q2
+    qac = q1 * q3
+    qbb = q2 * q2
+    qbc = q2 * q3
+    qcc = q3 * q3
+    R = np.empty((len(q), 3, 3))
+    R[:, 0, 0] = 1.0 - qbb - qcc
+    R[:, 0, 1] = -qdc + qab
+    R[:, 0, 2] = qdb + qac
+    R[:, 1, 0] = qdc + qab
+    R[:, 1, 1] = 1.0 - qaa - qcc
+    R[:, 1, 2] = -qda + qbc
+    R[:, 2, 0] = -qdb + qac
+    R[:, 2, 1] = qda + qbc
+    R[:, 2, 2] = 1.0 - qaa - qbb
+    return R
+
+def _CompatibleEuler(eul, old):
+    pi_x2 = 2.0 * math.pi
+    deul = eul - old
+    eul = np.where(deul > 5.1, eul - np.floor((deul / pi_x2) + 0.5) * pi_x2, eul)
+    eul = np.where(deul < -5.1, eul + np.floor((-deul / pi_x2) + 0.5) * pi_x2, eul)
+    deul = eul - old
+    adeul = np.abs(deul)
+    #is one of the axis rotations larger than 180 degrees and the others small?
+    for i, j, k in ((0, 1, 2), (1, 0, 2), (2, 0, 1)):
+        flip = (adeul[:, i] > 3.2) & (adeul[:, j] < 1.6) & (adeul[:, k] < 1.6)
+        eul[:, i] += np.where(flip, np.where(deul[:, i] > 0.0, -pi_x2, pi_x2), 0.0)
+    return eul
+
+def QuatToEuler(q, compat=None):
+    """ Same result as Quaternion.to_euler('XYZ', compat) for each row """
+    m = _QuatToMatrix(q)
+    cy = np.hypot(m[:, 0, 0], m[:, 1, 0])
+    ok = cy > 16.0 * 1.1920929e-07
+    eul1 = np.stack((np.where(ok, np.arctan2(m[:, 2, 1], m[:, 2, 2]), np.arctan2(-m[:, 1, 2], m[:, 1, 1])),
+                     np.arctan2(-m[:, 2, 0], cy),
+                     np.where(ok, np.arctan2(m[:, 1, 0], m[:, 0, 0]), 0.0)), axis=-1)
+    if compat is None:
+        return eul1
+    eul2 = np.where(ok[:, None], np.stack((np.arctan2(-m[:, 2, 1], -m[:, 2, 2]),
+                                           np.arctan2(-m[:, 2, 0], -cy),
+                                           np.arctan2(-m[:, 1, 0], -m[:, 0, 0])), axis=-1), eul1)
+    eul1 = _CompatibleEuler(eul1, compat)
+    eul2 = _CompatibleEuler(eul2, compat)
+    d1 = np.sum(np.abs(eul1 - compat), axis=-1)
+    d2 = np.sum(np.abs(eul2 - compat), axis=-1)
+    return np.where((d1 > d2)[:, None], eul2, eul1)
+
+def TailFinX(coeffs, angle, lean):
+    n = 2 * FSimCore.TAIL_FK_HARMONICS + 1
+    x = np.zeros(len(coeffs))
+    for k, g in enumerate((1.0, 1.0 - np.cos(lean), np.sin(lean))):
+        c = coeffs[:, k*n:(k + 1)*n]
+        y = c[:, 0].copy()
+        for m in range(1, FSimCore.TAIL_FK_HARMONICS + 1):
+            y += c[:, 2*m - 1] * np.sin(m * angle) + c[:, 2*m] * np.cos(m * angle)
+        x += g * y
+    return x
+
+def _UpdateBackFin(batch):
+    #Replace the supplied tail fin position with the modelled one where there is a model
+    if batch.sTailModel.any():
+        batch.sBackFinX = np.where(batch.sTailModel, TailFinX(batch.sTailFK, batch.sSpineAngle, batch.sTorsoAngle), batch.sBackFinX)
+
+def _AngleSigned2D(a0, a1, b0, b1, fallback):
+    zero = ((a0 == 0.0) & (a1 == 0.0)) | ((b0 == 0.0) & (b1 == 0.0))
+    return np.where(zero, fallback, np.arctan2(a1*b0 - a0*b1, a0*b0 + a1*b1))
+
+def _Local(R, v, scale):
+    #velocity @ matrix_world.inverted() for each fish
+    return np.einsum('nij,nj->ni', R, v / scale)
+
+
+#Set Effort and Direction properties to try and reach the target.
+def Target(batch, params, targets, h=1.0):
+    R = EulerToMatrix(batch.rotation)
+    RigDirn = -R[:, :, 1] / batch.scale[:, 1:2]
+
+    #distance to target
+    TargetDirn = np.where(targets.valid[:, None], targets.location - batch.location, (0.0, -10.0, 0.0))
+    DifDot = np.sum(TargetDirn * RigDirn, axis=-1)
+
+    #horizontal angle to target - limit max turning effort at 90 deg
+    AngleToTarget = np.degrees(_AngleSigned2D(RigDirn[:, 0], RigDirn[:, 1], TargetDirn[:, 0], TargetDirn[:, 1], math.pi))
+    DirectionEffort = np.clip(AngleToTarget/90.0, -1.0, 1.0)
+
+    #vertical angle to target - limit max turning effort at 20 deg
+    AngleToTargetV = np.degrees(_AngleSigned2D(np.hypot(RigDirn[:, 0], RigDirn[:, 1]), RigDirn[:, 2],
+                                               np.hypot(TargetDirn[:, 0], TargetDirn[:, 1]), TargetDirn[:, 2], math.pi))
+    DirectionEffortV = np.clip(AngleToTargetV/20.0, -1.0, 1.0)
+
+    #Hover Mode Detection (Close to target and slow)
+    near = targets.valid & (np.linalg.norm(TargetDirn, axis=-1) < targets.dimensions[:, 1] * params.pHoverDist)
+    hover = np.where(near, np.minimum(1.0, batch.sHoverMode + params.pSTransTime / FSimCore.REFERENCE_FPS * h),
+                           np.maximum(0.0, batch.sHoverMode - params.pHTransTime / FSimCore.REFERENCE_FPS * h))
+    batch.sHoverMode = np.where(batch.sGoldfish, hover, 0.0)
+
+    #Return normalised required effort, turning factor, and ascending factor
+    return DifDot, DirectionEffort, DirectionEffortV
+
+
+def PecSimulation(batch, params, channels, h=1.0):
+    nFrame = batch.sClock
+    gold = batch.sGoldfish
+
+    #Update State and main angle
+    sPecState = np.where(gold, batch.sPecState + 360.0 / params.pMaxPecFreq * h, batch.sPecState)
+    batch.sPecState = sPecState
+    xPecAngle = np.sin(np.radians(sPecState))*math.radians(params.pMaxPecAngle)
+    yPecAngle = np.sin(np.radians(sPecState+90.0))*math.radians(params.pMaxPecAngle * 2)
+
+    #Rest Period Calculations
+    sRestAmount = batch.sRestAmount
+    sRestFrame = batch.sRestFrame
+    sRestartFrame = batch.sRestartFrame
+    restart = gold & (nFrame >= sRestartFrame)
+    sRestAmount = np.where(restart, np.maximum(0.0, sRestAmount - params.pPecTransition * h), sRestAmount)
+    restart &= sRestAmount < 0.1
+    sRestFrame = np.where(restart, nFrame + params.pPecDuration, sRestFrame)
+    sRestartFrame = np.where(restart, sRestFrame + params.pPecDuty * params.pPecDuration, sRestartFrame)
+    rest = gold & (nFrame >= sRestFrame) & (nFrame < sRestartFrame) & (sRestAmount < 1.0)
+    batch.sRestAmount = np.where(rest, np.minimum(1.0, sRestAmount + params.pPecTransition * h), sRestAmount)
+    batch.sRestFrame = sRestFrame
+    batch.sRestartFrame = sRestartFrame
+
+    #Add the same side fin wobble to the pec fins to stop them looking boring when not flapping
+    SideFin = QuatX(np.radians(np.sin(np.radians(batch.sState + params.pSideFinPhase)) * params.pMaxSideFinAngle))
+
+    #Slerp between oscillating angle and rest angle depending on hover status and reset periods
+    xRestAmount = (1.0 - (1.0 - batch.sRestAmount) * batch.sHoverMode)
+    RestQuat = np.broadcast_to(FSimCore.QuatX(math.radians(params.pPecOffset)), (batch.count, 4))
+    yAng = QuatY(yPecAngle)
+    xAng = QuatSlerp(QuatMul(yAng, QuatX(-xPecAngle)), RestQuat, xRestAmount)
+    channels[FSimCore.P_PEC_PALM_L] = QuatMul(xAng, SideFin)
+
+    #Tip deflection based on phase offset
+    xMaxPecScale = params.pMaxPecAngle * ( 1.0 / params.pPecStiffness) * 0.2 / 30.0
+    sPec_scale = 1.0 + np.sin(np.radians(sPecState - params.pPecPhase)) * xMaxPecScale * (1.0 - xRestAmount)
+    channels[FSimCore.P_PEC_TOP_L] = _ScaleY(sPec_scale)
+    channels[FSimCore.P_PEC_BOTTOM_L] = _ScaleY(1 - (1 - sPec_scale) * params.pPecStubRatio)
+
+    #copy to the right fin
+    #If fins are opposing
+    if not params.pPecSynch:
+        xAng = QuatSlerp(QuatMul(yAng, QuatX(xPecAngle)), RestQuat, xRestAmount)
+        channels[FSimCore.P_PEC_PALM_R] = QuatMul(xAng, SideFin)
+        channels[FSimCore.P_PEC_TOP_R] = _ScaleY(1/sPec_scale)
+        channels[FSimCore.P_PEC_BOTTOM_R] = _ScaleY(1 - (1 - 1/sPec_scale) * params.pPecStubRatio)
+    else:
+        xAng = QuatSlerp(QuatMul(QuatY(-yPecAngle), QuatX(-xPecAngle)), RestQuat, xRestAmount)
+        channels[FSimCore.P_PEC_PALM_R] = QuatMul(xAng, SideFin)
+        channels[FSimCore.P_PEC_TOP_R] = _ScaleY(sPec_scale)
+        channels[FSimCore.P_PEC_BOTTOM_R] = _ScaleY(1 - (1 - sPec_scale) * params.pPecStubRatio)
+
+
+def _ScaleY(y):
+    scale = np.ones((len(y), 3))
+    scale[:, 1] = y
+    return scale
+
+
+def StartChannels(batch, params, channels=None):
+    """ The pose each fish starts from, as step_batch() channels (see
+    FSimCore.StartChannels). channels is a list with the rig's own pose,
+    or None, for each fish.
+    """
+    n = batch.count
+    xOffset = np.radians(batch.sTailAngleOffset)
+    xTailAngle = batch.sSpineAngle
+    start = {}
+    for path in FSimCore.ChannelPaths(True):
+        start[path] = np.tile((1.0, 0.0, 0.0, 0.0) if path.endswith("rotation_quaternion") else (1.0, 1.0, 1.0), (n, 1))
+    start["location"] = batch.location.copy()
+    start["rotation_euler"] = batch.rotation.copy()
+    start[FSimCore.P_ROOT] = batch.sRootQuat.copy()
+    start[FSimCore.P_SPINE] = QuatZ(xTailAngle)
+    start[FSimCore.P_CHEST] = QuatMul(QuatZ(-xTailAngle * params.pChestRatio), QuatX(-np.abs(xOffset)*params.pChestRaise * (1.0 - batch.sHoverMode)))
+    start[FSimCore.P_TORSO] = QuatY(-xOffset*params.pLeanIntoTurn * (1.0 - batch.sHoverMode))
+    for i, own in enumerate(channels or ()):
+        if own is not None:
+            for path, value in own.items():
+                if path in start:
+                    start[path][i] = value
+    return start
+
+
+def prime(batch, params, targets, channels=None):
+    """ Start frame: remember the effort and tail position to work from.
+    channels is the rig's pose on the start frame, or None, for each fish
+    (see StartChannels), which step_batch_fixed() blends from until the
+    first step.
+    """
+    RqdEffort, RqdDirection, RqdDirectionV = Target(batch, params, targets)
+    batch.sOldRqdEffort = RqdEffort
+    _UpdateBackFin(batch)
+    batch.sOldBackFinX = batch.sBackFinX.copy()
+    batch.sClock[:] = batch.frame
+    batch.sStepFrame = float(batch.frame)
+    batch.sChannels = StartChannels(batch, params, channels)
+    batch.sPrevChannels = None
+
+
+def step_batch(batch, params, targets):
+    """ Advance every fish in the batch by one frame.
+
+    Fish without a tail fin model (sTailModel) need batch.sBackFinX to hold
+    the current x position of DEF-back_fin.T.001.Bk.
+    Returns a dict of F-curve data path -> (N, size) array of new values.
+    """
+    batch.frame += 1
+    batch.sClock[:] = batch.frame
+    return _Advance(batch, params, targets, 1.0)
+
+
+def step_batch_fixed(batch, params, targets_at, fixed):
+    """ Advance every fish to the next scene frame in steps of a FixedStep
+    (see FSimCore.step_fixed). targets_at(frame) gives the BatchTargets at a
+    (fractional) scene frame.
+    """
+    batch.frame += 1
+    nFrame = batch.frame
+    while batch.sStepFrame < nFrame - 1e-9:
+        t = batch.sStepFrame + fixed.frames
+        batch.sClock += fixed.h
+        channels = _Advance(batch, params, targets_at(t), fixed.h)
+        batch.sPrevFrame, batch.sPrevChannels = batch.sStepFrame, batch.sChannels
+        batch.sStepFrame, batch.sChannels = t, channels
+    w = (nFrame - batch.sPrevFrame) / (batch.sStepFrame - batch.sPrevFrame)
+    return BlendChannels(batch.sPrevChannels, batch.sChannels, w)
+
+
+def BlendChannels(a, b, w):
+    """ Channels a blended toward b by w (quaternions are normalised), b itself at w = 1 """
+    if a is None or w >= 1.0:
+        return b
+    out = {}
+    for path, value in b.items():
+        old = a[path]
+        if path.endswith("rotation_quaternion"):
+            value = np.where(np.sum(old * value, axis=1, keepdims=True) < 0.0, -value, value)
+            q = old + (value - old) * w
+            out[path] = q / np.linalg.norm(q, axis=1, keepdims=True)
+        else:
+            out[path] = old + (value - old) * w
+    return out
+
+
+def _Advance(batch, params, targets, h):
+    #One step of h tuned frames, batch.sClock is the time at the end of it
+    nFrame = batch.sClock
+    channels = {}
+    pEffortRamp = params.pEffortRamp
+    xRamp = FSimCore._Ramp(pEffortRamp, h)
+    xDecay = FSimCore._Decay(pEffortRamp, h)
+    n = batch.count
+
+    #Get the effort and direction change to head toward the target
+    RqdEffort, RqdDirection, RqdDirectionV = Target(batch, params, targets, h)
+    batch.sOldRqdEffort = RqdEffort
+    batch.sEffort = np.clip(params.pEffortGain * RqdEffort * xRamp + batch.sEffort * xDecay, 0.0, FSimCore.MAX_EFFORT)
+    sHoverMode = batch.sHoverMode
+
+    #Pec fin simulation
+    PecSimulation(batch, params, channels, h)
+
+    #Convert effort into tail frequency and amplitude (Fades to a low value if in hover mode)
+    batch.sFreq = batch.rMaxFreq * ((1-sHoverMode) * (1.0/(batch.sEffort+ 0.01)) + sHoverMode * 2.0)
+    batch.sTailAngle = batch.rMaxTailAngle * ((1-sHoverMode) * batch.sEffort + sHoverMode * params.pHoverTailFrc)
+
+    #Convert direction into Tail Offset angle (Hover turning is currently disabled)
+    xSwimTailAngleOffset = RqdDirection * params.pMaxSteeringAngle
+    batch.sTailAngleOffset = batch.sTailAngleOffset * xDecay + xRamp * np.maximum(0,(1.0 - sHoverMode*2.0)) * xSwimTailAngleOffset
+
+    #Hover 'Twitch' calculations (Make the fish do some random twisting during hover mode)
+    hovering = sHoverMode >= 0.5
+    sTwitchFrame = np.where(hovering, batch.sTwitchFrame, 0.0)
+    sTwitchTarget = np.where(hovering, batch.sTwitchTarget, 0.0)
+    twitch = hovering & (nFrame >= sTwitchFrame)
+    if twitch.any():
+        rnd = np.zeros((2, n))
+        for i in np.flatnonzero(twitch):
+            rnd[0, i] = batch.sRandom[i].random()
+            rnd[1, i] = batch.sRandom[i].random()
+        xTwitchFrame = nFrame + params.pHoverTwitchTime * (rnd[0] - 0.5)
+        #Only twitch while not resting
+        resting = (xTwitchFrame < batch.sRestartFrame) & (xTwitchFrame > batch.sRestFrame)
+        xTwitchFrame = np.where(resting, batch.sRestartFrame + 5, xTwitchFrame)
+        sTwitchFrame = np.where(twitch, xTwitchFrame, sTwitchFrame)
+        sTwitchTarget = np.where(twitch, params.pHoverTwitch * 2.0 * (rnd[1] - 0.5), sTwitchTarget)
+    batch.sTwitchFrame = sTwitchFrame
+    batch.sTwitchTarget = sTwitchTarget
+    batch.sTwitchAngle = batch.sTwitchAngle * FSimCore._Decay(0.1, h) + FSimCore._Ramp(0.1, h) * sTwitchTarget
+
+    #Spine Movement
+    sState = batch.sState + 360.0 / batch.sFreq * h
+    batch.sState = sState
+    xOffset = np.radians(batch.sTailAngleOffset)
+    xTailAngle = np.sin(np.radians(sState))*np.radians(batch.sTailAngle) + xOffset + np.radians(batch.sTwitchAngle)
+    channels[FSimCore.P_SPINE] = QuatZ(xTailAngle)
+    channels[FSimCore.P_CHEST] = QuatMul(QuatZ(-xTailAngle * params.pChestRatio), QuatX(-np.abs(xOffset)*params.pChestRaise * (1.0 - sHoverMode)))
+    xLean = -xOffset*params.pLeanIntoTurn * (1.0 - sHoverMode)
+    channels[FSimCore.P_TORSO] = QuatY(xLean)
+
+    #Tail Movment (the fin position lags the spine by a frame, as it did when read from the evaluated pose)
+    _UpdateBackFin(batch)
+    batch.sSpineAngle = xTailAngle
+    batch.sTorsoAngle = xLean
+    back_fin_dif = batch.sBackFinX - batch.sOldBackFinX
+    batch.sOldBackFinX = batch.sBackFinX.copy()
+
+    #Tailfin bending based on phase offset
+    pMaxTailScale = params.pMaxTailFinAngle * ( 1.0 / params.pTailFinStiffness) * 0.2 / 30.0
+    sBack_fin1_scale = 1.0 + np.sin(np.radians(sState + params.pTailFinPhase)) * pMaxTailScale * (batch.sTailAngle / batch.rMaxTailAngle)
+    channels[FSimCore.P_BACK_FIN1] = _ScaleY(sBack_fin1_scale)
+    channels[FSimCore.P_BACK_FIN2] = _ScaleY(1 - (1 - sBack_fin1_scale) * params.pTailFinStubRatio)
+
+    SideFinRot = np.radians(np.sin(np.radians(sState + params.pSideFinPhase)) * params.pMaxSideFinAngle)
+    channels[FSimCore.P_SIDE_FIN_L] = QuatX(-SideFinRot)
+    channels[FSimCore.P_SIDE_FIN_R] = QuatX(SideFinRot)
+
+    #Do Object movment with Forward force and Angular force
+    ForwardForce = np.abs(np.cos(np.radians(sState))) * np.radians(batch.sTailAngle) * 15.0 * params.pPower / params.pMaxFreq
+
+    #Angular force due to 'swish', rudder effect and fake turning assistance
+    AngularForce = back_fin_dif / params.pAngularDrag
+    AngularForce += xTailAngle * batch.sVelocity[:, 1] / params.pAngularDrag * h
+    AngularForce += -(batch.sTailAngleOffset/params.pMaxSteeringAngle) * params.pTurnAssist * h
+
+    #Angular force for vertical movement
+    batch.sAngularForceV = batch.sAngularForceV * xDecay + RqdDirectionV * params.pMaxVerticalAngle * FSimCore._Gain(pEffortRamp, h)
+
+    swim = (sHoverMode < 0.1) | ~targets.valid
+    R = EulerToMatrix(batch.rotation)
+    v = batch.sVelocity
+    drag = params.pDrag * v * np.abs(v)
+
+    #Swimming - forward force only
+    SwimForce = np.zeros((n, 3))
+    SwimForce[:, 1] = -ForwardForce
+    SwimVelocity = v + (SwimForce - drag) / params.pMass * h
+    SwimRotation = batch.rotation.copy()
+    SwimRotation[:, 0] += np.radians(batch.sAngularForceV) * h
+    SwimRotation[:, 2] += np.radians(AngularForce)
+    SwimRoot = np.where((sHoverMode <= 0.1)[:, None], (1.0, 0.0, 0.0, 0.0), batch.sRootQuat)
+
+    #Hovering - pec fins push towards the target
+    with np.errstate(divide='ignore', invalid='ignore'):
+        RigForce = (sHoverMode * params.pPecEffortGain)[:, None] * batch.scale * np.einsum('nij,ni->nj', R, targets.location - batch.location)
+        xHoverMaxForce = params.pHoverMaxForce * (1-batch.sRestAmount*0.6)
+        xDerated = xHoverMaxForce * params.pHoverDerate
+        RigForce[:, 1] = np.minimum(np.maximum(RigForce[:, 1], -xHoverMaxForce), xDerated)
+        RigForce[:, 2] = np.minimum(np.maximum(RigForce[:, 2], -xDerated), xDerated)
+        RigForce[:, 0] = np.minimum(np.maximum(RigForce[:, 0], -xDerated), xDerated)
+        HoverVelocity = v + (RigForce - drag) / params.pMass * h
+
+        xTargetQuat = QuatMul(targets.rotation, np.broadcast_to(FSimCore.QuatZ(math.radians(params.pStartAngle)), (n, 4)))
+        xRigQuat = QuatSlerp(EulerToQuat(batch.rotation), xTargetQuat, FSimCore._Ramp(params.pPecTurnAssist/100.0, h))
+        HoverRotation = QuatToEuler(xRigQuat, batch.rotation)
+
+        rf = np.where(RigForce[:, 1] < 0, RigForce[:, 1] * params.pHoverDerate, RigForce[:, 1])
+        TiltAngle = np.radians(params.pHoverTilt * rf / (params.pHoverMaxForce * params.pHoverDerate))
+        HoverRoot = QuatSlerp(batch.sRootQuat, QuatX(TiltAngle), FSimCore._Ramp(0.03, h))
+        xTurnQuat = targets.rotation * (1.0, -1.0, -1.0, -1.0)
+        HoverTurn = np.degrees(QuatToEuler(xTurnQuat)[:, 2])
+
+    swim3 = swim[:, None]
+    batch.sVelocity = np.clip(np.where(swim3, SwimVelocity, HoverVelocity), -FSimCore.MAX_VELOCITY, FSimCore.MAX_VELOCITY)
+    batch.location = batch.location + _Local(R, batch.sVelocity * h, batch.scale)
+    batch.rotation = np.where(swim3, SwimRotation, HoverRotation)
+    batch.sRootQuat = np.where(swim3, SwimRoot, HoverRoot)
+    batch.sHoverTurn = np.where(swim, 0.0, HoverTurn)
+    channels["location"] = batch.location
+    channels["rotation_euler"] = batch.rotation
+    channels[FSimCore.P_ROOT] = batch.sRootQuat
+
+    return channels
@@ -0,0 +1,358 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FSimBenchmark.py  -- simulation throughput for schools of every size
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V0.3.0 - Goldfish Version - Blender 2.8
+
+# Times the simulation on synthetic schools of 1 to 10,000 fish, each
+# following its own scripted target path (swim, stop and hover, swim on),
+# and saves the results as JSON so runs before and after a change can be
+# compared (--baseline exits with an error if anything got slower).
+#
+# With plain Python it times the simulation engines on their own:
+#   python FSimBenchmark.py --sizes 1 10 100 --output before.json
+#   step      FSimCore.step(), one fish at a time (the Simulate default)
+#   batch     FSimBatch.step_batch(), the whole school at once
+#   fixed     FSimBatch.step_batch_fixed() with 0.01 s steps
+#   parallel  FSimParallel, the school split across worker processes
+# Inside Blender (in background mode, so Simulate runs to the end before
+# returning), with a rig that has a target as the active object, it times the
+# Copy Models and Simulate operators themselves:
+#   blender scene.blend --background --python FSimBenchmark.py -- --blender
+#
+# Each result has the frames and fish-frames simulated per second, the keys
+# per second (every channel value for the engines, the keyframes actually in
+# the actions for Simulate), and the peak memory of the process so far.
+
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+if __package__:
+    from . import FSimCore, FSimBatch, FSimParallel, FSimTrajectory
+else:
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import FSimCore, FSimBatch, FSimParallel, FSimTrajectory
+
+
+SIZES = (1, 10, 100, 1000, 10000)
+ENGINES = ("step", "batch", "fixed", "parallel")
+#Distance between the fish at the start
+SPACING = 3.0
+#Share of the frame range each target spends stopped (so the fish hover)
+PAUSE = (0.4, 0.6)
+
+
+def PeakRSS():
+    """ Peak resident memory of this process (and finished workers) in MB, None if unknown """
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    #kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)
+
+
+def Paths(count, frames):
+    """ (location, rotation) of every target at every frame, shapes (F, N, 3) and (F, N, 4) """
+    t = np.asarray(frames, dtype=float)[:, None] - frames[0]
+    k = np.arange(count)[None, :]
+    length = max(1.0, float(frames[-1] - frames[0]))
+    side = max(1, int(math.ceil(math.sqrt(count))))
+    speed = 0.08 + 0.04 * ((k * 7919) % 13) / 13.0
+    #distance travelled, held still through the pause
+    pause_start, pause_end = PAUSE[0] * length, PAUSE[1] * length
+    travel = speed * (np.minimum(t, pause_start) + np.maximum(0.0, t - pause_end))
+    location = np.empty((len(frames), count, 3))
+    location[..., 0] = (k % side) * SPACING + 0.5 * np.sin(t / 20.0 + k)
+    location[..., 1] = -travel
+    location[..., 2] = (k // side) * SPACING + 0.2 * np.sin(t / 35.0 + 2.0 * k)
+    yaw = 0.3 * np.sin(t / 30.0 + k)
+    rotation = np.zeros((len(frames), count, 4))
+    rotation[..., 0] = np.cos(yaw / 2.0)
+    rotation[..., 3] = np.sin(yaw / 2.0)
+    return location, rotation
+
+
+def Trajectory(count, start, end):
+    """ TrajectoryBuffer of the scripted targets for frames start..end """
+    trajectory = FSimTrajectory.TrajectoryBuffer(start, end, count)
+    location, rotation = Paths(count, range(start, end + 1))
+    trajectory.data[:, :, FSimTrajectory.LOC] = location
+    trajectory.data[:, :, FSimTrajectory.ROT] = rotation
+    trajectory.data[:, :, FSimTrajectory.DIM] = 1.0
+    trajectory.valid[:] = True
+    return trajectory
+
+
+#Tail fin x position against spine angle, in place of calibrating a real rig
+_TAIL_ANGLES = [math.radians(a) for a in range(-90, 91, 15)]
+_TAIL_XS = [0.1 * math.sin(a) for a in _TAIL_ANGLES]
+
+
+def School(count, params, trajectory, seed=0):
+    """ A FishState for each fish, on its target at the start frame (not yet primed) """
+    states = []
+    for i in range(count):
+        pose = trajectory.pose(trajectory.start, i)
+        state = FSimCore.FishState(trajectory.start, pose.location, (0.0, 0.0, 0.0), seed=FSimCore.RigSeed(seed, "Fish.{:05d}".format(i)))
+        state.randomise(params)
+        state.sTailFK = FSimCore.FitTailFin(_TAIL_ANGLES, _TAIL_XS)
+        states.append(state)
+    return states
+
+
+def _Values(channels):
+    #channel values (keys, if every value were keyed) in one step's channels
+    return sum(len(value) for value in channels.values())
+
+
+def RunStep(params, trajectory, states, budget):
+    for i, state in enumerate(states):
+        FSimCore.prime(state, params, trajectory.pose(trajectory.start, i))
+    frames = nValues = 0
+    t0 = time.perf_counter()
+    for nFrame in range(trajectory.start + 1, trajectory.end + 1):
+        for i, state in enumerate(states):
+            channels = FSimCore.step(state, params, trajectory.pose(nFrame, i))
+            nValues += _Values(channels)
+        frames += 1
+        if time.perf_counter() - t0 > budget:
+            break
+    return frames, nValues, time.perf_counter() - t0
+
+
+def RunBatch(params, trajectory, states, budget, fixed=None):
+    batch = FSimBatch.BatchState.from_states(states)
+    FSimBatch.prime(batch, params, trajectory.targets(trajectory.start))
+    frames = nValues = 0
+    t0 = time.perf_counter()
+    for nFrame in range(trajectory.start + 1, trajectory.end + 1):
+        if fixed is None:
+            channels = FSimBatch.step_batch(batch, params, trajectory.targets(nFrame))
+        else:
+            channels = FSimBatch.step_batch_fixed(batch, params, trajectory.targets, fixed)
+        nValues += sum(values.size for values in channels.values())
+        frames += 1
+        if time.perf_counter() - t0 > budget:
+            break
+    return frames, nValues, time.perf_counter() - t0
+
+
+def RunParallel(params, trajectory, states, workers=None):
+    #(there's no stopping the workers part way, so the whole range is always baked)
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(workers) as executor:
+        jobs = FSimParallel.SubmitBake(executor, states, params, trajectory, range(len(states)), trajectory.start, trajectory.end, workers=workers)
+        nValues = 0
+        for chunk, future in jobs:
+            channels, snapshots = future.result()
+            nValues += sum(values.size for values in channels.values())
+    return trajectory.end - trajectory.start, nValues, time.perf_counter() - t0
+
+
+def Result(case, count, frames, nKeys, seconds, **extra):
+    seconds = max(seconds, 1e-9)
+    result = {
+        "case": case,
+        "fish": count,
+        "frames": frames,
+        "seconds": seconds,
+        "frames_per_sec": frames / seconds,
+        "fish_frames_per_sec": frames * count / seconds,
+        "keys_per_sec": nKeys / seconds,
+        "peak_rss_mb": PeakRSS(),
+    }
+    result.update(extra)
+    return result
+
+
+def EngineCases(sizes, engines, start, end, preset, budget, workers=None):
+    params = FSimCore.FishParams.from_preset(preset)
+    results = []
+    for count in sizes:
+        trajectory = Trajectory(count, start, end)
+        for engine in engines:
+            states = School(count, params, trajectory)
+            if engine == "step":
+                frames, nKeys, seconds = RunStep(params, trajectory, states, budget)
+            elif engine == "batch":
+                frames, nKeys, seconds = RunBatch(params, trajectory, states, budget)
+            elif engine == "fixed":
+                frames, nKeys, seconds = RunBatch(params, trajectory, states, budget, FSimCore.FixedStep(FSimCore.REFERENCE_FPS, 0.01))
+            else:
+                frames, nKeys, seconds = RunParallel(params, trajectory, states, workers)
+            results.append(Result(engine, count, frames, nKeys, seconds))
+            Report(results[-1])
+    return results
+
+
+def BlenderCases(sizes, start, end):
+    """ Time Copy Models and Simulate for the active rig, with its target
+    copied to each scripted path. Everything added is removed again afterwards.
+    """
+    import bpy
+    context = bpy.context
+    if context.window is not None:
+        raise RuntimeError("Run Blender with --background, or Simulate carries on after the benchmark has stopped timing it")
+    scene = context.scene
+    pFSM = scene.FSimMainProps
+    rig = context.object
+    root = rig.pose.bones.get("root") if rig is not None and rig.type == 'ARMATURE' else None
+    proxy = scene.objects.get(root.get("TargetProxy", "")) if root is not None else None
+    if proxy is None:
+        raise RuntimeError("The active object must be a rig with a target (use 'Add a target' first)")
+    pFSM.fsim_start_frame = start
+    pFSM.fsim_end_frame = end
+    pFSM.fsim_copyrigs = True
+    pFSM.fsim_copymesh = False
+    pFSM.fsim_singlepass = True
+    results = []
+    for count in sizes:
+        before = set(bpy.data.objects.keys())
+        #The rig keeps its own target, the copies get the others
+        frames = range(start, end + 1, 10)
+        location, rotation = Paths(count, frames)
+        for i in range(1, count):
+            target = proxy.copy()
+            target.animation_data_clear()
+            context.collection.objects.link(target)
+            for j, nFrame in enumerate(frames):
+                target.location = [a + b for a, b in zip(proxy.location, location[j, i] - location[0, 0])]
+                target.rotation_euler = (0.0, 0.0, 2.0 * math.atan2(rotation[j, i, 3], rotation[j, i, 0]))
+                target.keyframe_insert(data_path="location", frame=nFrame)
+                target.keyframe_insert(data_path="rotation_euler", frame=nFrame)
+        pFSM.fsim_maxnum = count
+        context.view_layer.objects.active = rig
+
+        t0 = time.perf_counter()
+        bpy.ops.armature.fsim_run()
+        seconds = time.perf_counter() - t0
+        rigs = [obj for obj in scene.objects if obj.type == 'ARMATURE' and obj.name[:3] == rig.name[:3]]
+        results.append(Result("copy_models", count, 0, 0, seconds, rigs=len(rigs), rigs_per_sec=len(rigs) / max(seconds, 1e-9)))
+        Report(results[-1])
+
+        context.view_layer.objects.active = rig
+        t0 = time.perf_counter()
+        bpy.ops.armature.fsimulate()
+        seconds = time.perf_counter() - t0
+        nKeys = 0
+        for obj in rigs:
+            anim = obj.animation_data
+            if anim is not None and anim.action is not None:
+                nKeys += sum(len(fc.keyframe_points) for fc in anim.action.fcurves)
+        results.append(Result("simulate", count, end - start, nKeys, seconds, rigs=len(rigs)))
+        Report(results[-1])
+
+        #Back to just the rig and its target for the next size
+        for name in set(bpy.data.objects.keys()) - before:
+            obj = bpy.data.objects[name]
+            data = obj.data
+            bpy.data.objects.remove(obj)
+            if isinstance(data, bpy.types.Armature) and data.users == 0:
+                bpy.data.armatures.remove(data)
+    return results
+
+
+def Report(result):
+    rss = result["peak_rss_mb"]
+    print("{case:>12} {fish:>6} fish: {frames:>5} frames in {seconds:8.3f} s  {frames_per_sec:10.1f} frames/s  "
+          "{fish_frames_per_sec:12.1f} fish-frames/s  {keys_per_sec:12.0f} keys/s".format(**result)
+          + ("  {:.0f} MB".format(rss) if rss is not None else ""))
+
+
+def Environment():
+    environment = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+    try:
+        import bpy
+        environment["blender"] = bpy.app.version_string
+    except ImportError:
+        pass
+    return environment
+
+
+def Compare(results, baseline, tolerance):
+    """ Print the speed of each case against the baseline file, return the cases that got slower """
+    with open(baseline) as f:
+        before = {(r["case"], r["fish"]): r for r in json.load(f)["results"]}
+    slower = []
+    for result in results:
+        old = before.get((result["case"], result["fish"]))
+        if old is None or not old["fish_frames_per_sec"]:
+            continue
+        ratio = result["fish_frames_per_sec"] / old["fish_frames_per_sec"]
+        print("{:>12} {:>6} fish: {:.2f}x".format(result["case"], result["fish"], ratio))
+        if ratio < 1.0 - tolerance:
+            slower.append((result["case"], result["fish"], ratio))
+    return slower
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else sys.argv[1:]
+    parser = argparse.ArgumentParser(description="Time the FishSim simulation for schools of different sizes")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="school sizes to time")
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=ENGINES, help="engines to time (without Blender)")
+    parser.add_argument("--start", type=int, default=1, help="first frame")
+    parser.add_argument("--end", type=int, default=250, help="last frame")
+    parser.add_argument("--preset", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "presets", "goldfish.py"), help="parameter preset")
+    parser.add_argument("--budget", type=float, default=30.0, help="seconds each case may run before stopping early (not parallel)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes for the parallel engine")
+    parser.add_argument("--blender", action="store_true", help="time the Copy Models and Simulate operators (inside Blender)")
+    parser.add_argument("--output", default="fsim_benchmark.json", help="JSON file for the results")
+    parser.add_argument("--baseline", default=None, help="earlier results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown against the baseline allowed before failing")
+    args = parser.parse_args(argv)
+
+    if args.blender:
+        results = BlenderCases(args.sizes, args.start, args.end)
+    else:
+        results = EngineCases(args.sizes, args.engines, args.start, args.end, args.preset, args.budget, args.workers)
+    with open(args.output, "w") as f:
+        json.dump({"environment": Environment(), "frames": (args.start, args.end), "preset": os.path.basename(args.preset), "results": results}, f, indent=1)
+    print("Results saved to", args.output)
+
+    if args.baseline:
+        slower = Compare(results, args.baseline, args.tolerance)
+        if slower:
+            print("Slower than the baseline:", ", ".join("{} ({} fish) {:.2f}x".format(*s) for s in slower))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
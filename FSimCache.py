@@ -0,0 +1,99 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FSimCache.py  -- reuse of unchanged bakes for the FishSim add-on
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V0.3.0 - Goldfish Version - Blender 2.8
+
+# The channels of every complete bake are kept under a hash of everything
+# that went into it. A rig whose hash matches an earlier bake is keyed
+# straight from the cache instead of being simulated again.
+
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+
+def BakeKey(params_key, bone_names, trajectory, start_channels, start, end, seed=None):
+    """ Hash of the inputs of one rig's bake.
+    params_key is FSimSnapshots.ParamsKey(), trajectory the rig's target
+    samples (or None) and start_channels the channel values at the start frame.
+    """
+    h = hashlib.sha1()
+    h.update(repr(params_key).encode())
+    h.update(repr(sorted(bone_names)).encode())
+    h.update(repr((start, end, seed)).encode())
+    h.update(repr(sorted((path, tuple(value)) for path, value in start_channels.items())).encode())
+    if trajectory is not None:
+        h.update(np.ascontiguousarray(trajectory, dtype=float).tobytes())
+    return h.hexdigest()
+
+
+class BakeCache:
+    """ Least recently used store of (frames, {data path: values}) bakes, limited by size in bytes """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def _size(entry):
+        frames, samples = entry
+        return frames.nbytes + sum(values.nbytes for values in samples.values())
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, frames, samples):
+        entry = (np.asarray(frames, dtype=float), {path: np.asarray(values, dtype=float) for path, values in samples.items()})
+        if key in self.entries:
+            self.size -= self._size(self.entries.pop(key))
+        self.entries[key] = entry
+        self.size += self._size(entry)
+        self.evict()
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.evict()
+
+    def evict(self):
+        #drop the least recently used bakes until it fits
+        while self.entries and self.size > self.max_bytes:
+            key, entry = self.entries.popitem(last=False)
+            self.size -= self._size(entry)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+#Shared by every Simulate run in the Blender session
+Cache = BakeCache(256 * 1024 * 1024)
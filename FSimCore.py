@@ -0,0 +1,843 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FSimCore.py  -- headless swimming physics for the FishSim add-on
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V0.3.0 - Goldfish Version - Blender 2.8
+
+# The swimming physics, without bpy or mathutils.
+# ARMATURE_OT_FSimulate reads the rig and target proxy into a FishState and a
+# TargetPose, calls step() once per frame and writes the returned channels onto
+# the pose bones. Nothing in here touches RNA, so a fish can be stepped,
+# profiled and benchmarked in plain Python.
+# The parameters are tuned per frame at REFERENCE_FPS. step() advances one
+# such frame per scene frame, whatever the scene's frame rate. step_fixed()
+# instead advances in fixed steps of a FixedStep's length in seconds and
+# resamples the channels to the scene frames, so the motion is the same at
+# any frame rate.
+
+import ast
+import math
+import random
+import re
+import struct
+
+
+#Frame rate the parameters are tuned for (one step() is 1/REFERENCE_FPS seconds)
+REFERENCE_FPS = 25.0
+
+#Limits of the FSimProps sVelocity (each component) and sEffort state properties
+MAX_VELOCITY = 5.0
+MAX_EFFORT = 1.0
+
+#Parameters copied from FSimProps (plus the start angle from FSimMainProps)
+PARAM_NAMES = (
+    "pMass", "pDrag", "pPower", "pMaxFreq", "pEffortGain", "pEffortIntegral", "pEffortRamp",
+    "pAngularDrag", "pTurnAssist", "pMaxTailAngle", "pMaxSteeringAngle", "pMaxVerticalAngle",
+    "pMaxTailFinAngle", "pTailFinPhase", "pTailFinStiffness", "pTailFinStubRatio",
+    "pMaxSideFinAngle", "pSideFinPhase", "pChestRatio", "pChestRaise", "pLeanIntoTurn", "pRandom",
+    "pPecEffortGain", "pPecTurnAssist", "pMaxPecFreq", "pMaxPecAngle", "pPecPhase",
+    "pPecStubRatio", "pPecStiffness", "pHTransTime", "pSTransTime", "pPecOffset", "pHoverDist",
+    "pHoverTailFrc", "pHoverMaxForce", "pHoverDerate", "pHoverTilt", "pPecDuration", "pPecDuty",
+    "pPecTransition", "pHoverTwitch", "pHoverTwitchTime", "pPecSynch",
+)
+
+#FSimProps defaults (FishSim.py), for parameters a preset doesn't set when there's no Blender to ask
+PARAM_DEFAULTS = {
+    "pMass": 30.0, "pDrag": 8.0, "pPower": 1.0, "pMaxFreq": 15.0, "pEffortGain": 0.5,
+    "pEffortIntegral": 0.5, "pEffortRamp": 0.2, "pAngularDrag": 1.0, "pTurnAssist": 3.0,
+    "pMaxTailAngle": 15.0, "pMaxSteeringAngle": 15.0, "pMaxVerticalAngle": 0.1,
+    "pMaxTailFinAngle": 15.0, "pTailFinPhase": 90.0, "pTailFinStiffness": 1.0, "pTailFinStubRatio": 0.3,
+    "pMaxSideFinAngle": 5.0, "pSideFinPhase": 90.0, "pChestRatio": 0.5, "pChestRaise": 1.0,
+    "pLeanIntoTurn": 1.0, "pRandom": 0.25, "pPecEffortGain": 0.25, "pPecTurnAssist": 1.0,
+    "pMaxPecFreq": 15.0, "pMaxPecAngle": 20.0, "pPecPhase": 90.0, "pPecStubRatio": 0.7,
+    "pPecStiffness": 0.7, "pHTransTime": 0.5, "pSTransTime": 0.2, "pPecOffset": 20.0, "pHoverDist": 1.0,
+    "pHoverTailFrc": 0.2, "pHoverMaxForce": 0.2, "pHoverDerate": 0.2, "pHoverTilt": 4.0,
+    "pPecDuration": 50.0, "pPecDuty": 0.8, "pPecTransition": 0.05, "pHoverTwitch": 4.0,
+    "pHoverTwitchTime": 40.0, "pPecSynch": False,
+}
+
+#Bones animated by the simulation, and the property keyed on each
+SWIM_BONES = (
+    ("root", "rotation_quaternion"),
+    ("spine_master", "rotation_quaternion"),
+    ("chest", "rotation_quaternion"),
+    ("torso", "rotation_quaternion"),
+    ("back_fin_masterBk.001", "scale"),
+    ("back_fin_masterBk", "scale"),
+    ("side_fin.L", "rotation_quaternion"),
+    ("side_fin.R", "rotation_quaternion"),
+)
+PEC_BONES = (
+    ("pec_palm.L", "rotation_quaternion"),
+    ("pec_palm.R", "rotation_quaternion"),
+    ("t_master.L", "scale"),
+    ("b_master.L", "scale"),
+    ("t_master.R", "scale"),
+    ("b_master.R", "scale"),
+)
+
+
+def _Ramp(r, h):
+    #Per-step rate of a per-frame first order filter x = x*(1-r) + r*u, for a step of h frames
+    return r if h == 1.0 else 1.0 - (1.0 - r) ** h
+
+def _Decay(r, h):
+    #Matching per-step factor for x
+    return 1.0 - r if h == 1.0 else (1.0 - r) ** h
+
+def _Gain(r, h):
+    #Per-step gain of u for a filter x = x*(1-r) + u
+    if h == 1.0:
+        return 1.0
+    return (1.0 - (1.0 - r) ** h) / r if r > 0.0 else h
+
+
+class FixedStep:
+    """ Fixed time step of timestep seconds, for a scene at fps frames per second """
+    __slots__ = ("fps", "timestep", "h", "frames")
+
+    def __init__(self, fps, timestep):
+        self.fps = fps
+        self.timestep = timestep
+        #the step in tuned (REFERENCE_FPS) frames, and in scene frames
+        self.h = timestep * REFERENCE_FPS
+        self.frames = timestep * fps
+
+    def key(self):
+        return (self.fps, self.timestep)
+
+
+def BlendChannels(a, b, w):
+    """ Channels a blended toward b by w (quaternions are normalised), b itself at w = 1 """
+    if a is None or w >= 1.0:
+        return b
+    out = {}
+    for path, value in b.items():
+        old = a[path]
+        if path.endswith("rotation_quaternion"):
+            if sum(x * y for x, y in zip(old, value)) < 0.0:
+                value = tuple(-x for x in value)
+            q = [x + (y - x) * w for x, y in zip(old, value)]
+            n = math.sqrt(sum(x * x for x in q))
+            out[path] = tuple(x / n for x in q)
+        else:
+            out[path] = tuple(x + (y - x) * w for x, y in zip(old, value))
+    return out
+
+def RigSeed(seed, rig_name):
+    """ Seed for a rig's own random numbers, from the scene seed and the rig name """
+    return "{}:{}".format(seed, rig_name)
+
+def BonePath(bone_name, prop):
+    return 'pose.bones["{}"].{}'.format(bone_name, prop)
+
+
+def ChannelPaths(goldfish):
+    """ The F-curve data paths written by step(), in a fixed order.
+    """
+    paths = ["location", "rotation_euler"]
+    paths += [BonePath(b, p) for b, p in SWIM_BONES]
+    if goldfish:
+        paths += [BonePath(b, p) for b, p in PEC_BONES]
+    return paths
+
+
+P_ROOT = BonePath("root", "rotation_quaternion")
+P_SPINE = BonePath("spine_master", "rotation_quaternion")
+P_CHEST = BonePath("chest", "rotation_quaternion")
+P_TORSO = BonePath("torso", "rotation_quaternion")
+P_BACK_FIN1 = BonePath("back_fin_masterBk.001", "scale")
+P_BACK_FIN2 = BonePath("back_fin_masterBk", "scale")
+P_SIDE_FIN_L = BonePath("side_fin.L", "rotation_quaternion")
+P_SIDE_FIN_R = BonePath("side_fin.R", "rotation_quaternion")
+P_PEC_PALM_L = BonePath("pec_palm.L", "rotation_quaternion")
+P_PEC_PALM_R = BonePath("pec_palm.R", "rotation_quaternion")
+P_PEC_TOP_L = BonePath("t_master.L", "scale")
+P_PEC_BOTTOM_L = BonePath("b_master.L", "scale")
+P_PEC_TOP_R = BonePath("t_master.R", "scale")
+P_PEC_BOTTOM_R = BonePath("b_master.R", "scale")
+
+#Fin channels that are sinusoids of sState/sPecState
+FIN_PATHS = (P_SIDE_FIN_L, P_SIDE_FIN_R, P_BACK_FIN1, P_BACK_FIN2, P_PEC_TOP_L, P_PEC_BOTTOM_L, P_PEC_TOP_R, P_PEC_BOTTOM_R)
+
+
+#Quaternion and euler helpers - same conventions as mathutils (w, x, y, z), 'XYZ' eulers
+
+def QuatX(angle):
+    return (math.cos(angle * 0.5), math.sin(angle * 0.5), 0.0, 0.0)
+
+def QuatY(angle):
+    return (math.cos(angle * 0.5), 0.0, math.sin(angle * 0.5), 0.0)
+
+def QuatZ(angle):
+    return (math.cos(angle * 0.5), 0.0, 0.0, math.sin(angle * 0.5))
+
+def QuatMul(a, b):
+    return (a[0]*b[0] - a[1]*b[1] - a[2]*b[2] - a[3]*b[3],
+            a[0]*b[1] + a[1]*b[0] + a[2]*b[3] - a[3]*b[2],
+            a[0]*b[2] + a[2]*b[0] + a[3]*b[1] - a[1]*b[3],
+            a[0]*b[3] + a[3]*b[0] + a[1]*b[2] - a[2]*b[1])
+
+def QuatSlerp(a, b, t):
+    cosom = a[0]*b[0] + a[1]*b[1] + a[2]*b[2] + a[3]*b[3]
+    #rotate around the shortest angle
+    if cosom < 0.0:
+        cosom = -cosom
+        a = (-a[0], -a[1], -a[2], -a[3])
+    if (1.0 - cosom) > 0.0001:
+        omega = math.acos(min(cosom, 1.0))
+        sinom = math.sin(omega)
+        sc1 = math.sin((1.0 - t) * omega) / sinom
+        sc2 = math.sin(t * omega) / sinom
+    else:
+        sc1 = 1.0 - t
+        sc2 = t
+    return (sc1*a[0] + sc2*b[0], sc1*a[1] + sc2*b[1], sc1*a[2] + sc2*b[2], sc1*a[3] + sc2*b[3])
+
+def EulerToQuat(eul):
+    ti = eul[0] * 0.5
+    tj = eul[1] * 0.5
+    th = eul[2] * 0.5
+    ci = math.cos(ti)
+    cj = math.cos(tj)
+    ch = math.cos(th)
+    si = math.sin(ti)
+    sj = math.sin(tj)
+    sh = math.sin(th)
+    cc = ci * ch
+    cs = ci * sh
+    sc = si * ch
+    ss = si * sh
+    return (cj*cc + sj*ss, cj*sc - sj*cs, cj*ss + sj*cc, cj*cs - sj*sc)
+
+def EulerToMatrix(eul):
+    """ Rotation matrix of an 'XYZ' euler as three rows.
+    """
+    ci = math.cos(eul[0])
+    cj = math.cos(eul[1])
+    ch = math.cos(eul[2])
+    si = math.sin(eul[0])
+    sj = math.sin(eul[1])
+    sh = math.sin(eul[2])
+    cc = ci * ch
+    cs = ci * sh
+    sc = si * ch
+    ss = si * sh
+    return ((cj*ch, sj*sc - cs, sj*cc + ss),
+            (cj*sh, sj*ss + cc, sj*cs - sc),
+            (-sj, cj*si, cj*ci))
+
+def _QuatToMatrix(q):
+    #Normalised rotation matrix as three rows
+    n = math.sqrt(q[0]*q[0] + q[1]*q[1] + q[2]*q[2] + q[3]*q[3])
+    if n == 0.0:
+        return ((1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, 1.0))
+    q0 = math.sqrt(2.0) * q[0] / n
+    q1 = math.sqrt(2.0) * q[1] / n
+    q2 = math.sqrt(2.0) * q[2] / n
+    q3 = math.sqrt(2.0) * q[3] / n
+    qda = q0 * q1
+    qdb = q0 * q2
+    qdc = q0 * q3
+    qaa = q1 * q1
+    qab = q1 * q2
+    qac = q1 * q3
+    qbb = q2 * q2
+    qbc = q2 * q3
+    qcc = q3 * q3
+    return ((1.0 - qbb - qcc, -qdc + qab, qdb + qac),
+            (qdc + qab, 1.0 - qaa - qcc, -qda + qbc),
+            (-qdb + qac, qda + qbc, 1.0 - qaa - qbb))
+
+def _MatrixToEuler2(m):
+    #Both 'XYZ' euler solutions for a rotation matrix
+    cy = math.hypot(m[0][0], m[1][0])
+    if cy > 16.0 * 1.1920929e-07:
+        eul1 = [math.atan2(m[2][1], m[2][2]), math.atan2(-m[2][0], cy), math.atan2(m[1][0], m[0][0])]
+        eul2 = [math.atan2(-m[2][1], -m[2][2]), math.atan2(-m[2][0], -cy), math.atan2(-m[1][0], -m[0][0])]
+    else:
+        eul1 = [math.atan2(-m[1][2], m[1][1]), math.atan2(-m[2][0], cy), 0.0]
+        eul2 = list(eul1)
+    return eul1, eul2
+
+def _CompatibleEuler(eul, old):
+    pi_x2 = 2.0 * math.pi
+    deul = [0.0, 0.0, 0.0]
+    for i in range(3):
+        deul[i] = eul[i] - old[i]
+        if deul[i] > 5.1:
+            eul[i] -= math.floor((deul[i] / pi_x2) + 0.5) * pi_x2
+            deul[i] = eul[i] - old[i]
+        elif deul[i] < -5.1:
+            eul[i] += math.floor((-deul[i] / pi_x2) + 0.5) * pi_x2
+            deul[i] = eul[i] - old[i]
+    #is one of the axis rotations larger than 180 degrees and the others small?
+    for i, j, k in ((0, 1, 2), (1, 0, 2), (2, 0, 1)):
+        if math.fabs(deul[i]) > 3.2 and math.fabs(deul[j]) < 1.6 and math.fabs(deul[k]) < 1.6:
+            eul[i] += -pi_x2 if deul[i] > 0.0 else pi_x2
+
+def QuatToEuler(q, compat=None):
+    """ Same result as Quaternion.to_euler('XYZ', compat)
+    """
+    eul1, eul2 = _MatrixToEuler2(_QuatToMatrix(q))
+    if compat is None:
+        return tuple(eul1)
+    _CompatibleEuler(eul1, compat)
+    _CompatibleEuler(eul2, compat)
+    d1 = math.fabs(eul1[0] - compat[0]) + math.fabs(eul1[1] - compat[1]) + math.fabs(eul1[2] - compat[2])
+    d2 = math.fabs(eul2[0] - compat[0]) + math.fabs(eul2[1] - compat[1]) + math.fabs(eul2[2] - compat[2])
+    return tuple(eul2) if d1 > d2 else tuple(eul1)
+
+def QuatAngleZ(q):
+    """ Angle of a rotation about the z axis """
+    return 2.0 * math.atan2(q[3], q[0])
+
+def QuatAngleY(q):
+    """ Angle of a rotation about the y axis """
+    return 2.0 * math.atan2(q[2], q[0])
+
+def _AngleSigned2D(a, b, fallback):
+    #Vector.angle_signed() for 2D vectors
+    if (a[0] == 0.0 and a[1] == 0.0) or (b[0] == 0.0 and b[1] == 0.0):
+        return fallback
+    return math.atan2(a[1]*b[0] - a[0]*b[1], a[0]*b[0] + a[1]*b[1])
+
+
+#Tail fin kinematics.
+#spine_master swings the tail as a chain of segments that each turn by the
+#same angle, so the x position of DEF-back_fin.T.001.Bk is a short Fourier
+#series in the spine angle: c0 + sum(a_m sin(m*angle) + b_m cos(m*angle)).
+#Three harmonics covers the three tail segments of the shark/goldfish rigs.
+#Leaning the torso turns the whole tail about the torso's y axis, which
+#scales parts of that series by (1 - cos(lean)) and sin(lean), so there is a
+#set of coefficients for each of 1, 1 - cos(lean) and sin(lean).
+TAIL_FK_HARMONICS = 3
+TAIL_FK_SIZE = 3 * (2 * TAIL_FK_HARMONICS + 1)
+
+def _TailFinTerms(angle):
+    terms = [1.0]
+    for m in range(1, TAIL_FK_HARMONICS + 1):
+        terms += [math.sin(m * angle), math.cos(m * angle)]
+    return terms
+
+def _TailLeanTerms(lean):
+    return (1.0, 1.0 - math.cos(lean), math.sin(lean))
+
+def TailFinX(coeffs, angle, lean=0.0):
+    """ x of the tail fin with spine_master at angle and the torso leaning by lean """
+    n = 2 * TAIL_FK_HARMONICS + 1
+    x = 0.0
+    for k, g in enumerate(_TailLeanTerms(lean)):
+        c = coeffs[k*n:(k + 1)*n]
+        y = c[0]
+        for m in range(1, TAIL_FK_HARMONICS + 1):
+            y += c[2*m - 1] * math.sin(m * angle) + c[2*m] * math.cos(m * angle)
+        x += g * y
+    return x
+
+def FitTailFin(angles, xs, leans=None):
+    """ Least squares fit of the TailFinX coefficients to sampled tail fin positions
+    (without leans the torso is taken as upright, and the lean coefficients are 0)
+    """
+    size = TAIL_FK_SIZE
+    if leans is None:
+        leans = [0.0] * len(angles)
+    rows = []
+    for angle, lean in zip(angles, leans):
+        terms = _TailFinTerms(angle)
+        rows.append([g * t for g in _TailLeanTerms(lean) for t in terms])
+    #normal equations, solved by gaussian elimination with partial pivoting
+    A = [[sum(r[i] * r[j] for r in rows) for j in range(size)] + [sum(r[i] * x for r, x in zip(rows, xs))] for i in range(size)]
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda r: math.fabs(A[r][col]))
+        A[col], A[pivot] = A[pivot], A[col]
+        if math.fabs(A[col][col]) < 1e-12:
+            continue
+        for r in range(size):
+            if r != col:
+                f = A[r][col] / A[col][col]
+                A[r] = [a - f * b for a, b in zip(A[r], A[col])]
+    return tuple(A[i][size] / A[i][i] if math.fabs(A[i][i]) >= 1e-12 else 0.0 for i in range(size))
+
+
+class FishParams:
+    """ Simulation parameters for one bake, copied out of FSimProps """
+    __slots__ = PARAM_NAMES + ("pStartAngle",)
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name, 0.0))
+
+    @classmethod
+    def from_props(cls, pFS, pFSM=None):
+        params = cls(**{name: getattr(pFS, name) for name in PARAM_NAMES})
+        if pFSM is not None:
+            params.pStartAngle = pFSM.fsim_startangle
+        return params
+
+    @classmethod
+    def from_preset(cls, path):
+        """ The parameters of a preset file (presets/*.py), read without running it.
+        Anything the preset leaves out has its FSimProps default, and floats are
+        rounded to single precision as Blender stores them.
+        """
+        values = dict(PARAM_DEFAULTS)
+        with open(path) as f:
+            for line in f:
+                match = re.match(r"\s*pFS\.(\w+)\s*=\s*(.+?)\s*$", line)
+                if match and match.group(1) in values:
+                    values[match.group(1)] = ast.literal_eval(match.group(2))
+        for name, value in values.items():
+            if isinstance(value, float):
+                values[name] = struct.unpack("f", struct.pack("f", value))[0]
+        return cls(**values)
+
+
+class TargetPose:
+    """ World transform of a target proxy for one frame """
+    __slots__ = ("location", "rotation", "dimensions")
+
+    def __init__(self, location, rotation, dimensions):
+        self.location = location        #(x, y, z)
+        self.rotation = rotation        #quaternion (w, x, y, z)
+        self.dimensions = dimensions    #(x, y, z)
+
+
+class FishState:
+    """ Everything that changes from frame to frame for one fish """
+    __slots__ = (
+        "frame", "sGoldfish",
+        "location", "rotation", "scale", "sRootQuat",
+        "sVelocity", "sEffort", "sTailAngleOffset", "sAngularForceV", "sOldRqdEffort",
+        "sState", "sPecState", "sFreq", "sTailAngle",
+        "sHoverMode", "sHoverTurn",
+        "sRestFrame", "sRestartFrame", "sRestAmount",
+        "sTwitchFrame", "sTwitchAngle", "sTwitchTarget",
+        "sBackFinX", "sOldBackFinX", "sSpineAngle", "sTorsoAngle", "sTailFK",
+        "rMaxTailAngle", "rMaxFreq", "sRandom",
+        "sClock", "sStepFrame", "sChannels", "sPrevFrame", "sPrevChannels",
+    )
+
+    def __init__(self, frame, location, rotation, scale=(1.0, 1.0, 1.0), root_quat=(1.0, 0.0, 0.0, 0.0), goldfish=True, seed=None):
+        self.frame = frame
+        self.sGoldfish = goldfish
+        self.location = tuple(location)
+        self.rotation = tuple(rotation)
+        self.scale = tuple(scale)
+        self.sRootQuat = tuple(root_quat)
+        self.sVelocity = (0.0, 0.0, 0.0)
+        self.sEffort = 1.0
+        self.sTailAngleOffset = 0.0
+        self.sAngularForceV = 0.0
+        self.sOldRqdEffort = 0.0
+        self.sState = 0.0
+        self.sPecState = 0.0
+        self.sFreq = 0.0
+        self.sTailAngle = 0.0
+        self.sHoverMode = 1.0 if goldfish else 0.0
+        self.sHoverTurn = 0.0
+        self.sRestFrame = 0.0
+        self.sRestartFrame = 0.0
+        self.sRestAmount = 0.0
+        self.sTwitchFrame = 0.0
+        self.sTwitchAngle = 0.0
+        self.sTwitchTarget = 0.0
+        self.sBackFinX = 0.0
+        self.sOldBackFinX = 0.0
+        #Last spine_master angle and torso lean, and the TailFinX coefficients of this rig.
+        #Without coefficients the caller has to supply sBackFinX every frame.
+        self.sSpineAngle = 0.0
+        self.sTorsoAngle = 0.0
+        self.sTailFK = None
+        self.rMaxTailAngle = 0.0
+        self.rMaxFreq = 0.0
+        #This fish's own random numbers, so its result doesn't depend on any other fish
+        #(seeded from the OS without a seed)
+        self.sRandom = random.Random(seed)
+        #Time in tuned frames, for the twitch and rest timings (the frame, for step())
+        self.sClock = float(frame)
+        #Fixed steps: scene frame and channels of the last two steps, to resample from
+        self.sStepFrame = float(frame)
+        self.sChannels = None
+        self.sPrevFrame = float(frame)
+        self.sPrevChannels = None
+
+    def randomise(self, params):
+        """ Apply the 'Random' factor to this fish's tail angle and stroke period """
+        rFact = params.pRandom
+        self.rMaxTailAngle = params.pMaxTailAngle * (1 + (self.sRandom.random() * 2.0 - 1.0) * rFact)
+        self.rMaxFreq = params.pMaxFreq * (1 + (self.sRandom.random() * 2.0 - 1.0) * rFact)
+
+    def snapshot(self):
+        """ The whole state as a dictionary of plain values """
+        snapshot = {name: getattr(self, name) for name in self.__slots__}
+        snapshot["sRandom"] = self.sRandom.getstate()
+        return snapshot
+
+    @classmethod
+    def restore(cls, snapshot):
+        state = cls.__new__(cls)
+        for name, value in snapshot.items():
+            setattr(state, name, value)
+        state.sRandom = random.Random()
+        state.sRandom.setstate(snapshot["sRandom"])
+        return state
+
+
+#Set Effort and Direction properties to try and reach the target.
+def Target(state, params, target_pose, h=1.0):
+    R = EulerToMatrix(state.rotation)
+    sy = state.scale[1]
+    RigDirn = (-R[0][1] / sy, -R[1][1] / sy, -R[2][1] / sy)
+
+    #distance to target
+    if target_pose is not None:
+        loc = state.location
+        tloc = target_pose.location
+        TargetDirn = (tloc[0] - loc[0], tloc[1] - loc[1], tloc[2] - loc[2])
+    else:
+        TargetDirn = (0.0, -10.0, 0.0)
+    DifDot = TargetDirn[0]*RigDirn[0] + TargetDirn[1]*RigDirn[1] + TargetDirn[2]*RigDirn[2]
+
+    #horizontal angle to target - limit max turning effort at 90 deg
+    AngleToTarget = math.degrees(_AngleSigned2D(RigDirn, TargetDirn, math.pi))
+    DirectionEffort = max(-1.0, min(1.0, AngleToTarget/90.0))
+
+    #vertical angle to target - limit max turning effort at 20 deg
+    RigDirn2DV = (math.hypot(RigDirn[0], RigDirn[1]), RigDirn[2])
+    TargetDirn2DV = (math.hypot(TargetDirn[0], TargetDirn[1]), TargetDirn[2])
+    AngleToTargetV = math.degrees(_AngleSigned2D(RigDirn2DV, TargetDirn2DV, math.pi))
+    DirectionEffortV = max(-1.0, min(1.0, AngleToTargetV/20.0))
+
+    #Hover Mode Detection (Close to target and slow)
+    if not state.sGoldfish:
+        state.sHoverMode = 0.0
+    elif target_pose is not None and math.sqrt(TargetDirn[0]**2 + TargetDirn[1]**2 + TargetDirn[2]**2) < (target_pose.dimensions[1] * params.pHoverDist):
+        state.sHoverMode = min(1.0, state.sHoverMode + params.pSTransTime / REFERENCE_FPS * h)
+    else:
+        state.sHoverMode = max(0.0, state.sHoverMode - params.pHTransTime / REFERENCE_FPS * h)
+
+    #Return normalised required effort, turning factor, and ascending factor
+    return DifDot, DirectionEffort, DirectionEffortV
+
+
+#Handle the object movement for swimming
+def ObjectMovment(state, params, ForwardForce, AngularForce, AngularForceV, channels, h=1.0):
+    v = state.sVelocity
+    pDrag = params.pDrag
+    pMass = params.pMass
+    v = (v[0] - (pDrag * v[0] * math.fabs(v[0])) / pMass * h,
+         v[1] + (-ForwardForce + -pDrag * v[1] * math.fabs(v[1])) / pMass * h,
+         v[2] - (pDrag * v[2] * math.fabs(v[2])) / pMass * h)
+    v = _ClampVelocity(v)
+    state.sVelocity = v
+    _MoveLocal(state, v, None, h)
+    channels["location"] = state.location
+
+    #Let's be simplistic - just rotate object based on angluar force
+    rot = state.rotation
+    state.rotation = (rot[0] + math.radians(AngularForceV) * h, rot[1], rot[2] + math.radians(AngularForce))
+    channels["rotation_euler"] = state.rotation
+    state.sHoverTurn = 0.0
+
+    #Forward/Backward Tilt based on force
+    if state.sHoverMode <= 0.1:
+        state.sRootQuat = (1.0, 0.0, 0.0, 0.0)
+    channels[P_ROOT] = state.sRootQuat
+
+
+#Handle the object movement for hovering
+def ObjectMovmentHover(state, params, target_pose, channels, h=1.0):
+    R = EulerToMatrix(state.rotation)
+    sx, sy, sz = state.scale
+    loc = state.location
+    tloc = target_pose.location
+    d = (tloc[0] - loc[0], tloc[1] - loc[1], tloc[2] - loc[2])
+    k = state.sHoverMode * params.pPecEffortGain
+    RigForce = [k * sx * (R[0][0]*d[0] + R[1][0]*d[1] + R[2][0]*d[2]),
+                k * sy * (R[0][1]*d[0] + R[1][1]*d[1] + R[2][1]*d[2]),
+                k * sz * (R[0][2]*d[0] + R[1][2]*d[1] + R[2][2]*d[2])]
+
+    #Limit the force available
+    xHoverMaxForce = params.pHoverMaxForce * (1-state.sRestAmount*0.6)
+    xDerated = xHoverMaxForce * params.pHoverDerate
+    RigForce[1] = min(max(RigForce[1], -xHoverMaxForce), xDerated)
+    RigForce[2] = min(max(RigForce[2], -xDerated), xDerated)
+    RigForce[0] = min(max(RigForce[0], -xDerated), xDerated)
+
+    #Calculate velocity
+    v = state.sVelocity
+    pDrag = params.pDrag
+    pMass = params.pMass
+    v = (v[0] + (RigForce[0] - pDrag * v[0] * math.fabs(v[0])) / pMass * h,
+         v[1] + (RigForce[1] - pDrag * v[1] * math.fabs(v[1])) / pMass * h,
+         v[2] + (RigForce[2] - pDrag * v[2] * math.fabs(v[2])) / pMass * h)
+    v = _ClampVelocity(v)
+    state.sVelocity = v
+    _MoveLocal(state, v, R, h)
+    channels["location"] = state.location
+
+    #Rotate model direction to match target
+    xTargetQuat = QuatMul(target_pose.rotation, QuatZ(math.radians(params.pStartAngle)))
+    xRigQuat = EulerToQuat(state.rotation)
+    xRigQuat = QuatSlerp(xRigQuat, xTargetQuat, _Ramp(params.pPecTurnAssist/100.0, h))
+    state.rotation = QuatToEuler(xRigQuat, state.rotation)
+    channels["rotation_euler"] = state.rotation
+
+    #Forward/Backward Tilt based on force
+    if RigForce[1] < 0:
+        rf = RigForce[1] * params.pHoverDerate
+    else:
+        rf = RigForce[1]
+    TiltAngle = math.radians(params.pHoverTilt * rf / (params.pHoverMaxForce * params.pHoverDerate))
+    state.sRootQuat = QuatSlerp(state.sRootQuat, QuatX(TiltAngle), _Ramp(0.03, h))
+    channels[P_ROOT] = state.sRootQuat
+
+    #Get left or right turn
+    q = target_pose.rotation
+    state.sHoverTurn = math.degrees(QuatToEuler((q[0], -q[1], -q[2], -q[3]))[2])
+
+
+def _ClampVelocity(v):
+    return tuple(min(max(x, -MAX_VELOCITY), MAX_VELOCITY) for x in v)
+
+
+def _MoveLocal(state, v, R=None, h=1.0):
+    #location += velocity @ matrix_world.inverted()
+    if R is None:
+        R = EulerToMatrix(state.rotation)
+    sx, sy, sz = state.scale
+    lx = v[0] / sx * h
+    ly = v[1] / sy * h
+    lz = v[2] / sz * h
+    loc = state.location
+    state.location = (loc[0] + R[0][0]*lx + R[0][1]*ly + R[0][2]*lz,
+                      loc[1] + R[1][0]*lx + R[1][1]*ly + R[1][2]*lz,
+                      loc[2] + R[2][0]*lx + R[2][1]*ly + R[2][2]*lz)
+
+
+def PecSimulation(state, params, channels, h=1.0):
+    nFrame = state.sClock
+
+    #Update State and main angle
+    state.sPecState = state.sPecState + 360.0 / params.pMaxPecFreq * h
+    xPecAngle = math.sin(math.radians(state.sPecState))*math.radians(params.pMaxPecAngle)
+    yPecAngle = math.sin(math.radians(state.sPecState+90.0))*math.radians(params.pMaxPecAngle * 2)
+
+    #Rest Period Calculations
+    if nFrame >= state.sRestartFrame:
+        state.sRestAmount = max(0.0, state.sRestAmount - params.pPecTransition * h)
+        if state.sRestAmount < 0.1:
+            state.sRestFrame = nFrame + params.pPecDuration
+            state.sRestartFrame = state.sRestFrame + params.pPecDuty * params.pPecDuration
+
+    if (nFrame >= state.sRestFrame and nFrame < state.sRestartFrame and state.sRestAmount < 1.0):
+        state.sRestAmount = min(1.0, state.sRestAmount + params.pPecTransition * h)
+
+    #Add the same side fin wobble to the pec fins to stop them looking boring when not flapping
+    SideFin = QuatX(math.radians(math.sin(math.radians(state.sState + params.pSideFinPhase)) * params.pMaxSideFinAngle))
+
+    #Slerp between oscillating angle and rest angle depending on hover status and reset periods
+    # xRestAmount = 1 means no flapping due to either resting or not hovering
+    xRestAmount = (1.0 - (1.0 - state.sRestAmount) * state.sHoverMode)
+    RestQuat = QuatX(math.radians(params.pPecOffset))
+    yAng = QuatY(yPecAngle)
+    xAng = QuatSlerp(QuatMul(yAng, QuatX(-xPecAngle)), RestQuat, xRestAmount)
+    channels[P_PEC_PALM_L] = QuatMul(xAng, SideFin)
+
+    #Tip deflection based on phase offset
+    xMaxPecScale = params.pMaxPecAngle * ( 1.0 / params.pPecStiffness) * 0.2 / 30.0
+    sPec_scale = 1.0 + math.sin(math.radians(state.sPecState - params.pPecPhase)) * xMaxPecScale * (1.0 - xRestAmount)
+    channels[P_PEC_TOP_L] = (1.0, sPec_scale, 1.0)
+    channels[P_PEC_BOTTOM_L] = (1.0, 1 - (1 - sPec_scale) * params.pPecStubRatio, 1.0)
+
+    #copy to the right fin
+    #If fins are opposing
+    if not params.pPecSynch:
+        xAng = QuatSlerp(QuatMul(yAng, QuatX(xPecAngle)), RestQuat, xRestAmount)
+        channels[P_PEC_PALM_R] = QuatMul(xAng, SideFin)
+        channels[P_PEC_TOP_R] = (1.0, 1/sPec_scale, 1.0)
+        channels[P_PEC_BOTTOM_R] = (1.0, 1 - (1 - 1/sPec_scale) * params.pPecStubRatio, 1.0)
+    else:
+        xAng = QuatSlerp(QuatMul(QuatY(-yPecAngle), QuatX(-xPecAngle)), RestQuat, xRestAmount)
+        channels[P_PEC_PALM_R] = QuatMul(xAng, SideFin)
+        channels[P_PEC_TOP_R] = (1.0, sPec_scale, 1.0)
+        channels[P_PEC_BOTTOM_R] = (1.0, 1 - (1 - sPec_scale) * params.pPecStubRatio, 1.0)
+
+
+def StartChannels(state, params, channels=None):
+    """ The pose a fish starts from, as step() channels: its location,
+    rotation, root tilt and spine angle, with every other bone at rest,
+    and any channels given (the rig's own pose) in place of those.
+    """
+    xOffset = math.radians(state.sTailAngleOffset)
+    xTailAngle = state.sSpineAngle
+    start = {}
+    for path in ChannelPaths(state.sGoldfish):
+        start[path] = (1.0, 0.0, 0.0, 0.0) if path.endswith("rotation_quaternion") else (1.0, 1.0, 1.0)
+    start["location"] = state.location
+    start["rotation_euler"] = state.rotation
+    start[P_ROOT] = state.sRootQuat
+    start[P_SPINE] = QuatZ(xTailAngle)
+    start[P_CHEST] = QuatMul(QuatZ(-xTailAngle * params.pChestRatio), QuatX(-math.fabs(xOffset)*params.pChestRaise * (1.0 - state.sHoverMode)))
+    start[P_TORSO] = QuatY(-xOffset*params.pLeanIntoTurn * (1.0 - state.sHoverMode))
+    if channels is not None:
+        start.update((path, tuple(value)) for path, value in channels.items() if path in start)
+    return start
+
+
+def prime(state, params, target_pose, channels=None):
+    """ Start frame: remember the effort and tail position to work from.
+    channels is the rig's pose on the start frame (see StartChannels), which
+    step_fixed() blends from until the first step.
+    """
+    RqdEffort, RqdDirection, RqdDirectionV = Target(state, params, target_pose)
+    state.sOldRqdEffort = RqdEffort
+    if state.sTailFK is not None:
+        state.sBackFinX = TailFinX(state.sTailFK, state.sSpineAngle, state.sTorsoAngle)
+    state.sOldBackFinX = state.sBackFinX
+    state.sClock = float(state.frame)
+    state.sStepFrame = float(state.frame)
+    state.sChannels = StartChannels(state, params, channels)
+    state.sPrevChannels = None
+
+
+def step(state, params, target_pose):
+    """ Advance one fish by one frame.
+
+    Without a tail fin model (state.sTailFK) state.sBackFinX must hold the
+    current x position of DEF-back_fin.T.001.Bk.
+    Returns a dict of F-curve data path -> new value for state.frame.
+    """
+    state.frame += 1
+    state.sClock = float(state.frame)
+    return _Advance(state, params, target_pose, 1.0)
+
+
+def step_fixed(state, params, target_at, fixed):
+    """ Advance one fish to the next scene frame in steps of a FixedStep.
+    target_at(frame) gives the TargetPose at a (fractional) scene frame.
+    Returns the channels for state.frame, interpolated between the steps either side.
+    """
+    state.frame += 1
+    nFrame = state.frame
+    while state.sStepFrame < nFrame - 1e-9:
+        t = state.sStepFrame + fixed.frames
+        state.sClock += fixed.h
+        channels = _Advance(state, params, target_at(t), fixed.h)
+        state.sPrevFrame, state.sPrevChannels = state.sStepFrame, state.sChannels
+        state.sStepFrame, state.sChannels = t, channels
+    w = (nFrame - state.sPrevFrame) / (state.sStepFrame - state.sPrevFrame)
+    return BlendChannels(state.sPrevChannels, state.sChannels, w)
+
+
+def _Advance(state, params, target_pose, h):
+    #One step of h tuned frames, state.sClock is the time at the end of it
+    nFrame = state.sClock
+    channels = {}
+    pEffortRamp = params.pEffortRamp
+    xRamp = _Ramp(pEffortRamp, h)
+    xDecay = _Decay(pEffortRamp, h)
+
+    #Get the effort and direction change to head toward the target
+    RqdEffort, RqdDirection, RqdDirectionV = Target(state, params, target_pose, h)
+    state.sOldRqdEffort = RqdEffort
+    state.sEffort = min(max(params.pEffortGain * RqdEffort * xRamp + state.sEffort * xDecay, 0.0), MAX_EFFORT)
+    sHoverMode = state.sHoverMode
+
+    #Pec fin simulation
+    if state.sGoldfish:
+        PecSimulation(state, params, channels, h)
+
+    #Convert effort into tail frequency and amplitude (Fades to a low value if in hover mode)
+    state.sFreq = state.rMaxFreq * ((1-sHoverMode) * (1.0/(state.sEffort+ 0.01)) + sHoverMode * 2.0)
+    state.sTailAngle = state.rMaxTailAngle * ((1-sHoverMode) * state.sEffort + sHoverMode * params.pHoverTailFrc)
+
+    #Convert direction into Tail Offset angle (Hover turning is currently disabled)
+    xSwimTailAngleOffset = RqdDirection * params.pMaxSteeringAngle
+    state.sTailAngleOffset = state.sTailAngleOffset * xDecay + xRamp * max(0,(1.0 - sHoverMode*2.0)) * xSwimTailAngleOffset
+
+    #Hover 'Twitch' calculations (Make the fish do some random twisting during hover mode)
+    if sHoverMode < 0.5:
+        #Not hovering so reset
+        state.sTwitchTarget = 0.0
+        state.sTwitchFrame = 0.0
+    else:
+        #Hovering, so check if the twitch frame has been reached
+        if nFrame >= state.sTwitchFrame:
+            #set new twitch frame
+            state.sTwitchFrame = nFrame + params.pHoverTwitchTime * (state.sRandom.random() - 0.5)
+            #Only twitch while not resting
+            if state.sTwitchFrame < state.sRestartFrame and state.sTwitchFrame > state.sRestFrame:
+                state.sTwitchFrame = state.sRestartFrame + 5
+            #set a new twitch target angle
+            state.sTwitchTarget = params.pHoverTwitch * 2.0 * (state.sRandom.random() - 0.5)
+    state.sTwitchAngle = state.sTwitchAngle * _Decay(0.1, h) + _Ramp(0.1, h) * state.sTwitchTarget
+
+    #Spine Movement
+    state.sState = state.sState + 360.0 / state.sFreq * h
+    sState = state.sState
+    xOffset = math.radians(state.sTailAngleOffset)
+    xTailAngle = math.sin(math.radians(sState))*math.radians(state.sTailAngle) + xOffset + math.radians(state.sTwitchAngle)
+    channels[P_SPINE] = QuatZ(xTailAngle)
+    channels[P_CHEST] = QuatMul(QuatZ(-xTailAngle * params.pChestRatio), QuatX(-math.fabs(xOffset)*params.pChestRaise * (1.0 - sHoverMode)))
+    xLean = -xOffset*params.pLeanIntoTurn * (1.0 - sHoverMode)
+    channels[P_TORSO] = QuatY(xLean)
+
+    #Tail Movment (the fin position lags the spine by a frame, as it did when read from the evaluated pose)
+    if state.sTailFK is not None:
+        state.sBackFinX = TailFinX(state.sTailFK, state.sSpineAngle, state.sTorsoAngle)
+    state.sSpineAngle = xTailAngle
+    state.sTorsoAngle = xLean
+    back_fin_dif = state.sBackFinX - state.sOldBackFinX
+    state.sOldBackFinX = state.sBackFinX
+
+    #Tailfin bending based on phase offset
+    pMaxTailScale = params.pMaxTailFinAngle * ( 1.0 / params.pTailFinStiffness) * 0.2 / 30.0
+    sBack_fin1_scale = 1.0 + math.sin(math.radians(sState + params.pTailFinPhase)) * pMaxTailScale * (state.sTailAngle / state.rMaxTailAngle)
+    channels[P_BACK_FIN1] = (1.0, sBack_fin1_scale, 1.0)
+    channels[P_BACK_FIN2] = (1.0, 1 - (1 - sBack_fin1_scale) * params.pTailFinStubRatio, 1.0)
+
+    SideFinRot = math.radians(math.sin(math.radians(sState + params.pSideFinPhase)) * params.pMaxSideFinAngle)
+    channels[P_SIDE_FIN_L] = QuatX(-SideFinRot)
+    channels[P_SIDE_FIN_R] = QuatX(SideFinRot)
+
+    #Do Object movment with Forward force and Angular force
+    ForwardForce = math.fabs(math.cos(math.radians(sState))) * math.radians(state.sTailAngle) * 15.0 * params.pPower / params.pMaxFreq
+
+    #Angular force due to 'swish'
+    AngularForce = back_fin_dif / params.pAngularDrag
+
+    #(the swish is a change over the step, the rest are rates)
+    #Angular force due to rudder effect
+    AngularForce += xTailAngle * state.sVelocity[1] / params.pAngularDrag * h
+
+    #Fake Angular force to make turning more effective
+    AngularForce += -(state.sTailAngleOffset/params.pMaxSteeringAngle) * params.pTurnAssist * h
+
+    #Angular force for vertical movement
+    state.sAngularForceV = state.sAngularForceV * xDecay + RqdDirectionV * params.pMaxVerticalAngle * _Gain(pEffortRamp, h)
+
+    if sHoverMode < 0.1 or target_pose is None:
+        ObjectMovment(state, params, ForwardForce, AngularForce, state.sAngularForceV, channels, h)
+    else:
+        ObjectMovmentHover(state, params, target_pose, channels, h)
+
+    return channels
@@ -0,0 +1,198 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FSimCycles.py  -- looped swim cycles for steady swimming
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V0.3.0 - Goldfish Version - Blender 2.8
+
+# While a fish cruises at a steady effort its body and fin channels repeat
+# every tail stroke. FindCycles() looks for runs of identical strokes, and
+# WriteCycles() stores one stroke per run as its own action, looped by an NLA
+# strip (with Cycles modifiers so the loop joins smoothly). The frames in
+# between (turns, hovering) go into densely keyed strips on the same track.
+# A Cycles modifier alone can't do this, as it only repeats the whole of an
+# F-curve, not a stretch in the middle of it.
+# Object transforms and the root bone keep moving, so they stay keyed in the
+# rig's action as usual.
+
+import math
+import bpy
+import numpy as np
+
+if __package__:
+    from . import FSimCore, FSimKeys
+else:
+    import FSimCore, FSimKeys
+
+
+#Channels that repeat with the tail stroke
+CYCLE_PATHS = tuple(FSimCore.BonePath(b, p) for b, p in FSimCore.SWIM_BONES + FSimCore.PEC_BONES if b != "root")
+#NLA track holding the strips
+TRACK_NAME = "FSim Cycles"
+#Fewest strokes in a row worth looping
+MIN_CYCLES = 3
+#Pointers of strip actions FSimRollback can still put back, which RemoveCycles() leaves alone
+KeptActions = set()
+
+
+def _Sample(X, frames, t):
+    #X linearly interpolated at (fractional) frames t
+    i = np.clip(np.searchsorted(frames, t, side='right') - 1, 0, len(frames) - 2)
+    w = ((t - frames[i]) / (frames[i+1] - frames[i]))[:, None]
+    return X[i] * (1.0 - w) + X[i+1] * w
+
+
+def _Repeats(X, frames, tol, s0, T, n):
+    #True if every frame from s0 for n strokes of length T matches the first stroke
+    first = np.searchsorted(frames, s0)
+    last = np.searchsorted(frames, s0 + n * T, side='right')
+    if last <= first:
+        return False
+    t = frames[first:last]
+    phase = s0 + np.mod(t - s0, T)
+    return bool(np.all(np.abs(X[first:last] - _Sample(X, frames, phase)) <= tol))
+
+
+def FindCycles(frames, X, tol, stroke):
+    """ Runs of repeating tail strokes.
+    X holds the cycled channels (frames, columns) with per column
+    tolerances tol, and stroke is the spine_master column that marks strokes.
+    Returns a list of (first frame, stroke length, strokes) with integer
+    first frames.
+    """
+    frames = np.asarray(frames, dtype=float)
+    z = stroke
+    #stroke boundaries at the spine peaks, to a fraction of a frame
+    i = np.flatnonzero((z[1:-1] > z[:-2]) & (z[1:-1] >= z[2:])) + 1
+    denom = z[i-1] - 2.0 * z[i] + z[i+1]
+    peaks = frames[i] + np.where(denom != 0.0, 0.5 * (z[i-1] - z[i+1]) / np.where(denom != 0.0, denom, 1.0), 0.0)
+    runs = []
+    k = 0
+    while k + MIN_CYCLES < len(peaks):
+        length = peaks[k+1] - peaks[k]
+        j = k + 1
+        while j + 1 < len(peaks) and abs((peaks[j+1] - peaks[j]) - length) < 0.05 * length:
+            j += 1
+        #shrink until the whole run repeats exactly
+        s0 = math.ceil(peaks[k])
+        n = j - k
+        while n >= MIN_CYCLES:
+            T = (peaks[k+n] - peaks[k]) / n
+            if s0 + n * T <= frames[-1] and _Repeats(X, frames, tol, s0, T, n):
+                break
+            n -= 1
+        if n >= MIN_CYCLES:
+            runs.append((s0, T, n))
+            k += n
+        else:
+            k += 1
+    return runs
+
+
+def RemoveCycles(obj):
+    """ Remove the strips (and their actions) of an earlier cycle bake """
+    anim = obj.animation_data
+    if anim is None:
+        return
+    track = anim.nla_tracks.get(TRACK_NAME)
+    if track is None:
+        return
+    actions = [strip.action for strip in track.strips if strip.action is not None]
+    anim.nla_tracks.remove(track)
+    for action in actions:
+        if action.users == 0 and action.as_pointer() not in KeptActions:
+            bpy.data.actions.remove(action)
+
+
+def _StripAction(name, paths, frames, X, columns, cyclic):
+    action = bpy.data.actions.new(name)
+    for path, c0, c1 in columns:
+        for index in range(c1 - c0):
+            fc = FSimKeys.WriteFCurve(action.fcurves, path, index, frames, X[:, c0 + index])
+            if cyclic:
+                fc.modifiers.new('CYCLES')
+    return action
+
+
+def WriteCycles(obj, recorder, tolerances, decimate=None):
+    """ Write a rig's recording with looped strokes where it repeats.
+    tolerances are FSimKeys.Tolerances() for matching strokes, and decimate
+    the (optional) ones for the channels keyed in the rig's action.
+    Returns the number of keyframes written, or None if there are no
+    repeating runs (nothing is written then).
+    """
+    paths = [path for path in CYCLE_PATHS if path in recorder.samples]
+    if FSimCore.P_SPINE not in paths or len(recorder) < 4:
+        return None
+    frames = np.asarray(recorder.frames, dtype=float)
+    columns = []
+    blocks = []
+    col = 0
+    tol = []
+    for path in paths:
+        values = np.asarray(recorder.samples[path], dtype=float).reshape(len(frames), -1)
+        columns.append((path, col, col + values.shape[1]))
+        blocks.append(values)
+        tol += [FSimKeys.ChannelTolerance(path, tolerances)] * values.shape[1]
+        col += values.shape[1]
+    X = np.concatenate(blocks, axis=1)
+    spine = columns[paths.index(FSimCore.P_SPINE)][1] + 3
+    runs = FindCycles(frames, X, np.asarray(tol), X[:, spine])
+    if not runs:
+        return None
+
+    #everything else is keyed in the rig's action as usual
+    rest = FSimKeys.ChannelRecorder.from_arrays(recorder.frames, {path: values for path, values in recorder.samples.items() if path not in paths})
+    count = FSimKeys.WriteFCurves(obj, rest, decimate)
+    action = obj.animation_data.action
+    for path in paths:
+        for fc in [fc for fc in action.fcurves if fc.data_path == path]:
+            action.fcurves.remove(fc)
+
+    RemoveCycles(obj)
+    track = obj.animation_data.nla_tracks.new()
+    track.name = TRACK_NAME
+    nFrom = frames[0]
+    for number, (s0, T, n) in enumerate(runs + [(None, None, None)]):
+        #densely keyed frames up to the next run
+        if s0 is None:
+            dense = frames >= nFrom
+        else:
+            dense = (frames >= nFrom) & (frames < s0)
+        if np.any(dense):
+            a = _StripAction("{}FSimTransition.{:03d}".format(obj.name, number), paths, frames[dense], X[dense], columns, False)
+            strip = track.strips.new(a.name, int(frames[dense][0]), a)
+            strip.extrapolation = 'HOLD' if len(track.strips) == 1 else 'HOLD_FORWARD'
+            count += int(np.count_nonzero(dense)) * X.shape[1]
+        if s0 is None:
+            break
+        #one stroke, from s0 to s0 + T, looped n times
+        i0 = int(np.searchsorted(frames, s0))
+        i1 = int(np.searchsorted(frames, s0 + T))
+        t = np.append(frames[i0:i1] - s0, T)
+        Y = np.concatenate((X[i0:i1], X[i0:i0+1]))
+        a = _StripAction("{}FSimCycle.{:03d}".format(obj.name, number), paths, t, Y, columns, True)
+        strip = track.strips.new(a.name, int(s0), a)
+        strip.extrapolation = 'HOLD' if len(track.strips) == 1 else 'HOLD_FORWARD'
+        strip.action_frame_start = 0.0
+        strip.action_frame_end = T
+        strip.repeat = n
+        count += len(t) * X.shape[1]
+        nFrom = math.floor(s0 + n * T) + 1
+    return count
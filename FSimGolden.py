@@ -0,0 +1,235 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FSimGolden.py  -- checking that faster engines still swim the same
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V0.3.0 - Goldfish Version - Blender 2.8
+
+# Golden trajectories: the channels FSimCore.step() produces for a small
+# school on the benchmark's scripted target paths, with fixed seeds, for each
+# shipped preset. They are stored in golden/<preset>.npz (single precision,
+# compressed), and every engine is checked against them within a tolerance
+# per kind of channel:
+#   python FSimGolden.py             check every engine against the files
+#   python FSimGolden.py --update    simulate the files again (only after a
+#                                    change that is meant to alter the motion)
+#   step      FSimCore.step(), the reference itself
+#   batch     FSimBatch.step_batch()
+#   fixed     FSimCore.step_fixed() with steps of exactly one frame
+#   parallel  FSimParallel worker processes
+#   analytic  targets as keyframed objects read back by FSimAnalytic (inside
+#             Blender only: blender --background --python FSimGolden.py -- --engines analytic)
+# The exit status is 1 if any channel of any engine is out of tolerance.
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+if __package__:
+    from . import FSimCore, FSimBatch, FSimParallel, FSimTrajectory, FSimBenchmark
+else:
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import FSimCore, FSimBatch, FSimParallel, FSimTrajectory, FSimBenchmark
+
+
+ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
+GOLDEN_DIR = os.path.join(ADDON_DIR, "golden")
+PRESETS = ("goldfish", "GreatWhite")
+ENGINES = ("step", "batch", "fixed", "parallel", "analytic")
+#The school simulated for each preset
+FISH = 4
+START = 1
+END = 200
+SEED = 0
+
+#Largest difference allowed from the golden values, per component of each kind of channel
+TOLERANCES = {
+    "rotation_quaternion": 1e-4,
+    "rotation_euler": 1e-4,
+    "scale": 1e-4,
+    "location": 1e-3,
+}
+
+
+def Tolerance(path, factor=1.0):
+    return TOLERANCES[path.rsplit(".", 1)[-1]] * factor
+
+
+def Setup(preset):
+    """ (params, trajectory, states) of the golden school for a preset """
+    params = FSimCore.FishParams.from_preset(os.path.join(ADDON_DIR, "presets", preset + ".py"))
+    trajectory = FSimBenchmark.Trajectory(FISH, START, END)
+    return params, trajectory, FSimBenchmark.School(FISH, params, trajectory, SEED)
+
+
+def _Stack(frames):
+    #list of per-frame {path: (fish, k)} -> {path: (frames, fish, k)}
+    return {path: np.array([channels[path] for channels in frames]) for path in frames[0]}
+
+
+def RunStep(params, trajectory, states):
+    frames = []
+    for i, state in enumerate(states):
+        FSimCore.prime(state, params, trajectory.pose(START, i))
+    for nFrame in range(START + 1, END + 1):
+        channels = [FSimCore.step(state, params, trajectory.pose(nFrame, i)) for i, state in enumerate(states)]
+        frames.append({path: [c[path] for c in channels] for path in channels[0]})
+    return _Stack(frames)
+
+
+def RunFixed(params, trajectory, states):
+    #One step per frame at the reference rate, which should make no difference
+    fixed = FSimCore.FixedStep(FSimCore.REFERENCE_FPS, 1.0 / FSimCore.REFERENCE_FPS)
+    frames = []
+    for i, state in enumerate(states):
+        FSimCore.prime(state, params, trajectory.pose(START, i))
+    for nFrame in range(START + 1, END + 1):
+        channels = [FSimCore.step_fixed(state, params, lambda t, i=i: trajectory.pose(t, i), fixed) for i, state in enumerate(states)]
+        frames.append({path: [c[path] for c in channels] for path in channels[0]})
+    return _Stack(frames)
+
+
+def RunBatch(params, trajectory, states):
+    batch = FSimBatch.BatchState.from_states(states)
+    FSimBatch.prime(batch, params, trajectory.targets(START))
+    return _Stack([FSimBatch.step_batch(batch, params, trajectory.targets(nFrame)) for nFrame in range(START + 1, END + 1)])
+
+
+def RunParallel(params, trajectory, states):
+    #Two workers, so the school is split into chunks as it would be in a bake
+    with ProcessPoolExecutor(2) as executor:
+        jobs = FSimParallel.SubmitBake(executor, states, params, trajectory, range(len(states)), START, END, workers=2)
+        results = [(chunk, future.result()[0]) for chunk, future in jobs]
+    out = {}
+    for chunk, channels in results:
+        for path, values in channels.items():
+            if path not in out:
+                out[path] = np.empty((values.shape[0], len(states), values.shape[2]))
+            out[path][:, chunk] = values
+    return out
+
+
+def RunAnalytic(params, trajectory, states):
+    """ The reference simulation with the targets keyed onto objects and read back by FSimTrajectory """
+    import bpy
+    import FSimIsolate
+    context = bpy.context
+    mesh = bpy.data.meshes.new("FSimGolden")
+    half = 0.5
+    mesh.from_pydata([(x, y, z) for x in (-half, half) for y in (-half, half) for z in (-half, half)], [], [])
+    proxies = []
+    try:
+        for i in range(FISH):
+            proxy = bpy.data.objects.new("FSimGolden.{:03d}".format(i), mesh)
+            context.collection.objects.link(proxy)
+            proxy.rotation_mode = 'QUATERNION'
+            proxies.append(proxy)
+            for nFrame in range(START, END + 1):
+                sample = trajectory.data[nFrame - START, i]
+                proxy.location = sample[FSimTrajectory.LOC]
+                proxy.rotation_quaternion = sample[FSimTrajectory.ROT]
+                proxy.keyframe_insert(data_path="location", frame=nFrame)
+                proxy.keyframe_insert(data_path="rotation_quaternion", frame=nFrame)
+        evaluation = FSimIsolate.Evaluation(context.scene, context.view_layer)
+        sampled = FSimTrajectory.SampleProxies(evaluation, proxies, START, END, analytic=True)
+    finally:
+        for proxy in proxies:
+            bpy.data.objects.remove(proxy)
+        bpy.data.meshes.remove(mesh)
+    return RunStep(params, sampled, states)
+
+
+RUNS = {"step": RunStep, "batch": RunBatch, "fixed": RunFixed, "parallel": RunParallel, "analytic": RunAnalytic}
+
+
+def GoldenPath(preset):
+    return os.path.join(GOLDEN_DIR, preset + ".npz")
+
+
+def Save(preset, channels):
+    os.makedirs(GOLDEN_DIR, exist_ok=True)
+    meta = {"fish": FISH, "start": START, "end": END, "seed": SEED}
+    np.savez_compressed(GoldenPath(preset), __meta__=np.array(json.dumps(meta)),
+                        **{path: values.astype(np.float32) for path, values in channels.items()})
+
+
+def Load(preset):
+    """ {data path: (frames, fish, k) array} of a preset's golden file """
+    with np.load(GoldenPath(preset)) as data:
+        meta = json.loads(str(data["__meta__"]))
+        if meta != {"fish": FISH, "start": START, "end": END, "seed": SEED}:
+            raise ValueError("{} is for a different school ({}), run with --update".format(GoldenPath(preset), meta))
+        return {path: data[path].astype(float) for path in data.files if path != "__meta__"}
+
+
+def Compare(golden, channels, factor=1.0):
+    """ [(data path, largest error, tolerance, first frame out of tolerance)] of the channels
+    that differ from the golden ones by more than their tolerance (or are missing)
+    """
+    failures = []
+    for path, expected in golden.items():
+        values = channels.get(path)
+        if values is None or values.shape != expected.shape:
+            failures.append((path, float("inf"), Tolerance(path, factor), None))
+            continue
+        error = np.abs(values - expected)
+        tolerance = Tolerance(path, factor)
+        if not error.max() <= tolerance:
+            first = int(np.argmax(error.reshape(len(error), -1).max(axis=1) > tolerance))
+            failures.append((path, float(error.max()), tolerance, START + 1 + first))
+    return failures
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else sys.argv[1:]
+    parser = argparse.ArgumentParser(description="Check the FishSim engines against the golden trajectories")
+    parser.add_argument("--presets", nargs="+", choices=PRESETS, default=PRESETS)
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=None, help="engines to check (all but analytic without Blender)")
+    parser.add_argument("--update", action="store_true", help="write the golden files from the reference simulation")
+    parser.add_argument("--factor", type=float, default=1.0, help="scale every tolerance by this")
+    args = parser.parse_args(argv)
+
+    if args.update:
+        for preset in args.presets:
+            Save(preset, RunStep(*Setup(preset)))
+            print("Saved", GoldenPath(preset))
+        return 0
+
+    engines = args.engines
+    if engines is None:
+        engines = [engine for engine in ENGINES if engine != "analytic" or "bpy" in sys.modules]
+    failed = False
+    for preset in args.presets:
+        golden = Load(preset)
+        for engine in engines:
+            failures = Compare(golden, RUNS[engine](*Setup(preset)), args.factor)
+            print("{:>10} {:>9}: {}".format(preset, engine, "FAILED" if failures else "ok"))
+            for path, error, tolerance, nFrame in failures:
+                print("    {} differs by {:.3g} (tolerance {:.3g}) from frame {}".format(path, error, tolerance, nFrame))
+            failed = failed or bool(failures)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FSimIsolate.py  -- evaluating only what the simulation needs
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V0.3.0 - Goldfish Version - Blender 2.8
+
+# Sampling the target proxies and posing the rigs on the start frame step the
+# scene, which evaluates every mesh, particle system and rig in it. An Evaluation
+# can instead be a temporary scene that links only the rigs, their proxies
+# and the objects those depend on (parents, constraint and driver targets),
+# so the cost no longer depends on the rest of the production scene.
+# Blender only copies evaluated values back to the objects for the scene
+# being shown, so results are read from the temporary scene's depsgraph.
+
+import bpy
+
+
+#Name of the temporary scene
+SCENE_NAME = "FSim Evaluation"
+
+
+def _Targets(constraints):
+    for con in constraints:
+        yield getattr(con, "target", None)
+        for target in getattr(con, "targets", ()):
+            yield target.target
+
+
+def Dependencies(objects):
+    """ The objects plus everything their transforms depend on """
+    found = {}
+    stack = list(objects)
+    while stack:
+        obj = stack.pop()
+        if not isinstance(obj, bpy.types.Object) or obj.name in found:
+            continue
+        found[obj.name] = obj
+        stack.append(obj.parent)
+        stack.extend(_Targets(obj.constraints))
+        if obj.pose is not None:
+            for bone in obj.pose.bones:
+                stack.extend(_Targets(bone.constraints))
+        for anim in (obj.animation_data, getattr(obj.data, "animation_data", None)):
+            if anim is None:
+                continue
+            for driver in anim.drivers:
+                for var in driver.driver.variables:
+                    stack.extend(target.id for target in var.targets)
+    return list(found.values())
+
+
+class Evaluation:
+    """ The scene the simulation steps to read proxies and bones: either the
+    current scene, or a temporary one made by Isolated()
+    """
+
+    def __init__(self, scene, view_layer):
+        self.scene = scene
+        self.view_layer = view_layer
+        self.temporary = False
+
+    @classmethod
+    def Isolated(cls, scene, objects):
+        """ A temporary scene with the objects (and their dependencies) linked
+        in, on the same frame and frame rate as scene.
+        """
+        temp = bpy.data.scenes.new(SCENE_NAME)
+        temp.render.fps = scene.render.fps
+        temp.render.fps_base = scene.render.fps_base
+        temp.frame_start = scene.frame_start
+        temp.frame_end = scene.frame_end
+        temp.frame_current = scene.frame_current
+        for obj in Dependencies(objects):
+            temp.collection.objects.link(obj)
+        evaluation = cls(temp, temp.view_layers[0])
+        evaluation.temporary = True
+        return evaluation
+
+    def frame_set(self, nFrame):
+        self.scene.frame_set(nFrame)
+
+    def update(self):
+        self.view_layer.update()
+
+    def evaluated(self, obj):
+        """ obj as evaluated for the current frame """
+        if self.temporary:
+            return obj.evaluated_get(self.view_layer.depsgraph)
+        return obj
+
+    def close(self):
+        if self.temporary and self.scene is not None:
+            bpy.data.scenes.remove(self.scene)
+        self.scene = None
+        self.view_layer = None
@@ -0,0 +1,430 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FSimKeys.py  -- bulk keyframe output for the FishSim add-on
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V0.3.0 - Goldfish Version - Blender 2.8
+
+# The simulation records every channel into a ChannelRecorder while it runs,
+# and WriteFCurves() turns the recording into F-curves in one go at the end:
+# one keyframe_points.add(), one foreach_set('co') and one update() per curve,
+# instead of a keyframe_insert() (and a handle recalculation) per key.
+# With tolerances given, each curve is first thinned out to the fewest keys
+# that stay within them (see Decimate). Oscillating fin channels can also be
+# written as sine Generator modifiers plus a sparse curve for the remainder
+# (see FitOscillators).
+
+import bpy
+import math
+import numpy as np
+
+
+class ChannelRecorder:
+    """ Per-frame channel values for one rig, keyed by F-curve data path """
+
+    def __init__(self):
+        self.frames = []
+        self.samples = {}
+
+    def __len__(self):
+        return len(self.frames)
+
+    def key_count(self):
+        """ Keyframes needed to key every recorded value """
+        return len(self.frames) * sum(len(values[0]) for values in self.samples.values() if len(values))
+
+    def record(self, frame, channels):
+        self.frames.append(frame)
+        for path, value in channels.items():
+            self.samples.setdefault(path, []).append(value)
+
+    @classmethod
+    def from_arrays(cls, frames, channels):
+        recorder = cls()
+        recorder.extend(frames, channels)
+        return recorder
+
+    def extend(self, frames, channels):
+        """ Record several frames at once, channels holds one row per frame """
+        self.frames.extend(frames)
+        for path, values in channels.items():
+            self.samples.setdefault(path, []).extend(values)
+
+
+def GroupName(data_path):
+    """ Action group used by keyframe_insert for this path """
+    if data_path.startswith('pose.bones["'):
+        return data_path[len('pose.bones["'):data_path.index('"]')]
+    return "Object Transforms"
+
+
+#Channel kind of each simulated property, for picking its tolerance
+TOLERANCE_KINDS = {"rotation_quaternion": "quaternion", "rotation_euler": "angle", "scale": "scale", "location": "distance"}
+
+
+def Tolerances(angle, scale, distance):
+    """ Per component tolerance of each channel kind.
+    angle is in degrees, scale a ratio and distance in scene units.
+    """
+    return {
+        #a quaternion component changes by about half the rotation angle
+        "quaternion": math.radians(angle) * 0.5,
+        "angle": math.radians(angle),
+        "scale": scale,
+        "distance": distance,
+    }
+
+
+def ChannelTolerance(data_path, tolerances):
+    if tolerances is None:
+        return None
+    return tolerances.get(TOLERANCE_KINDS.get(data_path.rsplit(".", 1)[-1]))
+
+
+def Decimate(frames, values, tolerance):
+    """ Pick the keys to keep from a densely sampled channel.
+    Every key gets handles a third of the way to its neighbours along the
+    sampled slope, which makes each Bezier segment the cubic Hermite curve
+    between its keys. Keys are added where that curve strays furthest from
+    the samples until every sample is within tolerance.
+    Returns (indices of the keys, slope at every sample).
+    """
+    count = len(frames)
+    if count < 3:
+        return np.arange(count), np.zeros(count)
+    slopes = np.gradient(values, frames)
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    segments = [(0, count - 1)]
+    while segments:
+        i, j = segments.pop()
+        if j - i < 2:
+            continue
+        h = frames[j] - frames[i]
+        t = (frames[i+1:j] - frames[i]) / h
+        t2 = t * t
+        t3 = t2 * t
+        curve = ((2*t3 - 3*t2 + 1) * values[i] + (t3 - 2*t2 + t) * h * slopes[i]
+                 + (-2*t3 + 3*t2) * values[j] + (t3 - t2) * h * slopes[j])
+        error = np.abs(curve - values[i+1:j])
+        k = int(np.argmax(error))
+        if error[k] > tolerance:
+            m = i + 1 + k
+            keep[m] = True
+            segments += [(i, m), (m, j)]
+    return np.flatnonzero(keep), slopes
+
+
+#Frames fitted at a time (neighbouring windows that fit one sine wave share a modifier)
+OSCILLATOR_WINDOW = 24
+#Oscillation periods tried by the fit, in frames
+_PERIODS = np.geomspace(3.0, 4.0 * OSCILLATOR_WINDOW, 96)
+
+
+def _FitSine(x, y):
+    #Least squares c + d*x + A*sin(w*x + phase): (A, w, phase, largest error)
+    omegas = 2.0 * math.pi / _PERIODS
+    for span in (0.05, 0.0025, 0.000125, None):
+        #every candidate frequency at once
+        ones = np.ones((len(omegas), len(x)))
+        M = np.stack((ones, ones * (x - x[0]), np.sin(np.outer(omegas, x)), np.cos(np.outer(omegas, x))), axis=-1)
+        MtM = np.einsum('kni,knj->kij', M, M) + np.eye(4) * 1e-12
+        Mty = np.einsum('kni,n->ki', M, y)
+        coef = np.linalg.solve(MtM, Mty[..., None])[..., 0]
+        fit = np.einsum('kni,ki->kn', M, coef)
+        rss = np.sum((fit - y) ** 2, axis=1)
+        best = int(np.argmin(rss))
+        omega = omegas[best]
+        if span is not None:
+            omegas = np.linspace(omega * (1.0 - span), omega * (1.0 + span), 41)
+    a, b = coef[best, 2], coef[best, 3]
+    return math.hypot(a, b), omega, math.atan2(b, a), float(np.max(np.abs(fit[best] - y)))
+
+
+def FitOscillators(frames, values, tolerance):
+    """ Fit a sine wave to each OSCILLATOR_WINDOW frames of a channel.
+    Within a window the channel is taken as c + d*x + A*sin(w*x + phase),
+    with w picked from _PERIODS and refined around the best match. A window
+    is merged into the one before while a single wave fits both as well.
+    Returns a list of (first frame, last frame, A, w, phase) for the windows
+    where A is above tolerance.
+    """
+    fits = []
+    count = len(frames)
+    group = None
+    for window in np.array_split(np.arange(count), max(1, int(round(count / OSCILLATOR_WINDOW)))) + [None]:
+        if window is not None and len(window) >= 8:
+            fit = _FitSine(frames[window], values[window])
+            if group is not None:
+                union = np.concatenate((group[0], window))
+                merged = _FitSine(frames[union], values[union])
+                if merged[3] <= max(tolerance, group[1][3], fit[3]):
+                    group = (union, merged)
+                    continue
+        else:
+            fit = None
+        if group is not None and group[1][0] > tolerance:
+            x = frames[group[0]]
+            fits.append((x[0], x[-1]) + group[1][:3])
+        group = None if fit is None else (window, fit)
+    return fits
+
+
+def OscillatorValues(fits, frames):
+    """ The sum of the fitted sine waves at each frame (each modifier blends
+    in and out between its first and last frames and the frames either
+    side, so every frame has just its own window's wave)
+    """
+    values = np.zeros(len(frames))
+    for f0, f1, amplitude, omega, phase in fits:
+        inside = (frames >= f0) & (frames <= f1)
+        values[inside] += amplitude * np.sin(omega * frames[inside] + phase)
+    return values
+
+
+def _RemoveOscillators(fc, first, last):
+    #Sine modifiers written by an earlier bake are cut back to the frames
+    #outside first..last, so they don't add to the ones written now. Each
+    #keeps full influence on its own frames and fades out (or in) over the
+    #frame next to the range, as written by WriteFCurve()
+    for mod in [mod for mod in fc.modifiers if mod.type == 'FNGENERATOR' and mod.use_restricted_range
+                and mod.frame_start < last and mod.frame_end > first]:
+        start, end = mod.frame_start, mod.frame_end
+        before = start < first - 1.0
+        after = end > last + 1.0
+        if before and after:
+            #it goes on past the range too: keep that part as a copy
+            rest = fc.modifiers.new('FNGENERATOR')
+            for prop in ("function_type", "use_additive", "amplitude", "phase_multiplier", "phase_offset", "value_offset"):
+                setattr(rest, prop, getattr(mod, prop))
+            rest.use_restricted_range = True
+            rest.frame_start = last
+            rest.frame_end = end
+            rest.blend_in = 1.0
+            rest.blend_out = mod.blend_out
+        elif after:
+            mod.frame_start = last
+            mod.blend_in = 1.0
+        if before:
+            mod.frame_end = first
+            mod.blend_out = 1.0
+        elif not after:
+            fc.modifiers.remove(mod)
+
+
+#Key properties kept from an earlier bake, and the number of values each has
+_KEY_PROPS = (("co", 2), ("handle_left_type", 1), ("handle_right_type", 1), ("interpolation", 1), ("handle_left", 2), ("handle_right", 2))
+
+
+def _ReadKeys(points):
+    #Every key property of _KEY_PROPS as an array with one row per key
+    n = len(points)
+    keys = {}
+    for prop, size in _KEY_PROPS:
+        values = np.empty(n * size, dtype=np.float64 if size == 2 else np.int32)
+        points.foreach_get(prop, values)
+        keys[prop] = values.reshape(n, size) if size == 2 else values
+    return keys
+
+
+def _SplitBezier(p0, p1, p2, p3, frame):
+    """ Split the Bezier segment p0..p3 where it reaches frame.
+    Returns (right handle of p0, left handle at frame, point at frame,
+    right handle at frame) of the two halves.
+    """
+    lo, hi = 0.0, 1.0
+    for i in range(60):
+        t = (lo + hi) * 0.5
+        x = ((1-t)**3 * p0[0] + 3*(1-t)**2*t * p1[0] + 3*(1-t)*t*t * p2[0] + t**3 * p3[0])
+        if x < frame:
+            lo = t
+        else:
+            hi = t
+    t = (lo + hi) * 0.5
+    a = p0 + (p1 - p0) * t
+    e = p1 + (p2 - p1) * t
+    c = p2 + (p3 - p2) * t
+    f = a + (e - a) * t
+    g = e + (c - e) * t
+    m = f + (g - f) * t
+    m[0] = frame
+    return a, f, m, g
+
+
+def _Boundary(fc, keys, i, frame):
+    """ A key at frame for a curve whose keys after key i are being replaced
+    from frame + 1 on, so the curve up to frame keeps the shape it was baked
+    with. Returns (co, handle_left, new right handle of key i or None), or
+    None when key i is already at frame (or there's no key after it).
+    """
+    co = keys["co"]
+    if i < 0 or i + 1 >= len(co) or co[i, 0] >= frame:
+        return None
+    kp = fc.keyframe_points[i]
+    if kp.interpolation != 'BEZIER':
+        value = fc.evaluate(frame)
+        return np.array((frame, value)), np.array((frame - 1.0 / 3.0, value)), None
+    right, left, point, unused = _SplitBezier(co[i], keys["handle_right"][i], keys["handle_left"][i + 1], co[i + 1], frame)
+    return point, left, right
+
+
+def WriteFCurve(fcurves, data_path, index, frames, values, slopes=None, oscillators=()):
+    """ Replace the keys of one F-curve between frames[0] and frames[-1].
+    With slopes, the new keys get free handles along them (see Decimate).
+    Keys outside the range keep their handles and interpolation, and a key
+    is added on the frame before the range where needed so the curve before
+    it is unchanged (see _Boundary).
+    oscillators are FitOscillators() sine waves added to the keys by
+    additive Generator modifiers, each restricted to its own frames and
+    fading in and out over the frame either side.
+    """
+    nBefore = 0
+    boundary = None
+    fc = fcurves.find(data_path, index=index)
+    if fc is None:
+        fc = fcurves.new(data_path, index=index, action_group=GroupName(data_path))
+        co = np.empty(2 * len(frames))
+        co[0::2] = frames
+        co[1::2] = values
+        fc.keyframe_points.add(len(frames))
+        fc.keyframe_points.foreach_set('co', co)
+    else:
+        #keep any keys outside the simulated range, as they were
+        points = fc.keyframe_points
+        old = _ReadKeys(points)
+        x = old["co"][:, 0]
+        before = np.flatnonzero(x < frames[0])
+        after = np.flatnonzero(x > frames[-1])
+        nBefore = len(before)
+        boundary = _Boundary(fc, old, nBefore - 1, frames[0] - 1.0)
+        nBoundary = 0 if boundary is None else 1
+        new = np.column_stack((frames, values))
+        co = [old["co"][before]]
+        if boundary is not None:
+            co.append(boundary[0][None, :])
+        co += [new, old["co"][after]]
+        co = np.concatenate(co)
+        points.clear()
+        points.add(len(co))
+        points.foreach_set('co', co.ravel())
+        #rows of the kept keys in the new list of keys
+        rows = np.concatenate((np.arange(nBefore), nBefore + nBoundary + len(frames) + np.arange(len(after))))
+        kept = np.concatenate((before, after))
+        current = _ReadKeys(points)
+        for prop, size in _KEY_PROPS[1:]:
+            current[prop][rows] = old[prop][kept]
+            points.foreach_set(prop, current[prop].ravel())
+        if boundary is not None:
+            point, left, right = boundary
+            if right is not None:
+                kp = points[nBefore - 1]
+                kp.handle_left_type = 'FREE'
+                kp.handle_right_type = 'FREE'
+                kp.handle_left = old["handle_left"][before[-1]]
+                kp.handle_right = right
+            #on to the first new key along the slope the curve arrives with
+            kp = points[nBefore]
+            kp.interpolation = 'BEZIER'
+            kp.handle_left_type = 'FREE'
+            kp.handle_right_type = 'FREE'
+            slope = (point[1] - left[1]) / max(point[0] - left[0], 1e-9)
+            step = (frames[0] - point[0]) / 3.0
+            kp.handle_left = left
+            kp.handle_right = (point[0] + step, point[1] + slope * step)
+        nBefore += nBoundary
+    if slopes is not None:
+        points = fc.keyframe_points
+        for k in range(len(frames)):
+            kp = points[nBefore + k]
+            kp.handle_left_type = 'FREE'
+            kp.handle_right_type = 'FREE'
+            left = (frames[k] - frames[k-1]) / 3.0 if k > 0 else 1.0
+            right = (frames[k+1] - frames[k]) / 3.0 if k < len(frames) - 1 else 1.0
+            kp.handle_left = (frames[k] - left, values[k] - slopes[k] * left)
+            kp.handle_right = (frames[k] + right, values[k] + slopes[k] * right)
+    _RemoveOscillators(fc, frames[0], frames[-1])
+    for f0, f1, amplitude, omega, phase in oscillators:
+        mod = fc.modifiers.new('FNGENERATOR')
+        mod.function_type = 'SIN'
+        mod.use_additive = True
+        mod.amplitude = amplitude
+        mod.phase_multiplier = omega
+        mod.phase_offset = phase
+        mod.value_offset = 0.0
+        #full influence from f0 to f1, crossfading with the next window
+        #between frames instead of jumping half way
+        mod.use_restricted_range = True
+        mod.frame_start = f0 - 1.0
+        mod.frame_end = f1 + 1.0
+        mod.blend_in = 1.0
+        mod.blend_out = 1.0
+    fc.update()
+    return fc
+
+
+def WriteOscillatorFCurve(fcurves, data_path, index, frames, values, tolerance):
+    """ Write a channel as sine modifiers plus the decimated remainder, if
+    that takes fewer keys and modifiers than decimating the channel itself.
+    Returns the number of keys and modifiers written.
+    """
+    keys, slopes = Decimate(frames, values, tolerance)
+    #The first frame is left to its key alone, so the pose reads back exactly
+    #there (a later bake's snapshot and cache keys include the start pose)
+    fits = FitOscillators(frames[1:], values[1:], tolerance)
+    if fits:
+        residual = values - OscillatorValues(fits, frames)
+        rkeys, rslopes = Decimate(frames, residual, tolerance)
+        if len(rkeys) + len(fits) < len(keys):
+            WriteFCurve(fcurves, data_path, index, frames[rkeys], residual[rkeys], rslopes[rkeys], fits)
+            return len(rkeys) + len(fits)
+    WriteFCurve(fcurves, data_path, index, frames[keys], values[keys], slopes[keys])
+    return len(keys)
+
+
+def WriteFCurves(obj, recorder, tolerances=None, oscillate=None):
+    """ Write every recorded channel of a rig to its action, decimated to
+    the Tolerances() given. oscillate maps the data paths to write with
+    WriteOscillatorFCurve() to their tolerance.
+    Returns the number of keyframes (and modifiers) written.
+    """
+    if len(recorder) == 0:
+        return 0
+    anim = obj.animation_data
+    if anim is None:
+        anim = obj.animation_data_create()
+    if anim.action is None:
+        anim.action = bpy.data.actions.new(obj.name + "Action")
+    fcurves = anim.action.fcurves
+
+    frames = np.asarray(recorder.frames, dtype=float)
+    count = 0
+    for data_path, samples in recorder.samples.items():
+        values = np.asarray(samples, dtype=float).reshape(len(frames), -1)
+        tolerance = ChannelTolerance(data_path, tolerances)
+        for index in range(values.shape[1]):
+            if oscillate and data_path in oscillate:
+                count += WriteOscillatorFCurve(fcurves, data_path, index, frames, values[:, index], oscillate[data_path])
+            elif tolerance is None:
+                WriteFCurve(fcurves, data_path, index, frames, values[:, index])
+                count += len(frames)
+            else:
+                keys, slopes = Decimate(frames, values[:, index], tolerance)
+                WriteFCurve(fcurves, data_path, index, frames[keys], values[keys, index], slopes[keys])
+                count += len(keys)
+    return count
@@ -0,0 +1,110 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FSimParallel.py  -- multi-process baking for the FishSim add-on
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V0.3.0 - Goldfish Version - Blender 2.8
+
+# Rigs only depend on their own target proxy, so a school can be split into
+# chunks and each chunk baked by FSimBatch in its own process.
+# Worker processes can't import bpy, so they load this module directly (not
+# through the add-on package) and everything crossing the process boundary is
+# plain data: state snapshots and parameter slots in, NumPy channel arrays
+# (and snapshots) out.
+
+import os
+import numpy as np
+
+if __package__:
+    from . import FSimCore, FSimBatch, FSimTrajectory
+else:
+    import FSimCore, FSimBatch, FSimTrajectory
+
+
+def Pack(obj):
+    """ The slot values of FishParams as a dictionary """
+    return {name: getattr(obj, name) for name in type(obj).__slots__ if hasattr(obj, name)}
+
+def Unpack(cls, data):
+    obj = cls.__new__(cls)
+    for name, value in data.items():
+        setattr(obj, name, value)
+    return obj
+
+
+def BakeChunk(states, params, samples, valid, start, end, resume=None, interval=0, fixed=None, channels=None):
+    """ Bake a chunk of fish in one process.
+    states are FishState snapshots, params is Pack()ed and samples is the
+    chunk's slice of the trajectory buffer, shape (frames, fish, SAMPLE_SIZE).
+    The fish are primed on start, or carry on from the snapshots taken at
+    frame resume.
+    Returns (channels, snapshots): a dictionary of data path: array of shape
+    (frames, fish, k) for frames first..end, where first is start + 1 (or
+    resume + 1), and frame: list of snapshots every interval frames.
+    fixed is the (fps, timestep) of a FSimCore.FixedStep to advance by, or None.
+    channels is each fish's pose on the start frame, or None (see FSimBatch.prime).
+    """
+    states = [FSimCore.FishState.restore(s) for s in states]
+    params = Unpack(FSimCore.FishParams, params)
+    batch = FSimBatch.BatchState.from_states(states)
+    trajectory = FSimTrajectory.TrajectoryBuffer(start, end, 0)
+    trajectory.data = samples
+    trajectory.valid = valid
+    if fixed is not None:
+        fixed = FSimCore.FixedStep(*fixed)
+    first = start + 1 if resume is None else resume + 1
+    out = {}
+    snapshots = {}
+    for nFrame in range(start if resume is None else first, end + 1):
+        if nFrame == start:
+            FSimBatch.prime(batch, params, trajectory.targets(nFrame), channels)
+        elif fixed is None:
+            channels = FSimBatch.step_batch(batch, params, trajectory.targets(nFrame))
+        else:
+            channels = FSimBatch.step_batch_fixed(batch, params, trajectory.targets, fixed)
+        if nFrame > start:
+            for path, values in channels.items():
+                if path not in out:
+                    out[path] = np.empty((end - first + 1, len(states), values.shape[1]))
+                out[path][nFrame - first] = values
+        if interval and (nFrame - start) % interval == 0:
+            snapshots[nFrame] = [batch.to_state(i).snapshot() for i in range(len(states))]
+    return out, snapshots
+
+
+def Chunks(count, workers=None):
+    """ Split fish 0..count-1 into (at most) one index array per worker """
+    workers = workers or os.cpu_count() or 1
+    return [c for c in np.array_split(np.arange(count), min(workers, count)) if len(c)] if count else []
+
+
+def SubmitBake(executor, states, params, trajectory, columns, start, end, resume=None, interval=0, fixed=None, workers=None, channels=None):
+    """ Submit every chunk to the executor (see BakeChunk).
+    Returns a list of (indices into states, future) pairs.
+    """
+    packed_params = Pack(params)
+    columns = np.asarray(columns)
+    jobs = []
+    for chunk in Chunks(len(states), workers):
+        samples = trajectory.data[:, columns[chunk]]
+        valid = trajectory.valid[columns[chunk]]
+        own = None if channels is None else [channels[i] for i in chunk]
+        future = executor.submit(BakeChunk, [states[i].snapshot() for i in chunk], packed_params, samples, valid, start, end, resume, interval, fixed, own)
+        jobs.append((chunk, future))
+    return jobs
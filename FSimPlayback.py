@@ -0,0 +1,174 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FSimPlayback.py  -- keyframe-free playback of simulated rigs
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V0.3.0 - Goldfish Version - Blender 2.8
+
+# Instead of F-curves, a simulated rig can keep its channel values as one
+# single precision (float32) buffer per rig, stored as bytes in custom
+# properties on the armature object. A
+# frame_change_pre handler poses every such rig from its array, so the rigs
+# swim when scrubbing while their actions stay empty.
+
+import bpy
+import numpy as np
+from bpy.app.handlers import persistent
+
+
+#Custom properties on the armature object
+PROP_START = "FSimPlaybackStart"
+PROP_PATHS = "FSimPlaybackPaths"
+PROP_ROWS = "FSimPlaybackRows"
+PROP_DATA = "FSimPlaybackData"
+
+#obj.as_pointer(): (layout, start, [(owner, prop, columns)], data array). Store
+#and Clear drop a rig's track when they change its buffer, and a file load or
+#undo drops them all (see _Layout for the rest)
+_Tracks = {}
+
+
+def _Columns(paths, samples):
+    #Column range of each channel in a frame row, and the row width
+    columns = []
+    col = 0
+    for path in paths:
+        width = len(samples[path][0])
+        columns.append((path, col, col + width))
+        col += width
+    return columns, col
+
+
+def _Resolve(obj, path):
+    #The owner and property name a channel data path refers to
+    if '.' in path:
+        owner_path, prop = path.rsplit('.', 1)
+        return obj.path_resolve(owner_path), prop
+    return obj, path
+
+
+def Load(obj):
+    """ The stored frames of a rig as (start, paths, (frames, width) array), or None """
+    if PROP_DATA not in obj:
+        return None
+    paths = obj[PROP_PATHS].split("\n")
+    data = np.frombuffer(obj[PROP_DATA], dtype=np.float32)
+    return obj[PROP_START], paths, data.reshape(obj[PROP_ROWS], -1)
+
+
+def Store(obj, recorder):
+    """ Keep a ChannelRecorder's frames on the rig, merged into any frames
+    already stored with the same channels.
+    """
+    if len(recorder) == 0:
+        return
+    paths = list(recorder.samples)
+    columns, width = _Columns(paths, recorder.samples)
+    frames = np.asarray(recorder.frames, dtype=int)
+    start = int(frames.min())
+    end = int(frames.max())
+    old = Load(obj)
+    if old is not None and old[1] == paths:
+        start = min(start, old[0])
+        end = max(end, old[0] + len(old[2]) - 1)
+    data = np.zeros((end - start + 1, width), dtype=np.float32)
+    if old is not None and old[1] == paths:
+        data[old[0] - start:old[0] - start + len(old[2])] = old[2]
+    for path, c0, c1 in columns:
+        data[frames - start, c0:c1] = np.asarray(recorder.samples[path], dtype=np.float32).reshape(len(frames), -1)
+    obj[PROP_START] = start
+    obj[PROP_PATHS] = "\n".join(paths)
+    obj[PROP_ROWS] = len(data)
+    obj[PROP_DATA] = data.tobytes()
+    _Tracks.pop(obj.as_pointer(), None)
+
+
+def Clear(obj):
+    for prop in (PROP_START, PROP_PATHS, PROP_ROWS, PROP_DATA):
+        if prop in obj:
+            del obj[prop]
+    _Tracks.pop(obj.as_pointer(), None)
+
+
+def _Layout(obj):
+    #Cheap checks for a stale track: the buffer replaced other than by Store,
+    #or bones added or removed (renamed bones are still the same bones)
+    return (obj[PROP_ROWS], len(obj.pose.bones))
+
+
+def _Track(obj, key):
+    layout = _Layout(obj)
+    track = _Tracks.get(key)
+    if track is None or track[0] != layout:
+        start, paths, data = Load(obj)
+        channels = []
+        col = 0
+        for path in paths:
+            try:
+                owner, prop = _Resolve(obj, path)
+                count = len(getattr(owner, prop))
+            except (ValueError, AttributeError):
+                #a bone that's gone: leave its channels out
+                owner = None
+                count = 0
+            if owner is not None:
+                channels.append((owner, prop, slice(col, col + count)))
+            col += count
+        track = (layout, start, channels, data)
+        _Tracks[key] = track
+    return track
+
+
+@persistent
+def PosePlayback(scene, depsgraph=None):
+    """ frame_change_pre handler: pose every rig that has stored frames """
+    keys = set()
+    for obj in scene.objects:
+        if obj.type != 'ARMATURE' or PROP_DATA not in obj:
+            continue
+        key = obj.as_pointer()
+        keys.add(key)
+        layout, start, channels, data = _Track(obj, key)
+        row = data[min(max(scene.frame_current - start, 0), len(data) - 1)]
+        for owner, prop, columns in channels:
+            setattr(owner, prop, row[columns])
+    #Rigs deleted since
+    for key in [key for key in _Tracks if key not in keys]:
+        del _Tracks[key]
+
+
+@persistent
+def ClearTracks(dummy=None):
+    #The cached bones are stale after loading a file or undoing
+    _Tracks.clear()
+
+
+def register():
+    bpy.app.handlers.frame_change_pre.append(PosePlayback)
+    for handlers in (bpy.app.handlers.load_post, bpy.app.handlers.undo_post, bpy.app.handlers.redo_post):
+        handlers.append(ClearTracks)
+
+
+def unregister():
+    if PosePlayback in bpy.app.handlers.frame_change_pre:
+        bpy.app.handlers.frame_change_pre.remove(PosePlayback)
+    for handlers in (bpy.app.handlers.load_post, bpy.app.handlers.undo_post, bpy.app.handlers.redo_post):
+        if ClearTracks in handlers:
+            handlers.remove(ClearTracks)
+    _Tracks.clear()
@@ -0,0 +1,180 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FSimProfile.py  -- where a simulation spends its time
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V0.3.0 - Goldfish Version - Blender 2.8
+
+# A Profiler adds up the wall time and number of calls of each phase of a
+# simulation, per rig, and keeps the individual calls for a Chrome trace
+# (load the JSON file in chrome://tracing or https://ui.perfetto.dev).
+# Phases are either 'with profiler.phase(name, rig):' blocks in the operator,
+# or functions of the simulation core wrapped by instrument() for the length
+# of the simulation, so the core itself has no profiling code in it.
+# When profiling is off the operator uses NULL, whose phases do nothing.
+
+import json
+import time
+
+
+#Calls kept for the trace, after this only the totals are added up
+MAX_EVENTS = 250000
+
+
+class _NoPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _Phase:
+    __slots__ = ("profiler", "name", "rig", "t0")
+
+    def __init__(self, profiler, name, rig):
+        self.profiler = profiler
+        self.name = name
+        self.rig = rig
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, self.rig, self.t0, time.perf_counter())
+        return False
+
+
+class NullProfiler:
+    """ Stand-in used when profiling is off """
+    enabled = False
+    rig = None
+    _phase = _NoPhase()
+
+    def phase(self, name, rig=None):
+        return self._phase
+
+    def instrument(self, module, names):
+        pass
+
+    def restore(self):
+        pass
+
+
+NULL = NullProfiler()
+
+
+class Profiler:
+    """ Wall time and calls per (phase, rig), and the calls themselves for a trace """
+    enabled = True
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        #(phase, rig): [seconds, calls]
+        self.totals = {}
+        #(phase, rig, start, end) in perf_counter() seconds
+        self.events = []
+        self.dropped = 0
+        #rig the wrapped core functions are being called for (None in batch mode)
+        self.rig = None
+        self._patched = []
+
+    def phase(self, name, rig=None):
+        return _Phase(self, name, rig)
+
+    def add(self, name, rig, t0, t1):
+        entry = self.totals.get((name, rig))
+        if entry is None:
+            entry = self.totals[(name, rig)] = [0.0, 0]
+        entry[0] += t1 - t0
+        entry[1] += 1
+        if len(self.events) < MAX_EVENTS:
+            self.events.append((name, rig, t0, t1))
+        else:
+            self.dropped += 1
+
+    def _Wrap(self, name, function):
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(name, self.rig, t0, time.perf_counter())
+        return timed
+
+    def instrument(self, module, names):
+        """ Time every call of module.name for each name, until restore() """
+        for name in names:
+            function = getattr(module, name)
+            self._patched.append((module, name, function))
+            setattr(module, name, self._Wrap(name, function))
+
+    def restore(self):
+        for module, name, function in reversed(self._patched):
+            setattr(module, name, function)
+        self._patched = []
+
+    def phases(self):
+        """ [(phase, seconds, calls)] summed over the rigs, slowest first """
+        sums = {}
+        for (name, rig), (seconds, calls) in self.totals.items():
+            entry = sums.setdefault(name, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += calls
+        return sorted(((name, s, c) for name, (s, c) in sums.items()), key=lambda p: -p[1])
+
+    def rigs(self):
+        """ [(rig, seconds)] summed over the phases, slowest first """
+        sums = {}
+        for (name, rig), (seconds, calls) in self.totals.items():
+            if rig is not None:
+                sums[rig] = sums.get(rig, 0.0) + seconds
+        return sorted(sums.items(), key=lambda r: -r[1])
+
+    def summary(self, count=8):
+        """ Lines for the report: the slowest phases and rigs (phase times include any phases inside them) """
+        elapsed = max(time.perf_counter() - self.origin, 1e-9)
+        lines = ["Profile: {:.2f} s in total".format(elapsed)]
+        for name, seconds, calls in self.phases()[:count]:
+            lines.append("  {}: {:.3f} s, {} calls ({:.0f}%)".format(name, seconds, calls, 100.0 * seconds / elapsed))
+        rigs = self.rigs()
+        if rigs:
+            lines.append("  slowest rigs: " + ", ".join("{} {:.3f} s".format(rig, seconds) for rig, seconds in rigs[:3]))
+        if self.dropped:
+            lines.append("  ({} calls left out of the trace)".format(self.dropped))
+        return lines
+
+    def trace(self):
+        """ The calls in Chrome trace event format, one thread per rig """
+        threads = {None: 0}
+        events = []
+        for name, rig, t0, t1 in self.events:
+            tid = threads.setdefault(rig, len(threads))
+            events.append({"name": name, "cat": "FishSim", "ph": "X", "pid": 1, "tid": tid,
+                           "ts": (t0 - self.origin) * 1e6, "dur": (t1 - t0) * 1e6})
+        for rig, tid in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": rig or "FishSim"}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_trace(self, path):
+        with open(path, "w") as f:
+            json.dump(self.trace(), f)
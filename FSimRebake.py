@@ -0,0 +1,128 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FSimRebake.py  -- checking that a second bake is recognised as unchanged
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V0.3.0 - Goldfish Version - Blender 2.8
+
+# Simulate bakes a rig, and the next Simulate reads the start pose back from
+# what that bake wrote to build its cache key (FSimCache.BakeKey) and its
+# snapshot key (FSimSnapshots.ParamsKey). If the pose doesn't read back
+# exactly, the second run misses the cache and can't resume. This bakes the
+# first golden fish (see FSimGolden) with each keyframe output, evaluates
+# the start frame from the written F-curves and checks both keys still match.
+# Inside Blender only:
+#   blender --background --python FSimRebake.py
+# The exit status is 1 if any output misses.
+
+import os
+import sys
+
+import numpy as np
+
+if __package__:
+    from . import FSimCore, FSimKeys, FSimCache, FSimSnapshots, FSimGolden
+else:
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import FSimCore, FSimKeys, FSimCache, FSimSnapshots, FSimGolden
+
+
+#Snapshot interval of the bake
+INTERVAL = 10
+#Output option: (decimate, fin modifiers), with the default tolerances
+OUTPUTS = {
+    "KEYFRAMES": (False, False),
+    "DECIMATED": (True, False),
+    "FMODIFIERS": (True, True),
+}
+TOLERANCES = FSimKeys.Tolerances(0.5, 0.01, 0.001)
+
+
+def Bake(preset="goldfish"):
+    """ (params, state, trajectory column, start channels, recorder, history) of one fish """
+    params, trajectory, states = FSimGolden.Setup(preset)
+    state = states[0]
+    #a rig's pose is single precision
+    start = {path: tuple(np.asarray(value, dtype=np.float32).tolist()) for path, value in FSimCore.StartChannels(state, params).items()}
+    column = trajectory.column(0)
+    history = FSimSnapshots.RigHistory(FSimGolden.START, FSimGolden.END, INTERVAL, Keys(params, state, column, start)[1], column)
+    recorder = FSimKeys.ChannelRecorder()
+    recorder.record(FSimGolden.START, start)
+    FSimCore.prime(state, params, trajectory.pose(FSimGolden.START, 0), start)
+    history.capture(state)
+    for nFrame in range(FSimGolden.START + 1, FSimGolden.END + 1):
+        recorder.record(nFrame, FSimCore.step(state, params, trajectory.pose(nFrame, 0)))
+        history.capture(state)
+    history.complete = FSimGolden.END
+    return params, state, column, start, recorder, history
+
+
+def Keys(params, state, column, start):
+    #(cache key, snapshot key) as Simulate makes them
+    bones = [path.split('"')[1] for path in start if '"' in path]
+    return (FSimCache.BakeKey(FSimSnapshots.ParamsKey(params, state.sGoldfish, FSimGolden.SEED), bones, column, start, FSimGolden.START, FSimGolden.END, FSimGolden.SEED),
+            FSimSnapshots.ParamsKey(params, state.sGoldfish, FSimGolden.SEED, None, start))
+
+
+def ReadBack(obj, start, nFrame):
+    """ The channels of start as the object's action evaluates them on nFrame """
+    fcurves = obj.animation_data.action.fcurves
+    return {path: tuple(fcurves.find(path, index=i).evaluate(nFrame) for i in range(len(value))) for path, value in start.items()}
+
+
+def Check(output):
+    import bpy
+    decimate, oscillate = OUTPUTS[output]
+    params, state, column, start, recorder, history = Bake()
+    cache = FSimCache.BakeCache(64 * 1024 * 1024)
+    key, params_key = Keys(params, state, column, start)
+    cache.put(key, recorder.frames, recorder.samples)
+    obj = bpy.data.objects.new("FSimRebake", None)
+    try:
+        obj.animation_data_create()
+        obj.animation_data.action = bpy.data.actions.new("FSimRebake")
+        FSimKeys.WriteFCurves(obj, recorder, TOLERANCES if decimate else None,
+                              {path: FSimKeys.ChannelTolerance(path, TOLERANCES) for path in FSimCore.FIN_PATHS} if oscillate else None)
+        read = ReadBack(obj, start, FSimGolden.START)
+    finally:
+        action = obj.animation_data.action
+        bpy.data.objects.remove(obj)
+        bpy.data.actions.remove(action)
+    key2, params_key2 = Keys(params, state, column, read)
+    failures = ["{} reads back as {} instead of {}".format(path, read[path], value) for path, value in start.items() if read[path] != value]
+    if cache.get(key2) is None:
+        failures.append("cache miss")
+    if history.resume_frame(FSimGolden.START, FSimGolden.END, INTERVAL, params_key2, column) is None:
+        failures.append("no snapshot to resume from")
+    return failures
+
+
+def main():
+    failed = False
+    for output in OUTPUTS:
+        failures = Check(output)
+        print("{:>10}: {}".format(output, "FAILED" if failures else "ok"))
+        for failure in failures:
+            print("    " + failure)
+        failed = failed or bool(failures)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FSimRollback.py  -- undo-free baking with a single step of rollback
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V0.3.0 - Goldfish Version - Blender 2.8
+
+# Global undo stores a copy of the whole file for every bake, which gets
+# expensive for a large school. With undo turned off, Begin() instead has
+# each rig bake into a new action and keeps its own action (and its swim
+# cycle strips and playback frames) from before the bake, and Revert() puts
+# them back. Nothing kept has a fake user: once the rig no longer uses it, it
+# isn't saved with the file, and the backups are dropped when a file is loaded.
+# Only the most recent undo-free bake or Copy Models can be reverted.
+
+import bpy
+from bpy.app.handlers import persistent
+
+if __package__:
+    from . import FSimCycles, FSimPlayback, FSimSnapshots
+else:
+    import FSimCycles, FSimPlayback, FSimSnapshots
+
+
+#Rig name: RigBackup from before the last undo-free bake
+Backups = {}
+#Names of the objects added by the last undo-free Copy Models
+Added = []
+#Name given to an action while it is kept for Revert()
+BACKUP_NAME = "{} (before bake)"
+
+
+def _Remove(action):
+    #Delete an action that nothing uses any more (or that's already gone)
+    try:
+        if action.users == 0:
+            bpy.data.actions.remove(action)
+    except ReferenceError:
+        pass
+
+
+class RigBackup:
+    """ The animation of one rig before a bake """
+
+    def __init__(self, obj):
+        anim = obj.animation_data
+        #the rig's own action, which it keeps while the bake writes to a new one
+        self.sAction = None
+        self.sName = None
+        if anim is not None and anim.action is not None:
+            self.sAction = anim.action
+            self.sName = self.sAction.name
+            baked = self.sAction.copy()
+            self.sAction.name = BACKUP_NAME.format(self.sName)
+            baked.name = self.sName
+            anim.action = baked
+        #(name, start frame, action, action start, action end, repeat, extrapolation) of each cycle strip
+        self.sStrips = []
+        track = anim.nla_tracks.get(FSimCycles.TRACK_NAME) if anim is not None else None
+        if track is not None:
+            for strip in track.strips:
+                FSimCycles.KeptActions.add(strip.action.as_pointer())
+                self.sStrips.append((strip.name, strip.frame_start, strip.action, strip.action_frame_start, strip.action_frame_end, strip.repeat, strip.extrapolation))
+        self.sPlayback = {prop: obj[prop] for prop in (FSimPlayback.PROP_START, FSimPlayback.PROP_PATHS, FSimPlayback.PROP_ROWS, FSimPlayback.PROP_DATA) if prop in obj}
+
+    def Restore(self, obj):
+        FSimCycles.RemoveCycles(obj)
+        FSimPlayback.Clear(obj)
+        anim = obj.animation_data
+        if anim is None:
+            anim = obj.animation_data_create()
+        baked = anim.action
+        anim.action = self.sAction
+        if baked is not None and baked != self.sAction:
+            _Remove(baked)
+        if self.sAction is not None:
+            self.sAction.name = self.sName
+            self.sAction = None
+        if self.sStrips:
+            track = anim.nla_tracks.new()
+            track.name = FSimCycles.TRACK_NAME
+            for name, start, action, action_start, action_end, repeat, extrapolation in self.sStrips:
+                strip = track.strips.new(name, int(start), action)
+                strip.action_frame_start = action_start
+                strip.action_frame_end = action_end
+                strip.repeat = repeat
+                strip.extrapolation = extrapolation
+                FSimCycles.KeptActions.discard(action.as_pointer())
+        for prop, value in self.sPlayback.items():
+            obj[prop] = value
+        self.sStrips = []
+
+    def Discard(self):
+        #Drop the old actions once they can no longer be reverted to
+        if self.sAction is not None:
+            _Remove(self.sAction)
+            self.sAction = None
+        for strip in self.sStrips:
+            try:
+                FSimCycles.KeptActions.discard(strip[2].as_pointer())
+            except ReferenceError:
+                continue
+            _Remove(strip[2])
+        self.sStrips = []
+
+
+def Begin():
+    """ Start a new undo-free operation, forgetting the previous one """
+    for backup in Backups.values():
+        backup.Discard()
+    Backups.clear()
+    Added.clear()
+    FSimCycles.KeptActions.clear()
+
+
+def Keep(obj):
+    """ Back up a rig before it is baked (from here on it bakes into a new action) """
+    if obj.name not in Backups:
+        Backups[obj.name] = RigBackup(obj)
+
+
+@persistent
+def Forget(dummy=None):
+    #The backups refer to the file that was open before
+    Backups.clear()
+    Added.clear()
+    FSimCycles.KeptActions.clear()
+
+
+def register():
+    bpy.app.handlers.load_pre.append(Forget)
+
+
+def unregister():
+    if Forget in bpy.app.handlers.load_pre:
+        bpy.app.handlers.load_pre.remove(Forget)
+    Begin()
+
+
+def CanRevert():
+    return bool(Backups or Added)
+
+
+def Revert(scene):
+    """ Put back every rig backed up since Begin(), and delete the objects it added.
+    Returns the number of rigs restored.
+    """
+    nRestored = 0
+    for name, backup in Backups.items():
+        obj = scene.objects.get(name)
+        if obj is None or name in Added:
+            backup.Discard()
+            continue
+        backup.Restore(obj)
+        #the snapshots belong to the bake being reverted
+        FSimSnapshots.Histories.pop(name, None)
+        nRestored += 1
+    Backups.clear()
+    for name in Added:
+        obj = bpy.data.objects.get(name)
+        if obj is not None:
+            FSimSnapshots.Histories.pop(name, None)
+            data = obj.data
+            bpy.data.objects.remove(obj)
+            #the copied armature or mesh goes too, unless something else uses it
+            if data is not None and data.users == 0:
+                if isinstance(data, bpy.types.Armature):
+                    bpy.data.armatures.remove(data)
+                elif isinstance(data, bpy.types.Mesh):
+                    bpy.data.meshes.remove(data)
+    Added.clear()
+    return nRestored
@@ -0,0 +1,104 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FSimSnapshots.py  -- simulation state history for re-simulating changes
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V0.3.0 - Goldfish Version - Blender 2.8
+
+# Every bake keeps a FishState snapshot of each rig every few frames, along
+# with the target trajectory it followed. When the target is changed later
+# on, the next bake can restart from the last snapshot before the change
+# and only replace the keys after it.
+# The histories live for the Blender session only; without one a rig is
+# simply baked from the start frame.
+
+import math
+
+import numpy as np
+
+
+#Target samples closer than this are treated as unchanged
+TOLERANCE = 1e-6
+
+#Rig name: RigHistory of its last bake
+Histories = {}
+
+
+def ParamsKey(params, goldfish, seed=None, timing=None, start_channels=None):
+    """ Anything that changes the whole simulation when it changes
+    (timing is the FixedStep key, if the physics runs on fixed steps, and
+    start_channels the channel values at the start frame)
+    """
+    start = None if start_channels is None else tuple(sorted((path, tuple(value)) for path, value in start_channels.items()))
+    return tuple(getattr(params, name) for name in type(params).__slots__) + (bool(goldfish), seed, timing, start)
+
+
+def LastTargetFrame(frame, snapshot):
+    """ The last frame of target samples a snapshot taken after frame has
+    used. Fixed steps longer than a frame sample the target ahead of the
+    frame, up to the end of the last step (sStepFrame, between two frames).
+    """
+    return max(frame, int(math.ceil(snapshot.get("sStepFrame", frame) - 1e-9)))
+
+
+class RigHistory:
+    """ Snapshots of one rig's FishState every interval frames of a bake """
+    __slots__ = ("start", "end", "interval", "key", "trajectory", "snapshots", "complete")
+
+    def __init__(self, start, end, interval, key, trajectory, snapshots=None):
+        self.start = start
+        self.end = end
+        self.interval = max(1, interval)
+        self.key = key
+        #(frames, SAMPLE_SIZE) target samples, or None for a rig without a target
+        self.trajectory = None if trajectory is None else np.array(trajectory)
+        #frame: FishState.snapshot() taken after that frame was simulated
+        self.snapshots = dict(snapshots) if snapshots else {}
+        #last frame that was keyed
+        self.complete = start - 1
+
+    def due(self, frame):
+        return (frame - self.start) % self.interval == 0
+
+    def capture(self, state):
+        if self.due(state.frame):
+            self.snapshots[state.frame] = state.snapshot()
+
+    def resume_frame(self, start, end, interval, key, trajectory):
+        """ The latest snapshot a new bake with these settings can restart from,
+        or None if it has to start from scratch.
+        """
+        if (start, end, max(1, interval), key) != (self.start, self.end, self.interval, self.key):
+            return None
+        if (trajectory is None) != (self.trajectory is None):
+            return None
+        first = self.complete + 1
+        if trajectory is not None:
+            changed = np.flatnonzero(np.any(np.abs(trajectory - self.trajectory) > TOLERANCE, axis=1))
+            if len(changed):
+                first = min(first, start + int(changed[0]))
+        frames = [frame for frame, snapshot in self.snapshots.items() if LastTargetFrame(frame, snapshot) < first]
+        return max(frames) if frames else None
+
+    def restart(self, frame, trajectory):
+        """ A history for a new bake restarting from the snapshot at frame """
+        history = RigHistory(self.start, self.end, self.interval, self.key, trajectory,
+                             {f: s for f, s in self.snapshots.items() if f <= frame})
+        history.complete = frame
+        return history
@@ -0,0 +1,137 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FSimTrajectory.py  -- pre-sampled target proxy motion for the FishSim add-on
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V0.3.0 - Goldfish Version - Blender 2.8
+
+# The world transform of every target proxy over the simulation range,
+# captured once into a single array so the simulation itself never has to
+# read proxy.matrix_world (or move the scene to a frame) to find its target.
+# Fixed steps that fall between frames see the proxies blended between them.
+
+import math
+
+import numpy as np
+
+if __package__:
+    from . import FSimCore, FSimBatch, FSimAnalytic
+else:
+    import FSimCore, FSimBatch, FSimAnalytic
+
+
+#Layout of one sample: translation, rotation quaternion (w, x, y, z), dimensions
+LOC = slice(0, 3)
+ROT = slice(3, 7)
+DIM = slice(7, 10)
+SAMPLE_SIZE = 10
+
+
+class TrajectoryBuffer:
+    """ Proxy transforms for frames start..end, shape (frames, proxies, SAMPLE_SIZE) """
+    __slots__ = ("start", "end", "data", "valid")
+
+    def __init__(self, start, end, count):
+        self.start = start
+        self.end = end
+        self.data = np.zeros((end - start + 1, count, SAMPLE_SIZE))
+        self.data[:, :, ROT] = (1.0, 0.0, 0.0, 0.0)
+        #False for rigs that have no target proxy
+        self.valid = np.zeros(count, dtype=bool)
+
+    def _row(self, frame):
+        return min(max(int(round(frame)) - self.start, 0), self.end - self.start)
+
+    def _samples(self, frame, columns=slice(None)):
+        #The proxies at frame, blended between the two nearest frames for fixed steps between them
+        nRow = self._row(frame)
+        if abs(frame - round(frame)) < 1e-6:
+            return self.data[nRow, columns]
+        nRow = self._row(math.floor(frame))
+        a = self.data[nRow, columns]
+        b = self.data[min(nRow + 1, self.end - self.start), columns]
+        w = frame - math.floor(frame)
+        samples = a + (b - a) * w
+        #shortest way round for the rotation, then back to unit length
+        qb = np.where(np.sum(a[:, ROT] * b[:, ROT], axis=1, keepdims=True) < 0.0, -b[:, ROT], b[:, ROT])
+        q = a[:, ROT] + (qb - a[:, ROT]) * w
+        samples[:, ROT] = q / np.linalg.norm(q, axis=1, keepdims=True)
+        return samples
+
+    def pose(self, frame, i):
+        """ TargetPose of proxy i at frame (None if the rig has no proxy) """
+        if not self.valid[i]:
+            return None
+        sample = self._samples(frame, slice(i, i + 1))[0].tolist()
+        return FSimCore.TargetPose(tuple(sample[LOC]), tuple(sample[ROT]), tuple(sample[DIM]))
+
+    def column(self, i):
+        """ Every sample of proxy i, shape (frames, SAMPLE_SIZE) (None if the rig has no proxy) """
+        return self.data[:, i] if self.valid[i] else None
+
+    def targets(self, frame, columns=None):
+        """ BatchTargets for the given proxies (all of them by default) at frame """
+        samples = self._samples(frame, slice(None) if columns is None else columns)
+        valid = self.valid if columns is None else self.valid[columns]
+        return FSimBatch.BatchTargets(samples[:, LOC], samples[:, ROT], samples[:, DIM], valid)
+
+
+def AnalyticSamples(proxy, frames):
+    """ Samples of a proxy at every frame, worked out from its F-curves (see FSimAnalytic) """
+    m = FSimAnalytic.WorldMatrices(proxy, frames)
+    samples = np.empty((len(frames), SAMPLE_SIZE))
+    samples[:, LOC] = m[:, :3, 3]
+    samples[:, ROT] = FSimAnalytic.MatrixToQuat(m[:, :3, :3])
+    #the dimensions scale with the world matrix
+    scale = np.linalg.norm(np.array(proxy.matrix_world)[:3, :3], axis=0)
+    size = np.divide(np.array(proxy.dimensions), scale, out=np.zeros(3), where=scale > 0.0)
+    samples[:, DIM] = size * np.linalg.norm(m[:, :3, :3], axis=1)
+    return samples
+
+
+def SampleProxies(evaluation, proxies, start, end, analytic=True):
+    """ Capture every proxy from start..end. Proxies animated by nothing but
+    F-curves are worked out directly (if analytic is set), and the scene is
+    stepped through the frame range once for the rest.
+    evaluation is the FSimIsolate.Evaluation to step, and proxies may
+    contain None for rigs without a target.
+    """
+    buffer = TrajectoryBuffer(start, end, len(proxies))
+    buffer.valid[:] = [proxy is not None for proxy in proxies]
+    frames = np.arange(start, end + 1)
+    sampled = []
+    for i, proxy in enumerate(proxies):
+        if proxy is None:
+            continue
+        if analytic and FSimAnalytic.IsAnalytic(proxy):
+            buffer.data[:, i] = AnalyticSamples(proxy, frames)
+        else:
+            sampled.append((i, proxy))
+    if not sampled:
+        return buffer
+    for nFrame in range(start, end + 1):
+        evaluation.frame_set(nFrame)
+        row = buffer.data[nFrame - start]
+        for i, proxy in sampled:
+            proxy = evaluation.evaluated(proxy)
+            mw = proxy.matrix_world
+            row[i, LOC] = mw.to_translation()
+            row[i, ROT] = mw.to_quaternion()
+            row[i, DIM] = proxy.dimensions
+    return buffer
@@ -22,9 +22,10 @@
 # version comment: V0.3.0 - Goldfish Version - Blender 2.8
 
 import bpy
-import mathutils,  math, os
+import mathutils,  math, os, sys, time, multiprocessing, concurrent.futures
+from concurrent.futures import ProcessPoolExecutor
 from bpy.props import FloatProperty, FloatVectorProperty, IntProperty, BoolProperty, EnumProperty, StringProperty
-from random import random
+from . import FSimCore, FSimBatch, FSimKeys, FSimTrajectory, FSimSnapshots, FSimCache, FSimPlayback, FSimCycles, FSimRollback, FSimIsolate, FSimProfile
 
 
 
@@ -90,6 +91,203 @@ class FSimProps(bpy.types.PropertyGroup):
     pHoverTwitchTime : FloatProperty(name="Hover Twitch Time", description="The time between twitching while in hover mode in frames", default=40.0, min=0.0)
     pPecSynch : BoolProperty(name="Pec Synch", description="If true then fins beat together, otherwise fins act out of phase", default=False)
     
+#The target proxy linked to a rig's root bone, if any
+def GetTargetProxy(TargetRig):
+    try:
+        TargetProxyName = TargetRig.pose.bones["root"]["TargetProxy"]
+        return bpy.data.objects[TargetProxyName]
+    except:
+        return None
+
+
+#Worker processes can't import the add-on package (it needs bpy), so the parallel
+#bake runs FSimParallel loaded straight from the add-on folder
+def ParallelExecutor():
+    sAddonDir = os.path.dirname(os.path.abspath(__file__))
+    if sAddonDir not in sys.path:
+        sys.path.append(sAddonDir)
+    import FSimParallel
+    mp_context = multiprocessing.get_context('spawn')
+    #Blender 2.8 can't be started as a worker, use its bundled python instead
+    sPython = getattr(bpy.app, "binary_path_python", None)
+    if sPython:
+        mp_context.set_executable(sPython)
+    return FSimParallel, ProcessPoolExecutor(os.cpu_count(), mp_context=mp_context)
+
+
+class FSimOutput:
+    """How finished recordings are written to their rigs, from the Output options"""
+    
+    def __init__(self, pFSM):
+        self.sMode = pFSM.fsim_output
+        tolerances = FSimKeys.Tolerances(pFSM.fsim_tol_angle, pFSM.fsim_tol_scale, pFSM.fsim_tol_distance)
+        #Keyframe decimation tolerances (None keys every frame)
+        self.sTolerances = tolerances if pFSM.fsim_decimate and self.sMode != 'PROCEDURAL' else None
+        #Fin data paths written as sine modifiers, and their tolerances
+        self.sOscillate = None
+        if self.sMode == 'FMODIFIERS':
+            self.sOscillate = {path: FSimKeys.ChannelTolerance(path, tolerances) for path in FSimCore.FIN_PATHS}
+        #Tolerances for matching repeated swim strokes
+        self.sCycles = tolerances if self.sMode == 'CYCLES' else None
+        
+    #True if the output reduces the number of keys (so it's worth reporting)
+    def Reduces(self):
+        return self.sTolerances is not None or self.sOscillate is not None or self.sCycles is not None
+
+    #Write a recording to a rig, returns the number of keys written
+    def Write(self, obj, recorder):
+        if self.sMode == 'PROCEDURAL':
+            FSimCycles.RemoveCycles(obj)
+            FSimPlayback.Store(obj, recorder)
+            return 0
+        FSimPlayback.Clear(obj)
+        if self.sCycles is not None:
+            nKeys = FSimCycles.WriteCycles(obj, recorder, self.sCycles, self.sTolerances)
+            if nKeys is not None:
+                return nKeys
+        FSimCycles.RemoveCycles(obj)
+        return FSimKeys.WriteFCurves(obj, recorder, self.sTolerances, self.sOscillate)
+
+
+#The tail bones spine_master turns, from the hips out to the tail fin (the
+#super_spine tail of the metarigs)
+TAIL_BONES = ("ORG-spine.002", "ORG-spine.001", "ORG-spine")
+
+
+class FSimRig:
+    """The bones, target proxy and recorded channels of one armature being simulated"""
+    
+    def __init__(self, TargetRig):
+        self.sTargetRig = TargetRig
+        bones = TargetRig.pose.bones
+        self.sRoot = bones.get("root")
+        self.sTorso = bones.get("torso")
+        self.sSpine_master = bones.get("spine_master")
+        self.sBack_fin1 = bones.get("back_fin_masterBk.001")
+        self.sBack_fin2 = bones.get("back_fin_masterBk")
+        self.sBack_fin_middle = bones.get("DEF-back_fin.T.001.Bk")
+        self.sChest = bones.get("chest")
+        self.sSideFinL = bones.get("side_fin.L")
+        self.sSideFinR = bones.get("side_fin.R")
+        #pecs
+        self.sPecFinTopL = bones.get("t_master.L")
+        self.sPecFinTopR = bones.get("t_master.R")
+        self.sPecFinBottomL = bones.get("b_master.L")
+        self.sPecFinBottomR = bones.get("b_master.R")
+        self.sPecFinPalmL = bones.get("pec_palm.L")
+        self.sPecFinPalmR = bones.get("pec_palm.R")
+        self.sGoldfish = None not in (self.sPecFinTopL, self.sPecFinTopR, self.sPecFinBottomL, self.sPecFinBottomR, self.sPecFinPalmL, self.sPecFinPalmR)
+        self.sFish = None
+        self.sRecorder = None
+        self.sHistory = None
+        #Key of this bake in the bake cache, and the frames it covers
+        self.sCacheKey = None
+        self.nCacheFrames = (0, 0)
+        #Column of this rig's proxy in the sampled trajectory buffer
+        self.nTrajectory = 0
+        #Seed of this rig's random numbers (FSimCore.RigSeed)
+        self.sSeed = None
+            
+    #Check the required Rigify bones are present
+    def IsValid(self):
+        bones = self.sTargetRig.data.bones
+        return None not in (self.sRoot, self.sSpine_master, self.sTorso, self.sChest, self.sBack_fin1, self.sBack_fin2, self.sBack_fin_middle, self.sSideFinL, self.sSideFinR) and None not in [bones.get(name) for name in TAIL_BONES]
+        
+    def BoneList(self):
+        return [self.sSpine_master, self.sBack_fin1, self.sBack_fin2, self.sChest, self.sSideFinL, self.sSideFinR, self.sPecFinPalmL, self.sPecFinPalmR, self.sPecFinTopL, self.sPecFinBottomL, self.sPecFinTopR, self.sPecFinBottomR, self.sRoot, self.sTorso]
+        
+    #Where each simulated channel is written
+    def SetChannelTargets(self):
+        TargetRig = self.sTargetRig
+        self.sChannelTargets = {"location": (TargetRig, "location"), "rotation_euler": (TargetRig, "rotation_euler")}
+        bone_list = FSimCore.SWIM_BONES + (FSimCore.PEC_BONES if self.sGoldfish else ())
+        for bone_name, prop in bone_list:
+            self.sChannelTargets[FSimCore.BonePath(bone_name, prop)] = (TargetRig.pose.bones[bone_name], prop)
+        
+    #Initialise the simulation state from the pose at the start frame
+    def Start(self, nFrame, params):
+        TargetRig = self.sTargetRig
+        self.SetChannelTargets()
+        self.sRecorder = FSimKeys.ChannelRecorder()
+        self.SetInitialKeyframe(nFrame)
+        #the fixed steps blend from this pose to the first step
+        self.sStartChannels = self.CurrentChannels()
+        
+        #initialise state variables and randomise parameters
+        self.sFish = FSimCore.FishState(nFrame, TargetRig.location, TargetRig.rotation_euler, TargetRig.scale, self.sRoot.rotation_quaternion, self.sGoldfish, self.sSeed)
+        self.sFish.randomise(params)
+        self.CalibrateTail()
+    
+    #Carry on from the state saved by an earlier bake
+    def Resume(self, snapshot):
+        self.SetChannelTargets()
+        self.sRecorder = FSimKeys.ChannelRecorder()
+        self.sStartChannels = None
+        self.sFish = FSimCore.FishState.restore(snapshot)
+
+    #The current value of every simulated channel
+    def CurrentChannels(self):
+        channels = {}
+        for path, (owner, prop) in self.sChannelTargets.items():
+            channels[path] = tuple(getattr(owner, prop))
+        return channels
+
+    #Record the pose at the start frame so the F-curves begin from it
+    def SetInitialKeyframe(self, nFrame):
+        self.sRecorder.record(nFrame, self.CurrentChannels())
+
+    #The tail fin position gives the 'swish' force. Work it out from the rest pose once,
+    #over the range of spine_master angles and torso leans, and let the simulation
+    #fit it to the spine angle rather than evaluating the rig every frame.
+    #Each tail bone turns about its own z axis at its hip end by the spine_master
+    #angle, and the torso turns the hips and tail about its y axis. The chest only
+    #turns the bones in front of the hips, so it doesn't move the tail fin.
+    def CalibrateTail(self):
+        bones = self.sTargetRig.data.bones
+        torso = bones[self.sTorso.name]
+        xPivot = torso.head_local
+        xLeanAxis = torso.matrix_local.to_3x3().col[1]
+        xFin = bones[self.sBack_fin_middle.name].head_local
+        joints = [(bones[name].tail_local, bones[name].matrix_local.to_3x3().col[2]) for name in TAIL_BONES]
+        angles = []
+        leans = []
+        xs = []
+        for angle in [math.radians(a) for a in range(-90, 91, 15)]:
+            xTail = mathutils.Matrix.Identity(4)
+            for joint, axis in joints:
+                xTail = xTail @ mathutils.Matrix.Translation(joint) @ mathutils.Matrix.Rotation(angle, 4, axis) @ mathutils.Matrix.Translation(-joint)
+            xTip = xTail @ xFin - xPivot
+            for lean in [math.radians(a) for a in range(-45, 46, 15)]:
+                angles.append(angle)
+                leans.append(lean)
+                xs.append((mathutils.Matrix.Rotation(lean, 3, xLeanAxis) @ xTip + xPivot).x)
+        self.sFish.sTailFK = FSimCore.FitTailFin(angles, xs, leans)
+        self.sFish.sSpineAngle = FSimCore.QuatAngleZ(self.sSpine_master.rotation_quaternion)
+        self.sFish.sTorsoAngle = FSimCore.QuatAngleY(self.sTorso.rotation_quaternion)
+
+    #Record the channels returned by the simulation core for keying
+    def RecordChannels(self, channels, nFrame):
+        self.sRecorder.record(nFrame, channels)
+
+    #Key everything recorded for this rig in one pass per F-curve (see FSimOutput).
+    #Returns the number of values recorded and the number of keys written
+    def WriteKeyframes(self, output):
+        if self.sRecorder is None:
+            return 0, 0
+        nValues = self.sRecorder.key_count()
+        nKeys = output.Write(self.sTargetRig, self.sRecorder)
+        #Keep complete bakes for next time
+        if self.sCacheKey is not None and len(self.sRecorder) and (self.sRecorder.frames[0], self.sRecorder.frames[-1]) == self.nCacheFrames:
+            FSimCache.Cache.put(self.sCacheKey, self.sRecorder.frames, self.sRecorder.samples)
+        #Remember how far the keys go, so the next bake can restart from a snapshot
+        if self.sHistory is not None:
+            if len(self.sRecorder):
+                self.sHistory.complete = max(self.sHistory.complete, self.sRecorder.frames[-1])
+            FSimSnapshots.Histories[self.sTargetRig.name] = self.sHistory
+        self.sRecorder = None
+        return nValues, nKeys
+
+
 class ARMATURE_OT_FSimulate(bpy.types.Operator):
     """Simulate all armatures with a similar name to selected"""
     bl_idname = "armature.fsimulate"
@@ -97,65 +295,39 @@ class ARMATURE_OT_FSimulate(bpy.types.Operator):
     bl_options = {'REGISTER', 'UNDO', 'PRESET'}
     
     _timer = None
-    sRoot = None
-    sTorso = None
-    sSpine_master = None
-    sBack_fin1 = None
-    sBack_fin2 = None
-    sBack_fin_middle = None
-    sChest = None
-    sSideFinL = None
-    sSideFinR = None
-    #pecs
-    sPecFinTopL = None
-    sPecFinTopR = None
-    sPecFinBottomL = None
-    sPecFinBottomR = None
-    sPecFinPalmL = None
-    sPecFinPalmR = None
-    sState = 0.0
-    sPecState = 0.0
-    sPec_scale = 1.0
-    sAngularForceV = 0.0
-    sTargetProxy = None
-    rMaxTailAngle = 0.0
-    rMaxFreq = 0.0
     sTargetRig = None
-    sOldRqdEffort = 0.0
-    sOld_back_fin = None
     sArmatures = []
     nArmature = 0
-    sHoverMode = 1.0
-    sHoverTurn = 0.0
-    sRestFrame = 0.0
-    sRestartFrame = 0.0
-    sRestAmount = 0.0
-    sGoldfish = True
-    sStartAngle = 0.0
-    sTwitchFrame = 0.0
-    sTwitchAngle = 0.0
-    sTwitchTarget = 0.0
-    
-    def SetInitialKeyframe(self, TargetRig, nFrame):
-        TargetRig.keyframe_insert(data_path='location',  frame=(nFrame))
-        TargetRig.keyframe_insert(data_path='rotation_euler',  frame=(nFrame))
-        self.sSpine_master.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        self.sChest.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        self.sTorso.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        self.sBack_fin1.keyframe_insert(data_path='scale',  frame=(nFrame))
-        self.sBack_fin2.keyframe_insert(data_path='scale',  frame=(nFrame))
-        self.sSideFinL.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        self.sSideFinR.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        self.sSideFinR.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        self.sRoot.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        if self.sGoldfish:
-            self.sPecFinPalmL.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-            self.sPecFinPalmR.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-            self.sPecFinTopL.keyframe_insert(data_path='scale',  frame=(nFrame))
-            self.sPecFinBottomL.keyframe_insert(data_path='scale',  frame=(nFrame))
-            self.sPecFinTopR.keyframe_insert(data_path='scale',  frame=(nFrame))
-            self.sPecFinBottomR.keyframe_insert(data_path='scale',  frame=(nFrame))
-   
+    #Rigs stepped in the current pass
+    sRigs = []
+    sParams = None
+    sBatch = None
+    sTrajectory = None
+    sColumns = []
+    nFrame = 0
+    #Frame of the snapshots the pass carries on from (None when starting from scratch)
+    nResume = None
+    #Frames simulated (counted per rig) and the time spent, for the frames/sec report
+    nRigFrames = 0
+    xStartTime = 0.0
+    #Bake cache counters when the simulation started
+    nCacheHits = 0
+    nCacheMisses = 0
+    #How the recordings are written, and values recorded / keys written
+    sOutput = None
+    nValues = 0
+    nKeys = 0
+    #Parallel bake: the worker pool and its outstanding (rig indices, future) jobs
+    sExecutor = None
+    sJobs = None
+    #Back up the rigs for Revert Last Bake (used without global undo)
+    bRollback = False
+    #FSimIsolate.Evaluation the proxies and rigs are evaluated in
+    sEval = None
+    #Times the phases of the simulation (FSimProfile.NULL when not profiling)
+    sProfile = FSimProfile.NULL
+    #FSimCore.FixedStep the physics advances by (None to step once per frame)
+    sFixed = None
     
     def armature_list(self, scene, sFPM):
         self.sArmatures = []
@@ -177,6 +349,8 @@ class ARMATURE_OT_FSimulate(bpy.types.Operator):
             if (fcurve.data_path == "location" or fcurve.data_path == "rotation_euler"):
                 armature.animation_data.action.fcurves.remove(fcurve)
         for bone in bones:
+            if bone is None:
+                continue
             #bone.rotation_mode='XYZ'
             #dispose_paths.append('pose.bones["{}"].rotation_euler'.format(bone.name))
             dispose_paths.append('pose.bones["{}"].rotation_quaternion'.format(bone.name))
@@ -185,120 +359,8 @@ class ARMATURE_OT_FSimulate(bpy.types.Operator):
         for fcurve in dispose_curves:
             armature.animation_data.action.fcurves.remove(fcurve)
 
-    #Set Effort and Direction properties to try and reach the target.
-    def Target(self, TargetRig, TargetProxy, pFS):
-
-        RigDirn = mathutils.Vector((0,-1,0)) @ TargetRig.matrix_world.inverted()
-        #print("RigDirn: ", RigDirn)
-        
-        #distance to target
-        if TargetProxy != None:
-            TargetDirn = (TargetProxy.matrix_world.to_translation() - TargetRig.location)
-        else:
-            TargetDirn = mathutils.Vector((0,-10,0))
-        DifDot = TargetDirn.dot(RigDirn)
-        
-        #horizontal angle to target - limit max turning effort at 90 deg
-        RigDirn2D = mathutils.Vector((RigDirn.x, RigDirn.y))
-        TargetDirn2D = mathutils.Vector((TargetDirn.x, TargetDirn.y))
-        AngleToTarget = math.degrees(RigDirn2D.angle_signed(TargetDirn2D, math.radians(180)))
-        DirectionEffort = AngleToTarget/90.0
-        DirectionEffort = min(1.0,DirectionEffort)
-        DirectionEffort = max(-1.0,DirectionEffort)
-        
-        #vertical angle to target - limit max turning effort at 20 deg
-        RigDirn2DV = mathutils.Vector(((RigDirn.y**2 + RigDirn.x**2)**0.5, RigDirn.z))
-        TargetDirn2DV = mathutils.Vector(((TargetDirn.y**2 + TargetDirn.x**2)**0.5, TargetDirn.z))
-        AngleToTargetV = math.degrees(RigDirn2DV.angle_signed(TargetDirn2DV, math.radians(180)))
-        DirectionEffortV = AngleToTargetV/20.0
-        DirectionEffortV = min(1.0,DirectionEffortV)
-        DirectionEffortV = max(-1.0,DirectionEffortV)
-        
-        #Hover Mode Detection (Close to target and slow)
-        if not self.sGoldfish:
-            self.sHoverMode = 0.0
-        elif TargetDirn.length < (TargetProxy.dimensions[1] * pFS.pHoverDist):# and pFS.sVelocity.length < pFS.pHoverVel:
-            self.sHoverMode = min(1.0, self.sHoverMode + pFS.pSTransTime / 25.0)
-        else:
-            self.sHoverMode = max(0.0, self.sHoverMode - pFS.pHTransTime / 25.0)
-        # print("Hover %.2f, %.2f, %.2f, %.2f" % (self.sHoverMode, TargetDirn.length, TargetProxy.dimensions[1] * 3.0, pFS.sVelocity.length))
-        
-        #Return normalised required effort, turning factor, and ascending factor
-        return DifDot,DirectionEffort,DirectionEffortV
-        
-    #Handle the object movement for swimming
-    def ObjectMovment(self, TargetRig, ForwardForce, AngularForce, AngularForceV, nFrame, TargetProxy, pFS):
-        # print("MovementSwim")
-        #RigDirn = mathutils.Vector((0,-1,0)) * TargetRig.matrix_world.inverted()
-        #Total force is tail force - drag
-        # DragForce = pFS.pDrag * pFS.sVelocity ** 2.0
-        pFS.sVelocity[0] += -(pFS.pDrag * pFS.sVelocity[0] * math.fabs(pFS.sVelocity[0])) / pFS.pMass
-        pFS.sVelocity[1] += (-ForwardForce + -pFS.pDrag * pFS.sVelocity[1] * math.fabs(pFS.sVelocity[1])) / pFS.pMass
-        pFS.sVelocity[2] += -(pFS.pDrag * pFS.sVelocity[2] * math.fabs(pFS.sVelocity[2])) / pFS.pMass
-        # print("Velocity", pFS.sVelocity,pFS.pDrag,pFS.pMass)
-        #print("Fwd, Drag: ", ForwardForce, DragForce)
-        TargetRig.location += pFS.sVelocity @ TargetRig.matrix_world.inverted()
-        TargetRig.keyframe_insert(data_path='location',  frame=(nFrame))
-        
-        #Let's be simplistic - just rotate object based on angluar force
-        TargetRig.rotation_euler.z += math.radians(AngularForce)
-        TargetRig.rotation_euler.x += math.radians(AngularForceV)
-        TargetRig.keyframe_insert(data_path='rotation_euler',  frame=(nFrame))
-        self.sHoverTurn = 0.0
-        
-        #Forward/Backward Tilt based on force
-        if self.sHoverMode <= 0.1:
-            self.sRoot.rotation_quaternion = mathutils.Quaternion((1,0,0), math.radians(0))
-            self.sRoot.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        
-    #Handle the object movement for hovering
-    def ObjectMovmentHover(self, TargetRig, nFrame, TargetProxy, pFS):
-        # print("MovementHover")
-        RigForce = self.sHoverMode * pFS.pPecEffortGain * (TargetProxy.matrix_world.to_translation() - TargetRig.location) @ TargetRig.matrix_world
-        
-        #Limit the force available
-        xHoverMaxForce = pFS.pHoverMaxForce * (1-self.sRestAmount*0.6)
-        RigForce[1] = max(RigForce[1], -xHoverMaxForce)
-        RigForce[1] = min(RigForce[1], xHoverMaxForce * pFS.pHoverDerate)
-        RigForce[2] = max(RigForce[2], -xHoverMaxForce * pFS.pHoverDerate)
-        RigForce[2] = min(RigForce[2], xHoverMaxForce * pFS.pHoverDerate)
-        RigForce[0] = max(RigForce[0], -xHoverMaxForce * pFS.pHoverDerate)
-        RigForce[0] = min(RigForce[0], xHoverMaxForce * pFS.pHoverDerate)
-
-        #Calculate velocity
-        pFS.sVelocity[0] += (RigForce[0] - pFS.pDrag * pFS.sVelocity[0] * math.fabs(pFS.sVelocity[0])) / pFS.pMass
-        pFS.sVelocity[1] += (RigForce[1] - pFS.pDrag * pFS.sVelocity[1] * math.fabs(pFS.sVelocity[1])) / pFS.pMass
-        pFS.sVelocity[2] += (RigForce[2] - pFS.pDrag * pFS.sVelocity[2] * math.fabs(pFS.sVelocity[2])) / pFS.pMass
-        TargetRig.location += pFS.sVelocity @ TargetRig.matrix_world.inverted()
-        TargetRig.keyframe_insert(data_path='location',  frame=(nFrame))
-        # print("sVelocity", pFS.sVelocity)
-        
-        #Rotate model direction to match target
-        # TargetRig.rotation_mode = 'QUATERNION'
-        xTargetQuat = TargetProxy.matrix_world.to_quaternion() @ mathutils.Quaternion((0,0,1),math.radians(self.sStartAngle))
-        xRigQuat = TargetRig.rotation_euler.to_quaternion()
-        xRigQuat = xRigQuat.slerp(xTargetQuat,pFS.pPecTurnAssist/100.0)
-        TargetRig.rotation_euler = xRigQuat.to_euler('XYZ', TargetRig.rotation_euler)
-        # TargetRig.rotation_mode = 'XYZ'
-        TargetRig.keyframe_insert(data_path='rotation_euler',  frame=(nFrame))
-        
-        #Forward/Backward Tilt based on force
-        if RigForce[1] < 0:
-            rf = RigForce[1] * pFS.pHoverDerate
-        else:
-            rf = RigForce[1] 
-        TiltAngle = math.radians(pFS.pHoverTilt * rf / (pFS.pHoverMaxForce * pFS.pHoverDerate))
-        # self.sRoot.rotation_quaternion = mathutils.Quaternion((-1,0,0), math.radians(0))
-        self.sRoot.rotation_quaternion = self.sRoot.rotation_quaternion.slerp(mathutils.Quaternion((1,0,0), TiltAngle),0.03)
-        self.sRoot.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        
-        #Get left or right turn
-        xTurnQuat = TargetRig.rotation_quaternion @ TargetProxy.matrix_world.to_quaternion().inverted()
-        self.sHoverTurn = math.degrees(xTurnQuat.to_euler()[2])
-        # print("TurnQuat:", self.sHoverTurn)
-        
-    #Handle the movement of the bones within the armature        
-    def BoneMovement(self, context):
+    #Set up the rigs (indices into sArmatures) to be simulated from the start frame
+    def BoneMovement(self, context, indices):
     
         
         scene = context.scene
@@ -306,291 +368,187 @@ class ARMATURE_OT_FSimulate(bpy.types.Operator):
         pFSM = scene.FSimMainProps
         startFrame = pFSM.fsim_start_frame
         endFrame = pFSM.fsim_end_frame
-        self.sStartAngle = pFSM.fsim_startangle
-        
-        #Get the current Target Rig
-        # try:
-        TargetRig = scene.objects.get(self.sArmatures[self.nArmature])
-        # except IndexError:
-            # TargetRig = None
-        self.sTargetRig = TargetRig
-    
-        #Check the required Rigify bones are present
-        self.sRoot = TargetRig.pose.bones.get("root")
-        self.sTorso = TargetRig.pose.bones.get("torso")
-        self.sSpine_master = TargetRig.pose.bones.get("spine_master")
-        self.sBack_fin1 = TargetRig.pose.bones.get("back_fin_masterBk.001")
-        self.sBack_fin2 = TargetRig.pose.bones.get("back_fin_masterBk")
-        self.sBack_fin_middle = TargetRig.pose.bones.get("DEF-back_fin.T.001.Bk")
-        self.sChest = TargetRig.pose.bones.get("chest")
-        self.sSideFinL = TargetRig.pose.bones.get("side_fin.L")
-        self.sSideFinR = TargetRig.pose.bones.get("side_fin.R")
-        if (self.sSpine_master is None) or (self.sTorso is None) or (self.sChest is None) or (self.sBack_fin1 is None) or (self.sBack_fin2 is None) or (self.sBack_fin_middle is None) or (self.sSideFinL is None) or (self.sSideFinR is None):
-            self.report({'ERROR'}, "Sorry, this addon needs a Rigify rig generated from a Shark Metarig")
-            print("Not an Suitable Rigify Armature")
-            return 0,0
-            
-        # Pectoral fins if they exist
-        self.sPecFinTopL = TargetRig.pose.bones.get("t_master.L")
-        self.sPecFinTopR = TargetRig.pose.bones.get("t_master.R")
-        self.sPecFinBottomL = TargetRig.pose.bones.get("b_master.L")
-        self.sPecFinBottomR = TargetRig.pose.bones.get("b_master.R")
-        self.sPecFinPalmL = TargetRig.pose.bones.get("pec_palm.L")
-        self.sPecFinPalmR = TargetRig.pose.bones.get("pec_palm.R")
-        if (self.sPecFinTopL is None) or (self.sPecFinTopR is None) or (self.sPecFinBottomL is None) or (self.sPecFinBottomR is None) or (self.sPecFinPalmL is None) or (self.sPecFinPalmR is None):
-            print("Not a Goldfish Armature")
-            self.sGoldfish = False
-            self.sHoverMode = 0.0
-            
-        #initialise state variabiles
-        self.sState = 0.0
-        self.AngularForceV = 0.0
-        self.sPecState = 0.0
-        pFS.sVelocity[0] = pFS.sVelocity[1] = pFS.sVelocity[2] = 0.0
-        # print("Init SVelocity", pFS.sVelocity)
-            
-        #Get TargetProxy object details
-        try:
-            TargetProxyName = self.sRoot["TargetProxy"]
-            self.sTargetProxy = bpy.data.objects[TargetProxyName]
-        except:
-            self.sTargetProxy = None
+        nInterval = pFSM.fsim_snapinterval
+        self.sParams = FSimCore.FishParams.from_props(pFS, pFSM)
+        self.sFixed = None
+        if pFSM.fsim_fixedstep:
+            self.sFixed = FSimCore.FixedStep(scene.render.fps / scene.render.fps_base, pFSM.fsim_timestep)
+        sTiming = None if self.sFixed is None else self.sFixed.key()
+        
+        self.sRigs = []
+        for i in indices:
+            rig = FSimRig(scene.objects.get(self.sArmatures[i]))
+            rig.nTrajectory = i
+            rig.sSeed = FSimCore.RigSeed(pFSM.fsim_seed, rig.sTargetRig.name)
+            if not rig.IsValid():
+                self.report({'ERROR'}, "Sorry, this addon needs a Rigify rig generated from a Shark Metarig")
+                print("Not an Suitable Rigify Armature")
+                continue
+            if not rig.sGoldfish:
+                print("Not a Goldfish Armature")
+            self.sRigs.append(rig)
 
         #Go back to the start before removing keyframes to remember starting point
-        context.scene.frame_set(startFrame)
+        with self.sProfile.phase("frame_set"):
+            context.scene.frame_set(startFrame)
+        
+        #Rigs with nothing changed since an earlier bake are keyed straight from the cache
+        if pFSM.fsim_usecache:
+            FSimCache.Cache.resize(pFSM.fsim_cachesize * 1024 * 1024)
+            for rig in list(self.sRigs):
+                sName = rig.sTargetRig.name
+                with self.sProfile.phase("cache", sName):
+                    rig.SetChannelTargets()
+                    rig.sCacheKey = FSimCache.BakeKey(FSimSnapshots.ParamsKey(self.sParams, rig.sGoldfish, rig.sSeed, sTiming), rig.sTargetRig.pose.bones.keys(), self.sTrajectory.column(rig.nTrajectory), rig.CurrentChannels(), startFrame, endFrame, rig.sSeed)
+                    rig.nCacheFrames = (startFrame, endFrame)
+                    cached = FSimCache.Cache.get(rig.sCacheKey)
+                if cached is None:
+                    continue
+                with self.sProfile.phase("RemoveKeyframes", sName):
+                    try:
+                        self.RemoveKeyframes(rig.sTargetRig, rig.BoneList())
+                    except AttributeError:
+                        pass
+                recorder = FSimKeys.ChannelRecorder.from_arrays(*cached)
+                self.nValues += recorder.key_count()
+                with self.sProfile.phase("write keys", sName):
+                    self.nKeys += self.sOutput.Write(rig.sTargetRig, recorder)
+                #the snapshots may be from a different bake than the cached keys
+                FSimSnapshots.Histories.pop(rig.sTargetRig.name, None)
+                self.sRigs.remove(rig)
+        self.sColumns = [rig.nTrajectory for rig in self.sRigs]
+
+        #Restart from the latest snapshot every rig has from before its target changed
+        nResume = None
+        #(cycle detection needs the whole recording)
+        if pFSM.fsim_incremental and pFSM.fsim_output != 'CYCLES' and self.sRigs:
+            resumes = []
+            for rig in self.sRigs:
+                history = FSimSnapshots.Histories.get(rig.sTargetRig.name)
+                if history is not None:
+                    #(a rig moved or posed differently at the start frame can't carry on)
+                    rig.SetChannelTargets()
+                    key = FSimSnapshots.ParamsKey(self.sParams, rig.sGoldfish, rig.sSeed, sTiming, rig.CurrentChannels())
+                    history = history.resume_frame(startFrame, endFrame, nInterval, key, self.sTrajectory.column(rig.nTrajectory))
+                resumes.append(history)
+            if None not in resumes:
+                nResume = min(resumes)
+                if not all(nResume in FSimSnapshots.Histories[rig.sTargetRig.name].snapshots for rig in self.sRigs):
+                    nResume = None
+        self.nResume = nResume
        
-        #Delete existing keyframes
-        try:
-            self.RemoveKeyframes(TargetRig, [self.sSpine_master, self.sBack_fin1, self.sBack_fin2, self.sChest, self.sSideFinL, self.sSideFinR, self.sPecFinPalmL, self.sPecFinPalmR, self.sPecFinTopL, self.sPecFinBottomL, self.sPecFinTopR, self.sPecFinBottomR, self.sRoot, self.sTorso])
-        except AttributeError:
-            pass
-            # print("info: no keyframes")
+        #Delete existing keyframes (a restarted bake only replaces the keys after the snapshot)
+        if nResume is None:
+            for rig in self.sRigs:
+                with self.sProfile.phase("RemoveKeyframes", rig.sTargetRig.name):
+                    try:
+                        self.RemoveKeyframes(rig.sTargetRig, rig.BoneList())
+                    except AttributeError:
+                        pass
+                        # print("info: no keyframes")
         
         #record to previous tail position
-        context.scene.frame_set(startFrame)
-        context.scene.update()
-        self.SetInitialKeyframe(TargetRig, startFrame)
-        
-        #randomise parameters
-        rFact = pFS.pRandom
-        self.rMaxTailAngle = pFS.pMaxTailAngle * (1 + (random() * 2.0 - 1.0) * rFact)
-        self.rMaxFreq = pFS.pMaxFreq * (1 + (random() * 2.0 - 1.0) * rFact)
-        
-    def PecSimulation(self, nFrame, pFS, startFrame):
-        # print("Pecs")
-        if self.sPecFinTopL == None or self.sPecFinTopR == None:
-            return
-        
-        #Update State and main angle
-        self.sPecState = self.sPecState + 360.0 / pFS.pMaxPecFreq
-        xPecAngle = math.sin(math.radians(self.sPecState))*math.radians(pFS.pMaxPecAngle)
-        yPecAngle = math.sin(math.radians(self.sPecState+90.0))*math.radians(pFS.pMaxPecAngle * 2)
-        
-        #Rest Period Calculations
-
-        if nFrame >= self.sRestartFrame:
-            self.sRestAmount = max(0.0, self.sRestAmount - pFS.pPecTransition)
-            if self.sRestAmount < 0.1:
-                self.sRestFrame = nFrame + pFS.pPecDuration
-                self.sRestartFrame = self.sRestFrame + pFS.pPecDuty * pFS.pPecDuration 
+        with self.sProfile.phase("frame_set"):
+            self.sEval.frame_set(startFrame)
+            self.sEval.update()
+        for rig in self.sRigs:
+            trajectory = self.sTrajectory.column(rig.nTrajectory)
+            if nResume is None:
+                with self.sProfile.phase("rig setup", rig.sTargetRig.name):
+                    rig.Start(startFrame, self.sParams)
+                key = FSimSnapshots.ParamsKey(self.sParams, rig.sGoldfish, rig.sSeed, sTiming, rig.sStartChannels)
+                rig.sHistory = FSimSnapshots.RigHistory(startFrame, endFrame, nInterval, key, trajectory)
+            else:
+                history = FSimSnapshots.Histories[rig.sTargetRig.name]
+                rig.Resume(history.snapshots[nResume])
+                rig.sHistory = history.restart(nResume, trajectory)
+        self.nFrame = startFrame if nResume is None else nResume + 1
             
-        if (nFrame >= self.sRestFrame and nFrame < self.sRestartFrame and self.sRestAmount < 1.0):
-            self.sRestAmount = min(1.0, self.sRestAmount + pFS.pPecTransition)
-            
-        # print("RestAmount: ", self.sRestAmount, self.sRestFrame, self.sRestartFrame)
-        
-        #Add the same side fin wobble to the pec fins to stop them looking boring when not flapping
-        SideFinRot = math.radians(math.sin(math.radians(self.sState + pFS.pSideFinPhase)) * pFS.pMaxSideFinAngle)
-
-        #Slerp between oscillating angle and rest angle depending on hover status and reset periods
-        # xRestAmount = 1 means no flapping due to either resting or not hovering
-        xRestAmount = (1.0 - (1.0 - self.sRestAmount) * self.sHoverMode)
-        # print("xRestAmaount: ", xRestAmount)
-        # print("RestAmount: ", self.sRestAmount, self.sRestFrame, self.sRestartFrame)
-        # print("HoverMode: ", self.sHoverMode)
-        yAng = mathutils.Quaternion((0.0, 1.0, 0.0), yPecAngle)
-        # yAng = mathutils.Quaternion((0.0, 1.0, 0.0), 0)
-        xAng = yAng @ mathutils.Quaternion((1.0, 0.0, 0.0), -xPecAngle)
-        xAng = xAng.slerp(mathutils.Quaternion((1.0, 0.0, 0.0), math.radians(pFS.pPecOffset)), xRestAmount)
-        self.sPecFinPalmL.rotation_quaternion = xAng @ mathutils.Quaternion((1.0, 0.0, 0.0), SideFinRot)
-        self.sPecFinPalmL.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        # print("Palm Animate: ", nFrame)
-
-        #Tip deflection based on phase offset
-        xMaxPecScale = pFS.pMaxPecAngle * ( 1.0 / pFS.pPecStiffness) * 0.2 / 30.0
-        
-        self.sPec_scale = 1.0 + math.sin(math.radians(self.sPecState - pFS.pPecPhase)) * xMaxPecScale * (1.0 - xRestAmount)
-        
-        self.sPecFinTopL.scale[1] = self.sPec_scale
-        self.sPecFinBottomL.scale[1] = 1 - (1 - self.sPec_scale) * pFS.pPecStubRatio
-        self.sPecFinTopL.keyframe_insert(data_path='scale',  frame=(nFrame))
-        self.sPecFinBottomL.keyframe_insert(data_path='scale',  frame=(nFrame))
-
-        #copy to the right fin
-        
-        #If fins are opposing
-        if not pFS.pPecSynch:
-            yAng = mathutils.Quaternion((0.0, 1.0, 0.0), yPecAngle)
-            xAng = yAng @ mathutils.Quaternion((1.0, 0.0, 0.0), xPecAngle)
-            xAng = xAng.slerp(mathutils.Quaternion((1.0, 0.0, 0.0), math.radians(pFS.pPecOffset)), xRestAmount)
-            self.sPecFinPalmR.rotation_quaternion = xAng @ mathutils.Quaternion((1.0, 0.0, 0.0), SideFinRot)
-            self.sPecFinTopR.scale[1] = 1/self.sPec_scale
-            self.sPecFinBottomR.scale[1] = 1 - (1 - 1/self.sPec_scale) * pFS.pPecStubRatio
+        #All rigs in one pass are stepped together by the batch engine
+        self.sBatch = None
+        if pFSM.fsim_singlepass and self.sRigs:
+            self.sBatch = FSimBatch.BatchState.from_states([rig.sFish for rig in self.sRigs])
+    
+    #Step one rig with the simulation core
+    def StepRig(self, rig, nFrame, startFrame):
+        self.sProfile.rig = rig.sTargetRig.name
+        if nFrame == startFrame:
+            FSimCore.prime(rig.sFish, self.sParams, self.sTrajectory.pose(nFrame, rig.nTrajectory), rig.sStartChannels)
         else:
-            yAng = mathutils.Quaternion((0.0, 1.0, 0.0), -yPecAngle)
-            xAng = yAng @ mathutils.Quaternion((1.0, 0.0, 0.0), -xPecAngle)
-            xAng = xAng.slerp(mathutils.Quaternion((1.0, 0.0, 0.0), math.radians(pFS.pPecOffset)), xRestAmount)
-            self.sPecFinPalmR.rotation_quaternion = xAng @ mathutils.Quaternion((1.0, 0.0, 0.0), SideFinRot)
-            self.sPecFinTopR.scale[1] = self.sPec_scale
-            self.sPecFinBottomR.scale[1] = 1 - (1 - self.sPec_scale) * pFS.pPecStubRatio
-        self.sPecFinPalmR.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        self.sPecFinTopR.keyframe_insert(data_path='scale',  frame=(nFrame))
-        self.sPecFinBottomR.keyframe_insert(data_path='scale',  frame=(nFrame))
-        
-       
+            with self.sProfile.phase("step", self.sProfile.rig):
+                if self.sFixed is None:
+                    channels = FSimCore.step(rig.sFish, self.sParams, self.sTrajectory.pose(nFrame, rig.nTrajectory))
+                else:
+                    channels = FSimCore.step_fixed(rig.sFish, self.sParams, lambda t: self.sTrajectory.pose(t, rig.nTrajectory), self.sFixed)
+            rig.RecordChannels(channels, nFrame)
+        rig.sHistory.capture(rig.sFish)
+        
+    #Step every rig together with the batch engine
+    def StepBatch(self, nFrame, startFrame):
+        self.sProfile.rig = None
+        batch = self.sBatch
+        if nFrame == startFrame:
+            FSimBatch.prime(batch, self.sParams, self.sTrajectory.targets(nFrame, self.sColumns), [rig.sStartChannels for rig in self.sRigs])
+        else:
+            with self.sProfile.phase("step_batch"):
+                if self.sFixed is None:
+                    channels = FSimBatch.step_batch(batch, self.sParams, self.sTrajectory.targets(nFrame, self.sColumns))
+                else:
+                    channels = FSimBatch.step_batch_fixed(batch, self.sParams, lambda t: self.sTrajectory.targets(t, self.sColumns), self.sFixed)
+            with self.sProfile.phase("record"):
+                for i, rig in enumerate(self.sRigs):
+                    rig.RecordChannels({path: channels[path][i] for path in rig.sChannelTargets}, nFrame)
+        for i, rig in enumerate(self.sRigs):
+            if rig.sHistory.due(nFrame):
+                rig.sHistory.capture(batch.to_state(i))
         
     def ModalMove(self, context):
         scene = context.scene
-        pFS = scene.FSimProps
         pFSM = scene.FSimMainProps
         startFrame = pFSM.fsim_start_frame
         endFrame = pFSM.fsim_end_frame
         
-        nFrame = scene.frame_current
-        print("nFrame: ", nFrame)
-        
-        
-        #Get the effort and direction change to head toward the target
-        RqdEffort, RqdDirection, RqdDirectionV = self.Target(self.sTargetRig, self.sTargetProxy, pFS)
-        if nFrame == startFrame:
-            self.sOldRqdEffort = RqdEffort
-            context.scene.frame_set(nFrame + 1)
-            self.sOld_back_fin = self.sBack_fin_middle.matrix.decompose()[0]
-            return 1
-        TargetEffort = pFS.pEffortGain * (pFS.pEffortIntegral * RqdEffort + (RqdEffort - self.sOldRqdEffort))
-        self.sOldRqdEffort = RqdEffort
-        pFS.sEffort = pFS.pEffortGain * RqdEffort * pFS.pEffortRamp + pFS.sEffort * (1.0-pFS.pEffortRamp)
-        pFS.sEffort = min(pFS.sEffort, 1.0)
-        #print("Required, Effort:", RqdEffort, pFS.sEffort)
-        
-        #Pec fin simulation
-        self.PecSimulation(nFrame, pFS, startFrame)
-        
-        #Convert effort into tail frequency and amplitude (Fades to a low value if in hover mode)
-        pFS.pFreq = self.rMaxFreq * ((1-self.sHoverMode) * (1.0/(pFS.sEffort+ 0.01)) + self.sHoverMode * 2.0)
-        pFS.pTailAngle = self.rMaxTailAngle * ((1-self.sHoverMode) * pFS.sEffort + self.sHoverMode * pFS.pHoverTailFrc)
-        #print("rMax, Frc: %.2f, %.2f" % (self.rMaxTailAngle, pFS.pHoverTailFrc))
-        
-        #Convert direction into Tail Offset angle (Work out swim turn angle and Hover turn angle and mix)
-        xSwimTailAngleOffset = RqdDirection * pFS.pMaxSteeringAngle
-        xHoverTailAngleOffset = pFS.pMaxSteeringAngle * self.sHoverTurn / 30.0
-        xHoverTailAngleOffset = 0.0
-        # xHoverFactor = max(0,(1.0 - self.sHoverMode * 4.0))
-        pFS.sTailAngleOffset = pFS.sTailAngleOffset * (1 - pFS.pEffortRamp) + pFS.pEffortRamp * max(0,(1.0 - self.sHoverMode*2.0)) * xSwimTailAngleOffset + pFS.pEffortRamp * self.sHoverMode * xHoverTailAngleOffset
-        # pFS.sTailAngleOffset = pFS.sTailAngleOffset * (1 - pFS.pEffortRamp) + pFS.pEffortRamp * xSwimTailAngleOffset
-        # print("xHoverOffset, TailOffset: ", xHoverTailAngleOffset, pFS.sTailAngleOffset)
-        # print("HoverMode, xSwimTailAngleOffset: ", self.sHoverMode, xSwimTailAngleOffset)
-        
-        #Hover 'Twitch' calculations (Make the fish do some random twisting during hover mode)
-        if self.sHoverMode < 0.5:
-            #Not hovering so reset
-            self.sTwitchTarget = 0.0
-            self.sTwitchFrame = 0.0
-        else:
-            #Hovering, so check if the twitch frame has been reached
-            if nFrame >= self.sTwitchFrame:
-                #set new twitch frame
-                self.sTwitchFrame = nFrame + pFS.pHoverTwitchTime * (random() - 0.5)
-                #Only twitch while not resting
-                if self.sTwitchFrame < self.sRestartFrame and self.sTwitchFrame > self.sRestFrame:
-                    self.sTwitchFrame = self.sRestartFrame + 5
-                #set a new twitch target angle
-                self.sTwitchTarget = pFS.pHoverTwitch * 2.0 * (random() - 0.5)
-        self.sTwitchAngle = self.sTwitchAngle * 0.9 + 0.1 * self.sTwitchTarget
-        #print("Twitch Angle: ", self.sTwitchAngle)
-            
-        
-        
-        #Spine Movement
-        self.sState = self.sState + 360.0 / pFS.pFreq
-        xTailAngle = math.sin(math.radians(self.sState))*math.radians(pFS.pTailAngle) + math.radians(pFS.sTailAngleOffset) + math.radians(self.sTwitchAngle)
-        #print("Components: %.2f, %.2f, %.2f" % (math.sin(math.radians(self.sState))*math.radians(pFS.pTailAngle),math.radians(pFS.sTailAngleOffset),math.radians(self.sTwitchAngle)))
-        #print("TailAngle", math.degrees(xTailAngle))
-        self.sSpine_master.rotation_quaternion = mathutils.Quaternion((0.0, 0.0, 1.0), xTailAngle)
-        self.sSpine_master.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        ChestRot = mathutils.Quaternion((0.0, 0.0, 1.0), -xTailAngle * pFS.pChestRatio)# - math.radians(pFS.sTailAngleOffset))
-        self.sChest.rotation_quaternion = ChestRot @ mathutils.Quaternion((1.0, 0.0, 0.0), -math.fabs(math.radians(pFS.sTailAngleOffset))*pFS.pChestRaise * (1.0 - self.sHoverMode))
-        #print("Torso:", pFS.sTailAngleOffset)
-        self.sTorso.rotation_quaternion = mathutils.Quaternion((0.0, 1.0, 0.0), -math.radians(pFS.sTailAngleOffset)*pFS.pLeanIntoTurn * (1.0 - self.sHoverMode))
-        self.sChest.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        self.sTorso.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        #context.scene.update()
-        
-        # #Tail Movment
-        if (nFrame == startFrame):
-            back_fin_dif = 0
-        else:
-            back_fin_dif = (self.sBack_fin_middle.matrix.decompose()[0].x - self.sOld_back_fin.x)
-        self.sOld_back_fin = self.sBack_fin_middle.matrix.decompose()[0]
-        
-        #Tailfin bending based on phase offset
-        pMaxTailScale = pFS.pMaxTailFinAngle * ( 1.0 / pFS.pTailFinStiffness) * 0.2 / 30.0
-        
-        self.sBack_fin1_scale = 1.0 + math.sin(math.radians(self.sState + pFS.pTailFinPhase)) * pMaxTailScale * (pFS.pTailAngle / self.rMaxTailAngle)
-        # print("Bend Factor: ", (pFS.pTailAngle / self.rMaxTailAngle))
-        
-        self.sBack_fin1.scale[1] = self.sBack_fin1_scale
-        self.sBack_fin2.scale[1] = 1 - (1 - self.sBack_fin1_scale) * pFS.pTailFinStubRatio
-        self.sBack_fin1.keyframe_insert(data_path='scale',  frame=(nFrame))
-        self.sBack_fin2.keyframe_insert(data_path='scale',  frame=(nFrame))
-        
-        
-        SideFinRot = math.sin(math.radians(self.sState + pFS.pSideFinPhase)) * pFS.pMaxSideFinAngle
-        
-       
-        self.sSideFinL.rotation_quaternion = mathutils.Quaternion((1,0,0), math.radians(-SideFinRot))
-        self.sSideFinR.rotation_quaternion = mathutils.Quaternion((1,0,0), math.radians(SideFinRot))
-       
-        self.sSideFinL.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        self.sSideFinR.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        
-        #Do Object movment with Forward force and Angular force
-        TailFinAngle = (self.sBack_fin1_scale - 1.0) * 30.0 / 0.4
-        TailFinAngleForce = math.sin(math.radians(TailFinAngle))
-        # ForwardForce = -back_fin_dif * TailFinAngleForce * pFS.pPower
-        ForwardForce =  math.fabs(math.cos(math.radians(self.sState))) * math.radians(pFS.pTailAngle) * 15.0 * pFS.pPower / pFS.pMaxFreq
-        # print("Force", ForwardForce, math.fabs(math.cos(math.radians(self.sState))), math.radians(pFS.pTailAngle))
-        
-        #Angular force due to 'swish'
-        AngularForce = back_fin_dif  / pFS.pAngularDrag
-        
-        #Angular force due to rudder effect
-        AngularForce += xTailAngle * pFS.sVelocity[1] / pFS.pAngularDrag
+        #The scene stays on the start frame, the simulation only needs the sampled targets
+        nFrame = self.nFrame
+        # print("nFrame: ", nFrame)
         
-        #Fake Angular force to make turning more effective
-        AngularForce += -(pFS.sTailAngleOffset/pFS.pMaxSteeringAngle) * pFS.pTurnAssist
-        
-        #Angular force for vertical movement
-        self.sAngularForceV = self.sAngularForceV * (1 - pFS.pEffortRamp) + RqdDirectionV * pFS.pMaxVerticalAngle
-        
-        
-        #print("TailFinAngle, AngularForce", xTailAngle, AngularForce)
-        if self.sHoverMode < 0.1:
-            self.ObjectMovment(self.sTargetRig, ForwardForce, AngularForce, self.sAngularForceV, nFrame, self.sTargetProxy, pFS)
+        if not self.sRigs or nFrame > endFrame:
+            return 0
+        if self.sBatch is not None:
+            self.StepBatch(nFrame, startFrame)
         else:
-            self.ObjectMovmentHover(self.sTargetRig, nFrame, self.sTargetProxy, pFS)
-        
+            for rig in self.sRigs:
+                self.StepRig(rig, nFrame, startFrame)
+        #the start frame only primes the rigs
+        if nFrame != startFrame:
+            self.nRigFrames += len(self.sRigs)
         
         #Go to next frame, or finish
         wm = context.window_manager
         # print("Frame: ", nFrame)
-        if nFrame == endFrame:
+        if nFrame >= endFrame:
             return 0
         else:
-            wm.progress_update((len(self.sArmatures) - self.nArmature)*99.0/len(self.sArmatures))
-            context.scene.frame_set(nFrame + 1)
+            if self.sBatch is not None:
+                wm.progress_update((nFrame - startFrame)*99.0/max(1, endFrame - startFrame))
+            else:
+                wm.progress_update((len(self.sArmatures) - self.nArmature)*99.0/len(self.sArmatures))
+            self.nFrame = nFrame + 1
             return 1
         
+    #Key one rig, counting the keys saved by decimation
+    def WriteRig(self, rig):
+        with self.sProfile.phase("write keys", rig.sTargetRig.name):
+            nValues, nKeys = rig.WriteKeyframes(self.sOutput)
+        self.nValues += nValues
+        self.nKeys += nKeys
+
+    #Key the finished rigs
+    def WriteKeyframes(self):
+        for rig in self.sRigs:
+            self.WriteRig(rig)
+        self.sRigs = []
+        self.sBatch = None
 
     def modal(self, context, event):
         if event.type in {'RIGHTMOUSE', 'ESC'}:
@@ -598,21 +556,121 @@ class ARMATURE_OT_FSimulate(bpy.types.Operator):
             return {'CANCELLED'}
 
         if event.type == 'TIMER':
+            pFSM = context.scene.FSimMainProps
+            if not self.Advance(context, time.perf_counter() + pFSM.fsim_tickbudget / 1000.0):
+                return {'CANCELLED'}
+
+        return {'PASS_THROUGH'}
+
+    #Step as many frames as fit before the deadline (None for no limit), then give the UI a turn.
+    #Returns False once everything is simulated and keyed
+    def Advance(self, context, xDeadline=None):
+        pFSM = context.scene.FSimMainProps
+        if self.sJobs is not None:
+            try:
+                modal_rtn = self.CollectParallel(context)
+            except Exception as e:
+                self.report({'ERROR'}, "Parallel simulation failed: {}".format(e))
+                modal_rtn = 0
+            if modal_rtn == 0:
+                self.Finish(context)
+                return False
+            self.UpdateRate(context)
+            return True
+        
+        while True:
             modal_rtn = self.ModalMove(context)
             if modal_rtn == 0:
                 # print("nArmature:", self.nArmature)
+                self.WriteKeyframes()
                 #Go to the next rig if applicable
-                context.scene.frame_set(context.scene.FSimMainProps.fsim_start_frame)
+                with self.sProfile.phase("frame_set"):
+                    context.scene.frame_set(pFSM.fsim_start_frame)
                 if self.nArmature > 0:
                     self.nArmature -= 1
-                    self.BoneMovement(context) 
+                    with self.sProfile.phase("BoneMovement"):
+                        self.BoneMovement(context, [self.nArmature]) 
 
                 else:
-                    wm = context.window_manager
-                    wm.progress_end()
-                    return {'CANCELLED'}
-
-        return {'PASS_THROUGH'}
+                    self.Finish(context)
+                    return False
+            if xDeadline is not None and time.perf_counter() >= xDeadline:
+                break
+        self.UpdateRate(context)
+        return True
+
+    #Without a window (blender --background, or a script) there are no timer events, so simulate to the end in one go
+    def RunToEnd(self, context):
+        while self.Advance(context):
+            if self.sJobs:
+                concurrent.futures.wait([future for chunk, future in self.sJobs], return_when=concurrent.futures.FIRST_COMPLETED)
+
+    #Report and tidy up once everything is simulated
+    def Finish(self, context):
+        self.UpdateRate(context)
+        self.report({'INFO'}, "Simulated {} frames at {:.0f} frames/sec".format(self.nRigFrames, context.scene.FSimMainProps.fsim_fps))
+        if self.sOutput.Reduces() and self.nValues:
+            self.report({'INFO'}, "Keyframes reduced from {} to {} ({:.1f}:1)".format(self.nValues, self.nKeys, self.nValues / max(1, self.nKeys)))
+        if context.scene.FSimMainProps.fsim_usecache:
+            hits = FSimCache.Cache.hits - self.nCacheHits
+            misses = FSimCache.Cache.misses - self.nCacheMisses
+            self.report({'INFO'}, "Bake cache: {} hits, {} misses ({} bakes, {:.1f} MB)".format(hits, misses, len(FSimCache.Cache), FSimCache.Cache.size / (1024 * 1024)))
+        wm = context.window_manager
+        wm.progress_end()
+        self.cancel(context)
+
+    #Report where the time went, and save the trace if there's a path for it
+    def EndProfile(self, context):
+        sProfile = self.sProfile
+        self.sProfile = FSimProfile.NULL
+        sProfile.restore()
+        if not sProfile.enabled:
+            return
+        for line in sProfile.summary():
+            print(line)
+            self.report({'INFO'}, line)
+        sPath = context.scene.FSimMainProps.fsim_profilepath
+        if sPath:
+            sPath = bpy.path.abspath(sPath)
+            try:
+                sProfile.write_trace(sPath)
+                self.report({'INFO'}, "Profile trace saved to " + sPath)
+            except OSError as e:
+                self.report({'WARNING'}, "Couldn't save the profile trace: {}".format(e))
+
+    #Hand the rigs to a pool of worker processes, in chunks
+    def StartParallel(self, context):
+        pFSM = context.scene.FSimMainProps
+        FSimParallel, self.sExecutor = ParallelExecutor()
+        self.sJobs = FSimParallel.SubmitBake(self.sExecutor, [rig.sFish for rig in self.sRigs], self.sParams, self.sTrajectory, self.sColumns, pFSM.fsim_start_frame, pFSM.fsim_end_frame, self.nResume, pFSM.fsim_snapinterval, None if self.sFixed is None else self.sFixed.key(), channels=[rig.sStartChannels for rig in self.sRigs])
+
+    #Key the rigs of any finished chunks
+    def CollectParallel(self, context):
+        pFSM = context.scene.FSimMainProps
+        frames = range(max(self.nFrame, pFSM.fsim_start_frame + 1), pFSM.fsim_end_frame + 1)
+        for job in [job for job in self.sJobs if job[1].done()]:
+            self.sJobs.remove(job)
+            chunk, future = job
+            with self.sProfile.phase("collect"):
+                channels, snapshots = future.result()
+            for k, i in enumerate(chunk):
+                rig = self.sRigs[i]
+                if len(frames):
+                    rig.sRecorder.extend(frames, {path: channels[path][:, k] for path in rig.sChannelTargets})
+                for nFrame, states in snapshots.items():
+                    rig.sHistory.snapshots[nFrame] = states[k]
+                self.WriteRig(rig)
+                self.nRigFrames += len(frames)
+        context.window_manager.progress_update(self.nRigFrames*99.0/max(1, len(self.sRigs)*len(frames)))
+        return 1 if self.sJobs else 0
+
+    #Show the simulation speed in the panel
+    def UpdateRate(self, context):
+        xElapsed = time.perf_counter() - self.xStartTime
+        if xElapsed > 0.0:
+            context.scene.FSimMainProps.fsim_fps = self.nRigFrames / xElapsed
+        if context.area is not None:
+            context.area.tag_redraw()
 
     def execute(self, context):
         sFPM = context.scene.FSimMainProps
@@ -625,21 +683,108 @@ class ARMATURE_OT_FSimulate(bpy.types.Operator):
         
         #Load a list of the relevant armatures
         self.armature_list(scene, sFPM)
+        if not self.sArmatures:
+            self.report({'ERROR'}, "No armatures with a target to simulate - add a target first")
+            return {'CANCELLED'}
         
         #Progress bar
         wm = context.window_manager
         wm.progress_begin(0.0,100.0)
-
-        scene.frame_set(sFPM.fsim_start_frame)
-        self.BoneMovement(context) 
+        self.nRigFrames = 0
+        self.xStartTime = time.perf_counter()
+        self.nCacheHits = FSimCache.Cache.hits
+        self.nValues = 0
+        self.nKeys = 0
+        self.sOutput = FSimOutput(sFPM)
+        self.nCacheMisses = FSimCache.Cache.misses
+        self.sProfile = FSimProfile.NULL
+        if sFPM.fsim_profile:
+            self.sProfile = FSimProfile.Profiler()
+            self.sProfile.instrument(FSimCore, ("Target", "PecSimulation", "ObjectMovment", "ObjectMovmentHover"))
+            self.sProfile.instrument(FSimBatch, ("Target", "PecSimulation"))
+        if self.bRollback:
+            FSimRollback.Begin()
+            for name in self.sArmatures:
+                FSimRollback.Keep(scene.objects.get(name))
+
+        #Capture the motion of every target once, up front
+        proxies = [GetTargetProxy(scene.objects.get(name)) for name in self.sArmatures]
+        if sFPM.fsim_isolate:
+            with self.sProfile.phase("isolate"):
+                self.sEval = FSimIsolate.Evaluation.Isolated(scene, [scene.objects.get(name) for name in self.sArmatures] + proxies)
+        else:
+            self.sEval = FSimIsolate.Evaluation(scene, context.view_layer)
+        with self.sProfile.phase("sample targets"):
+            self.sTrajectory = FSimTrajectory.SampleProxies(self.sEval, proxies, sFPM.fsim_start_frame, sFPM.fsim_end_frame)
+
+        with self.sProfile.phase("frame_set"):
+            scene.frame_set(sFPM.fsim_start_frame)
+        if sFPM.fsim_parallel:
+            #Every rig is set up here, then baked by the worker processes
+            with self.sProfile.phase("BoneMovement"):
+                self.BoneMovement(context, range(len(self.sArmatures)))
+            self.nArmature = 0
+            self.sBatch = None
+            self.StartParallel(context)
+        elif sFPM.fsim_singlepass:
+            #Every rig steps together, frame by frame
+            with self.sProfile.phase("BoneMovement"):
+                self.BoneMovement(context, range(len(self.sArmatures)))
+            self.nArmature = 0
+        else:
+            with self.sProfile.phase("BoneMovement"):
+                self.BoneMovement(context, [self.nArmature]) 
+        if context.window is None:
+            self.RunToEnd(context)
+            return {'FINISHED'}
         wm = context.window_manager
         self._timer = wm.event_timer_add(0.001, window=context.window)
         wm.modal_handler_add(self)
         return {'RUNNING_MODAL'}
 
     def cancel(self, context):
+        #Stop any worker processes still baking
+        if self.sExecutor is not None:
+            for chunk, future in self.sJobs or []:
+                future.cancel()
+            self.sExecutor.shutdown(wait=False)
+            self.sExecutor = None
+        self.sJobs = None
+        #Keep whatever was simulated before the cancel
+        self.WriteKeyframes()
+        if self.sEval is not None:
+            self.sEval.close()
+            self.sEval = None
+        self.EndProfile(context)
         wm = context.window_manager
-        wm.event_timer_remove(self._timer)
+        if self._timer is not None:
+            wm.event_timer_remove(self._timer)
+            self._timer = None
+
+
+class ARMATURE_OT_FSimulateNoUndo(ARMATURE_OT_FSimulate):
+    """Simulate all armatures with a similar name to selected, without global undo (see Revert Last Bake)"""
+    bl_idname = "armature.fsimulate_noundo"
+    bl_label = "Simulate"
+    bl_options = {'REGISTER', 'PRESET'}
+    
+    bRollback = True
+
+
+class ARMATURE_OT_FSim_Revert(bpy.types.Operator):
+    """Put back the rigs as they were before the last Simulate or Copy Models run without undo"""
+    bl_idname = "armature.fsim_revert"
+    bl_label = "Revert Last Bake"
+    bl_options = {'REGISTER'}
+    
+    @classmethod
+    def poll(cls, context):
+        return FSimRollback.CanRevert()
+
+    def execute(self, context):
+        nRestored = FSimRollback.Revert(context.scene)
+        self.report({'INFO'}, "Reverted {} rigs".format(nRestored))
+        return {'FINISHED'}
 
 
 #Register
@@ -647,6 +792,8 @@ class ARMATURE_OT_FSimulate(bpy.types.Operator):
 classes = (
     FSimProps,
     ARMATURE_OT_FSimulate,
+    ARMATURE_OT_FSimulateNoUndo,
+    ARMATURE_OT_FSim_Revert,
 )
 
 def registerTypes():
@@ -657,11 +804,15 @@ def registerTypes():
         register_class(cls)
     # bpy.utils.register_class(FSimProps)
     bpy.types.Scene.FSimProps = bpy.props.PointerProperty(type=FSimProps)
+    FSimPlayback.register()
+    FSimRollback.register()
     # bpy.utils.register_class(ARMATURE_OT_FSimulate)
 
 def unregisterTypes():
     from bpy.utils import unregister_class
 
+    FSimPlayback.unregister()
+    FSimRollback.unregister()
     del bpy.types.Scene.FSimProps
 
     # Classes.
@@ -36,10 +36,34 @@ bl_info = {
 
 if "bpy" in locals():
     import imp
+    imp.reload(FSimCore)
+    imp.reload(FSimBatch)
+    imp.reload(FSimAnalytic)
+    imp.reload(FSimTrajectory)
+    imp.reload(FSimKeys)
+    imp.reload(FSimSnapshots)
+    imp.reload(FSimCache)
+    imp.reload(FSimPlayback)
+    imp.reload(FSimCycles)
+    imp.reload(FSimRollback)
+    imp.reload(FSimIsolate)
+    imp.reload(FSimProfile)
     imp.reload(FishSim)
     imp.reload(metarig_menu)
     # print("Reloaded multifiles")
 else:
+    from . import FSimCore
+    from . import FSimBatch
+    from . import FSimAnalytic
+    from . import FSimTrajectory
+    from . import FSimKeys
+    from . import FSimSnapshots
+    from . import FSimCache
+    from . import FSimPlayback
+    from . import FSimCycles
+    from . import FSimRollback
+    from . import FSimIsolate
+    from . import FSimProfile
     from . import FishSim
     # print("Imported multifiles")
 
@@ -69,8 +93,34 @@ class FSimMainProps(bpy.types.PropertyGroup):
     fsim_maxnum : IntProperty(name="Maximum number of copies", default=250)  
     fsim_copyrigs : BoolProperty(name="Distribute multiple copies of the rig", default=False)  
     fsim_copymesh : BoolProperty(name="Distribute multiple copies of meshes", default=False)  
+    fsim_sharedata : BoolProperty(name="Share armature and mesh data", description="Copies use the template's armature and meshes instead of copies of them, so memory hardly grows with the school. Drivers on the armature then all follow the template's controls", default=False)
     fsim_multisim : BoolProperty(name="Simulate the multiple rigs", default=False)  
     fsim_startangle : FloatProperty(name="Angle to Target", default=0.0)
+    fsim_seed : IntProperty(name="Random Seed", description="Seed for the random variation of every rig (each rig also uses its name, so rigs differ from each other). The same seed always gives the same result", default=0, min=0)
+    fsim_fixedstep : BoolProperty(name="Fixed time step", description="Advance the physics in fixed steps of time, so the motion doesn't change with the scene frame rate (frames are blended from the steps either side)", default=False)
+    fsim_timestep : FloatProperty(name="Time Step (s)", description="Length of one physics step in seconds (the simulation was tuned at 0.04, one frame at 25 fps)", default=0.01, min=0.001, max=0.2, precision=3)
+    fsim_singlepass : BoolProperty(name="Simulate all rigs in one pass", description="Step every rig together, frame by frame, instead of running the frame range once per rig", default=False)
+    fsim_parallel : BoolProperty(name="Bake in parallel processes", description="Split the rigs across one worker process per CPU core", default=False)
+    fsim_incremental : BoolProperty(name="Only re-simulate changes", description="Restart from the last saved simulation state before the targets changed, and keep the keys before it", default=False)
+    fsim_snapinterval : IntProperty(name="Snapshot Interval", description="Frames between saved simulation states", default=25, min=1)
+    fsim_usecache : BoolProperty(name="Reuse unchanged bakes", description="Key rigs whose parameters, bones, start pose and target are unchanged from an earlier bake straight from the bake cache", default=False)
+    fsim_cachesize : IntProperty(name="Bake Cache Size (MB)", description="Memory kept for earlier bakes, the least recently used are dropped first", default=256, min=1)
+    fsim_output : EnumProperty(name="Output", description="What the simulation produces",
+        items=[('KEYS', "Keyframes", "Key every simulated channel"),
+               ('FMODIFIERS', "Keyframes with fin modifiers", "Key the body, and write the fin channels as sine modifiers with a few correcting keyframes"),
+               ('CYCLES', "Keyframes with swim cycles", "Loop a single tail stroke on an NLA track wherever the swimming repeats, and key only the frames in between"),
+               ('PROCEDURAL', "Procedural playback", "Store the simulated frames on the rig and pose it when the frame changes, without keyframes")],
+        default='KEYS')
+    fsim_decimate : BoolProperty(name="Reduce keyframes", description="After simulating, keep only the keyframes needed to stay within the tolerances below", default=False)
+    fsim_tol_angle : FloatProperty(name="Angle Tolerance", description="Largest rotation error allowed by keyframe reduction, in degrees", default=0.5, min=0.0)
+    fsim_tol_scale : FloatProperty(name="Scale Tolerance", description="Largest scale error allowed by keyframe reduction, as a ratio", default=0.01, min=0.0)
+    fsim_tol_distance : FloatProperty(name="Distance Tolerance", description="Largest location error allowed by keyframe reduction", default=0.001, min=0.0)
+    fsim_isolate : BoolProperty(name="Evaluate in a separate scene", description="Read the targets and rigs from a temporary scene holding only them (and what they depend on), so the rest of the scene isn't evaluated every frame", default=False)
+    fsim_profile : BoolProperty(name="Profile", description="Time each part of the simulation, report the slowest ones and save a trace", default=False)
+    fsim_profilepath : StringProperty(name="Trace File", description="Where to save the profile trace (Chrome trace event JSON), nothing is saved if empty", default="//fishsim_trace.json", subtype='FILE_PATH')
+    fsim_undo : BoolProperty(name="Global Undo", description="Let Simulate and Copy Models be undone. Turn off for large schools to save memory, and use Revert Last Bake instead", default=True)
+    fsim_tickbudget : FloatProperty(name="Time per Update (ms)", description="How long the simulation runs between interface updates", default=12.0, min=1.0, max=1000.0)
+    fsim_fps : FloatProperty(name="Frames per second", description="Frames simulated per second in the last simulation (per rig)", default=0.0)
     
 
 
@@ -215,33 +265,85 @@ class ARMATURE_OT_FSim_Run(bpy.types.Operator):
     # add_preset_files()
     
     root = None
+    #Back up the rigs and track the new objects for Revert Last Bake (used without global undo)
+    bRollback = False
 
     
 
-    def CopyChildren(self, context, src_obj, new_obj):
-        for childObj in src_obj.children:
+    def CopyChildren(self, context, src_obj, new_obj, children=None, bShare=False):
+        #children: (child, location relative to src_obj) of src_obj, if already worked out
+        #bShare: link the copies to the template's meshes instead of copying them
+        if children is None:
+            children = [(childObj, childObj.location - src_obj.location) for childObj in src_obj.children]
+        new_children = []
+        for childObj, location in children:
             # print("Copying child: ", childObj.name)
             new_child = childObj.copy()
-            new_child.data = childObj.data.copy()
+            if not bShare:
+                new_child.data = childObj.data.copy()
+            if self.bRollback:
+                FSimRollback.Added.append(new_child.name)
             new_child.animation_data_clear()
-            new_child.location = childObj.location - src_obj.location
+            new_child.location = location
             new_child.parent = new_obj
             new_child.matrix_parent_inverse = childObj.matrix_parent_inverse
             context.collection.objects.link(new_child)
-            new_child.select_set(True)
             for mod in new_child.modifiers:
                 if mod.type == "ARMATURE":
                     mod.object = new_obj
-
+            new_children.append(new_child)
+        return new_children
+
+    #Every driver variable target on the template that points back at it (or its armature), found once per Copy Models:
+    #(on the armature data, driver index, variable index, target index, points at the armature)
+    def DriverSlots(self, src_obj):
+        slots = []
+        for bOnData, anim in ((False, src_obj.animation_data), (True, src_obj.data.animation_data)):
+            if anim is None:
+                continue
+            for nDriver, dr in enumerate(anim.drivers):
+                for nVar, v1 in enumerate(dr.driver.variables):
+                    for nTarget, target in enumerate(v1.targets):
+                        if target.id is None:
+                            continue
+                        if target.id == src_obj:
+                            slots.append((bOnData, nDriver, nVar, nTarget, False))
+                        elif target.id == src_obj.data:
+                            slots.append((bOnData, nDriver, nVar, nTarget, True))
+        return slots
+
+    #Point a copy's drivers at the copy, using the template's DriverSlots
+    def RemapDrivers(self, new_obj, slots, bShare):
+        drivers = {}
+        for bOnData in (False, True):
+            anim = new_obj.data.animation_data if bOnData else new_obj.animation_data
+            #shared armature data keeps the template's drivers
+            if anim is not None and not (bOnData and bShare) and any(slot[0] == bOnData for slot in slots):
+                drivers[bOnData] = list(anim.drivers)
+        for bOnData, nDriver, nVar, nTarget, bData in slots:
+            if bOnData in drivers:
+                target = drivers[bOnData][nDriver].driver.variables[nVar].targets[nTarget]
+                target.id = new_obj.data if bData else new_obj
+
+    #Every target for src_obj's kind of rig (up to the maximum number), with its transform at the current frame
+    def CollectTargets(self, scene, src_obj):
+        targets = []
+        for obj in scene.objects:
+            if "FSim" in obj and (obj["FSim"][-3:] == src_obj.name[:3]):
+                #Limit the maximum copy number
+                if len(targets) >= scene.FSimMainProps.fsim_maxnum:
+                    break
+                targets.append((obj, obj.matrix_world.to_translation(), obj.rotation_euler.copy(), obj.scale.copy()))
+        return targets
     
     def CopyRigs(self, context):
         # print("Populate")
         
         scene = context.scene
+        pFSM = scene.FSimMainProps
         src_obj = context.object
         if src_obj.type != 'ARMATURE':
             return {'CANCELLED'}
-        src_obj.select_set(True)
         
         #make a list of armatures
         armatures = {}
@@ -254,90 +356,91 @@ class ARMATURE_OT_FSim_Run(bpy.types.Operator):
                         if len(proxyName) > 1:
                             armatures[proxyName] = obj.name
         
-        #for each target...
-        obj_count = 0
-        for obj in scene.objects:
-            if "FSim" in obj and (obj["FSim"][-3:] == src_obj.name[:3]):
-                #Limit the maximum copy number
-                if obj_count >= scene.FSimMainProps.fsim_maxnum:
-                    return  {'FINISHED'}
-                obj_count += 1
-                
-                #Go back to the first frame to make sure the rigs are placed correctly
-                scene.frame_set(scene.FSimMainProps.fsim_start_frame)
-                scene.update()
-                
-                #if a rig hasn't already been paired with this target, and it's the right target type for this rig, then add a duplicated rig at this location if 'CopyRigs' is selected
-                if (obj.name not in armatures) and (obj["FSim"][-3:] == src_obj.name[:3]):
-                    # print("time to duplicate")
-
-                    if scene.FSimMainProps.fsim_copyrigs:
-                        #If there is not already a matching armature, duplicate the template and update the link field
-                        new_obj = src_obj.copy()
+        #Go back to the first frame once to make sure the rigs are placed correctly, and read every target there
+        scene.frame_set(pFSM.fsim_start_frame)
+        targets = self.CollectTargets(scene, src_obj)
+        xStartAngle = math.radians(pFSM.fsim_startangle)
+        #Shared data: only the object (transform, pose and action) is new for each fish
+        bShare = pFSM.fsim_sharedata
+        children = [(childObj, childObj.location - src_obj.location) for childObj in src_obj.children]
+        slots = self.DriverSlots(src_obj) if pFSM.fsim_copyrigs else []
+        
+        #Objects to leave selected, and the rig to leave active
+        selected = []
+        active = None
+        for obj, location, rotation, scale in targets:
+            #if a rig hasn't already been paired with this target, add a duplicated rig at this location if 'CopyRigs' is selected
+            if obj.name not in armatures:
+                # print("time to duplicate")
+
+                if pFSM.fsim_copyrigs:
+                    #If there is not already a matching armature, duplicate the template and update the link field
+                    new_obj = src_obj.copy()
+                    if not bShare:
                         new_obj.data = src_obj.data.copy()
-                        # new_obj.animation_data_clear()
-                        context.collection.objects.link(new_obj)
-                        
-                        #Unlink from original action
-                        new_obj.animation_data.action = None
-                        
-                        #2.8 Issue Workout how to update drivers
-                        #Update drivers with new rig id
-                        for dr in new_obj.data.animation_data.drivers:                            
-                            for v1 in dr.driver.variables:
-                                # print("ID_name: ", v1.targets[0].id.name)
-                                # print("obj_name:", src_obj.name)
-                                if (v1.targets[0].id_type == 'OBJECT') and (v1.targets[0].id.name == src_obj.name):
-                                    # print("Update_p", v1.targets[0].id)
-                                    v1.targets[0].id = new_obj
-                                    # print("Update", v1.targets[0].id)
-                                
-                        new_obj.location = obj.matrix_world.to_translation()
-                        new_obj.rotation_euler = obj.rotation_euler
-                        new_obj.rotation_euler.z += math.radians(scene.FSimMainProps.fsim_startangle)
-                        new_root = new_obj.pose.bones.get('root')
-                        new_root['TargetProxy'] = obj.name
-                        new_root.scale = (new_root.scale.x * obj.scale.x, new_root.scale.y * obj.scale.y, new_root.scale.z * obj.scale.z)
-                        context.view_layer.objects.active = new_obj
-                        new_obj.select_set(True)
-                        src_obj.select_set(False)
-                        
-                        #if 'CopyMesh' is selected duplicate the dependents and re-link
-                        if scene.FSimMainProps.fsim_copymesh:
-                            self.CopyChildren(context, src_obj, new_obj)
-
-                #If there's already a matching rig, then just update it
-                elif obj["FSim"][-3:] == src_obj.name[:3]:
-                    # print("matching armature", armatures[obj.name])
-                    TargRig = scene.objects.get(armatures[obj.name])
-                    if TargRig is not None:
-                        #reposition if required
-                        if scene.FSimMainProps.fsim_copyrigs:
-                            # TargRig.animation_data_clear()
-                            TargRig.location = obj.matrix_world.to_translation()
-                            TargRig.rotation_euler = obj.rotation_euler
-                            TargRig.rotation_euler.z += math.radians(scene.FSimMainProps.fsim_startangle)
-                            TargRig.keyframe_insert(data_path='rotation_euler',  frame=(scene.FSimMainProps.fsim_start_frame))
-                            TargRig.keyframe_insert(data_path='location',  frame=(scene.FSimMainProps.fsim_start_frame))
-                        
-                        #if no children, and the 'copymesh' flag set, then copy the associated meshes
-                        if scene.FSimMainProps.fsim_copymesh and len(TargRig.children) < 1:
-                            self.CopyChildren(context, src_obj, TargRig)
-                        
-                        #Leave the just generated objects selected
-                        # scene.objects.active = TargRig
-                        TargRig.select_set(True)
-                        src_obj.select_set(False)
-                        for childObj in TargRig.children:
-                            childObj.select_set(True)
-                        for childObj in src_obj.children:
-                            childObj.select_set(True)
-
-                        # #Animate
-                        # if scene.FSimMainProps.fsim_multisim and TargRig.name != src_obj.name:
-                            # # self.BoneMovement(TargRig, scene.FSimMainProps.fsim_start_frame, scene.FSimMainProps.fsim_end_frame, context)
-                            # bpy.ops.armature.fsimulate()
-                
+                    if self.bRollback:
+                        FSimRollback.Added.append(new_obj.name)
+                    # new_obj.animation_data_clear()
+                    context.collection.objects.link(new_obj)
+                    
+                    #Unlink from original action
+                    new_obj.animation_data.action = None
+                    
+                    #Update drivers with new rig id
+                    self.RemapDrivers(new_obj, slots, bShare)
+                            
+                    new_obj.location = location
+                    new_obj.rotation_euler = rotation
+                    new_obj.rotation_euler.z += xStartAngle
+                    new_root = new_obj.pose.bones.get('root')
+                    new_root['TargetProxy'] = obj.name
+                    new_root.scale = (new_root.scale.x * scale.x, new_root.scale.y * scale.y, new_root.scale.z * scale.z)
+                    active = new_obj
+                    selected.append(new_obj)
+                    
+                    #if 'CopyMesh' is selected duplicate the dependents and re-link
+                    if pFSM.fsim_copymesh:
+                        selected += self.CopyChildren(context, src_obj, new_obj, children, bShare)
+
+            #If there's already a matching rig, then just update it
+            else:
+                # print("matching armature", armatures[obj.name])
+                TargRig = scene.objects.get(armatures[obj.name])
+                if TargRig is not None:
+                    #reposition if required
+                    if pFSM.fsim_copyrigs:
+                        if self.bRollback:
+                            FSimRollback.Keep(TargRig)
+                        # TargRig.animation_data_clear()
+                        TargRig.location = location
+                        TargRig.rotation_euler = rotation
+                        TargRig.rotation_euler.z += xStartAngle
+                        TargRig.keyframe_insert(data_path='rotation_euler',  frame=(pFSM.fsim_start_frame))
+                        TargRig.keyframe_insert(data_path='location',  frame=(pFSM.fsim_start_frame))
+                    
+                    #if no children, and the 'copymesh' flag set, then copy the associated meshes
+                    if pFSM.fsim_copymesh and len(TargRig.children) < 1:
+                        self.CopyChildren(context, src_obj, TargRig, children, bShare)
+                    
+                    #Leave the just generated objects selected
+                    # scene.objects.active = TargRig
+                    selected.append(TargRig)
+                    selected.extend(TargRig.children)
+                    selected.extend(src_obj.children)
+
+                    # #Animate
+                    # if scene.FSimMainProps.fsim_multisim and TargRig.name != src_obj.name:
+                        # # self.BoneMovement(TargRig, scene.FSimMainProps.fsim_start_frame, scene.FSimMainProps.fsim_end_frame, context)
+                        # bpy.ops.armature.fsimulate()
+        
+        #Selection and the depsgraph are updated once for the whole school
+        for obj in selected:
+            obj.select_set(True)
+        src_obj.select_set(not selected)
+        if active is not None:
+            context.view_layer.objects.active = active
+        context.view_layer.update()
+        return {'FINISHED'}
             
 
 
@@ -356,6 +459,8 @@ class ARMATURE_OT_FSim_Run(bpy.types.Operator):
         # bpy.ops.armature.fsim_test()
         
         if scene.FSimMainProps.fsim_copyrigs or scene.FSimMainProps.fsim_copymesh:
+            if self.bRollback:
+                FSimRollback.Begin()
             self.CopyRigs(context)
         # else:
             # # self.BoneMovement(TargetRig, scene.FSimMainProps.fsim_start_frame, scene.FSimMainProps.fsim_end_frame, context)   
@@ -366,6 +471,15 @@ class ARMATURE_OT_FSim_Run(bpy.types.Operator):
         
     
 
+class ARMATURE_OT_FSim_RunNoUndo(ARMATURE_OT_FSim_Run):
+    """Copy the armature to every target, without global undo (see Revert Last Bake)"""
+    bl_label = "Copy Models"
+    bl_idname = "armature.fsim_run_noundo"
+    bl_options = {'REGISTER', 'PRESET'}
+    
+    bRollback = True
+    
+
 class ARMATURE_PT_FSim(bpy.types.Panel):
     """Creates a Panel in the Object properties window"""
     bl_label = "FishSim"   
@@ -399,13 +513,42 @@ class ARMATURE_PT_FSim(bpy.types.Panel):
         row = layout.row()
         layout.operator("armature.fsim_add")
         row = layout.row()
-        layout.operator("armature.fsimulate")
+        layout.operator("armature.fsimulate" if scene.FSimMainProps.fsim_undo else "armature.fsimulate_noundo")
+        layout.prop(scene.FSimMainProps, "fsim_seed")
+        layout.prop(scene.FSimMainProps, "fsim_fixedstep")
+        if scene.FSimMainProps.fsim_fixedstep:
+            layout.prop(scene.FSimMainProps, "fsim_timestep")
+            xSteps = 1.0 / (scene.FSimMainProps.fsim_timestep * scene.render.fps / scene.render.fps_base)
+            layout.label(text="{:.1f} steps per frame".format(xSteps))
+        layout.prop(scene.FSimMainProps, "fsim_singlepass")
+        layout.prop(scene.FSimMainProps, "fsim_parallel")
+        layout.prop(scene.FSimMainProps, "fsim_incremental")
+        layout.prop(scene.FSimMainProps, "fsim_snapinterval")
+        layout.prop(scene.FSimMainProps, "fsim_usecache")
+        layout.prop(scene.FSimMainProps, "fsim_cachesize")
+        layout.prop(scene.FSimMainProps, "fsim_output")
+        layout.prop(scene.FSimMainProps, "fsim_decimate")
+        if scene.FSimMainProps.fsim_decimate or scene.FSimMainProps.fsim_output in {'FMODIFIERS', 'CYCLES'}:
+            layout.prop(scene.FSimMainProps, "fsim_tol_angle")
+            layout.prop(scene.FSimMainProps, "fsim_tol_scale")
+            layout.prop(scene.FSimMainProps, "fsim_tol_distance")
+        layout.prop(scene.FSimMainProps, "fsim_tickbudget")
+        layout.prop(scene.FSimMainProps, "fsim_isolate")
+        layout.prop(scene.FSimMainProps, "fsim_profile")
+        if scene.FSimMainProps.fsim_profile:
+            layout.prop(scene.FSimMainProps, "fsim_profilepath")
+        layout.prop(scene.FSimMainProps, "fsim_undo")
+        if not scene.FSimMainProps.fsim_undo:
+            layout.operator("armature.fsim_revert")
+        if scene.FSimMainProps.fsim_fps > 0.0:
+            layout.label(text="Simulated {:.0f} frames/sec".format(scene.FSimMainProps.fsim_fps))
         row = layout.row()
         # box = layout.box()
         # box.label(text="Multi Sim Options")
-        layout.operator("armature.fsim_run")
+        layout.operator("armature.fsim_run" if scene.FSimMainProps.fsim_undo else "armature.fsim_run_noundo")
         layout.prop(scene.FSimMainProps, "fsim_copyrigs")
         layout.prop(scene.FSimMainProps, "fsim_copymesh")
+        layout.prop(scene.FSimMainProps, "fsim_sharedata")
         layout.prop(scene.FSimMainProps, "fsim_maxnum")
         layout.prop(scene.FSimMainProps, "fsim_startangle")
 
@@ -540,6 +683,7 @@ classes = (
     AMATURE_MT_fsim_presets,
     AddPresetFSim,
     ARMATURE_OT_FSim_Run,
+    ARMATURE_OT_FSim_RunNoUndo,
 )
 
 def register():